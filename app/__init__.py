@@ -1,20 +1,66 @@
 # Simple init script for flask app
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
-from flask.ext.openid import OpenID
+from flask.ext.mail import Mail
+from jinja2 import FileSystemBytecodeCache
 from config import basedir
 import os
 from momentjs import momentjs
+from lastseen import LastSeenTracker
+from fragments import FragmentCache, MemoryBackend
+from instrumentation import Instrumentation
+from routing import RoutingSQLAlchemy
+from httpcache import HTTPCache
+from search import WhooshBackend
+from jobs import JobQueue
+from assets import Assets
+from lazyopenid import LazyOpenID
 
 app = Flask(__name__)
 app.jinja_env.globals['momentjs'] = momentjs
 app.config.from_object('config')  # read-in configuration file
-db = SQLAlchemy(app)
+if app.config.get('TEMPLATE_CACHE_DIR'):
+  # compiled templates, shared by workers and restarts (compile_templates.py)
+  if not os.path.isdir(app.config['TEMPLATE_CACHE_DIR']):
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'])
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+db = RoutingSQLAlchemy(app)  # reads from replicas in GET requests
 
 lm = LoginManager()
 lm.init_app(app)
 lm.login_view = 'login'
-oid = OpenID(app, os.path.join(basedir, 'tmp'))
+oid = LazyOpenID(app, os.path.join(basedir, 'tmp'))  # imported on first sign in
+mail = Mail(app)
+# before the views, so that requests are timed around their other hooks
+instrumentation = Instrumentation(app, db)
+last_seen = LastSeenTracker(app, db)
+jobs = JobQueue(app, db)  # run by worker.py
+fragment_cache = FragmentCache(app)
+app.jinja_env.globals['render_posts'] = fragment_cache.render_posts
+http_cache = HTTPCache(app)
+assets = Assets(app)  # built by build_assets.py
 
-from app import views, models
+from app import views, models, api
+
+if models.search_engine is not None:
+  instrumentation.instrument(models.search_engine, 'search_page', 'search')
+  instrumentation.add_metric('microblog_search_cache_hits_total', 'Search result cache hits',
+                             lambda: models.search_engine.results.hits, 'counter')
+  instrumentation.add_metric('microblog_search_cache_misses_total', 'Search result cache misses',
+                             lambda: models.search_engine.results.misses, 'counter')
+  if isinstance(models.search_engine, WhooshBackend):
+    instrumentation.add_metric('microblog_search_index_queued', 'Changes waiting to be indexed',
+                               lambda: models.search_engine.indexer.stats()['queued'])
+    instrumentation.add_metric('microblog_search_index_lag_seconds', 'Age of the oldest change waiting to be indexed',
+                               lambda: models.search_engine.indexer.lag())
+if isinstance(fragment_cache.backend, MemoryBackend):
+  instrumentation.add_metric('microblog_fragment_cache_hits_total', 'Post fragment cache hits',
+                             lambda: fragment_cache.backend.lru.hits, 'counter')
+  instrumentation.add_metric('microblog_fragment_cache_misses_total', 'Post fragment cache misses',
+                             lambda: fragment_cache.backend.lru.misses, 'counter')
+instrumentation.add_metric('microblog_identity_cache_hits_total', 'Signed in users loaded from the identity cache',
+                           lambda: models.identity_cache.cache.hits, 'counter')
+instrumentation.add_metric('microblog_identity_cache_misses_total', 'Signed in users loaded from the database',
+                           lambda: models.identity_cache.cache.misses, 'counter')
+instrumentation.add_metric('microblog_last_seen_pending', 'Visits waiting to be written',
+                           lambda: len(last_seen.pending))
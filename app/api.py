@@ -0,0 +1,287 @@
+# JSON API for the mobile client, under /api/v1
+import gzip
+import json
+from cStringIO import StringIO
+from flask import Blueprint, Response, g, request
+from app import app, db, http_cache
+from routing import use_primary
+from models import User, Post, search_engine, feed_events
+from emails import follower_notification, follower_notifications
+from config import POSTS_PER_PAGE
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# the fields a post can be serialized with, as the columns they are read
+# from; posts are read as plain rows, no Post or User objects are built
+FIELDS = {
+  'id': Post.id.label('id'),
+  'body': Post.body.label('body'),
+  'timestamp': Post.timestamp.label('timestamp'),
+  'author': User.nickname.label('author'),
+  'author_id': Post.user_id.label('author_id'),
+  'avatar': User.email_hash.label('email_hash'),
+}
+DEFAULT_FIELDS = ['id', 'body', 'timestamp', 'author', 'avatar']
+
+
+class APIError(Exception):
+  """
+  Raised by API views to answer with a JSON error
+  """
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+    self.message = message
+
+
+def jsonify(data, status=200):
+  """
+  Returns:
+    a compact JSON response
+  """
+  return Response(json.dumps(data, separators=(',', ':')), status=status, mimetype='application/json')
+
+
+def requested_fields():
+  """
+  Read the fields parameter (comma separated names of FIELDS)
+
+  Returns:
+    (names, columns): the fields to serialize, and the columns to read
+    for them and for the cursors
+  """
+  names = request.args.get('fields')
+  names = names.split(',') if names else DEFAULT_FIELDS
+  unknown = [name for name in names if name not in FIELDS]
+  if unknown:
+    raise APIError(400, 'unknown fields: ' + ', '.join(unknown))
+  columns = [FIELDS[name] for name in set(names) | set(['id', 'timestamp'])]
+  return names, columns
+
+
+def per_page():
+  """
+  Returns:
+    the limit parameter, at most API_MAX_PER_PAGE
+  """
+  limit = request.args.get('limit', POSTS_PER_PAGE, type=int)
+  return max(1, min(limit, app.config['API_MAX_PER_PAGE']))
+
+
+def serialize(rows, names):
+  """
+  Returns:
+    the rows as dicts of the requested fields
+  """
+  size = app.config['API_AVATAR_SIZE']
+  posts = []
+  for row in rows:
+    post = {}
+    for name in names:
+      if name == 'timestamp':
+        post[name] = row.timestamp.isoformat() + 'Z'
+      elif name == 'avatar':
+        post[name] = User.avatar_url(row.email_hash, size) if row.email_hash else None
+      else:
+        post[name] = getattr(row, name)
+    posts.append(post)
+  return posts
+
+
+def feed(page, names):
+  """
+  Returns:
+    the response for a KeysetPage of post rows
+  """
+  return jsonify({
+    'posts': serialize(page.items, names),
+    'prev': page.prev_cursor if page.has_prev else None,
+    'next': page.next_cursor if page.has_next else None,
+  })
+
+
+def find_user(nickname):
+  """
+  Returns:
+    the user with a nickname, raising a 404 APIError if there is none
+  """
+  user = User.query.filter_by(nickname=nickname).first()
+  if user is None:
+    raise APIError(404, 'no such user: ' + nickname)
+  return user
+
+
+@api.before_request
+def authenticate():
+  """
+  Every endpoint needs a signed in user (the session cookie of the site)
+  """
+  if not g.user.is_authenticated():
+    return jsonify({'error': 'authentication required'}, 401)
+
+
+@api.errorhandler(APIError)
+def api_error(error):
+  return jsonify({'error': error.message}, error.status)
+
+
+@api.errorhandler(404)
+def not_found(error):
+  # e.g. an invalid cursor
+  return jsonify({'error': 'not found'}, 404)
+
+
+@api.after_request
+def compress(response):
+  """
+  Compress responses of at least API_COMPRESS_MIN_SIZE bytes with brotli
+  (if installed) or gzip, as the client accepts
+  """
+  response.vary.add('Accept-Encoding')
+  if response.status_code != 200 or response.is_streamed or 'Content-Encoding' in response.headers:
+    return response
+  data = response.get_data()
+  if len(data) < app.config['API_COMPRESS_MIN_SIZE']:
+    return response
+  accepted = request.accept_encodings
+  level = app.config['API_COMPRESS_LEVEL']
+  if brotli is not None and accepted['br']:
+    response.set_data(brotli.compress(data, quality=min(level, 11)))
+    response.headers['Content-Encoding'] = 'br'
+  elif accepted['gzip']:
+    buffer = StringIO()
+    with gzip.GzipFile(mode='wb', compresslevel=level, fileobj=buffer) as out:
+      out.write(data)
+    response.set_data(buffer.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+  return response
+
+
+@api.route('/timeline')
+def timeline():
+  """
+  The signed in user's home feed, newest first: ?before=<cursor> for older
+  posts, ?after=<cursor> for newer ones, ?limit=, ?fields=
+  """
+  names, columns = requested_fields()
+  token, last_modified = g.user.timeline_version()
+  not_modified = http_cache.check(token, last_modified)
+  if not_modified is not None:
+    return not_modified
+  return feed(g.user.timeline_rows(columns, per_page(), before=request.args.get('before'),
+                                   after=request.args.get('after')), names)
+
+
+@api.route('/users/<nickname>/posts')
+def user_posts(nickname):
+  """
+  A user's posts, newest first, paged like the timeline
+  """
+  names, columns = requested_fields()
+  user = find_user(nickname)
+  token, last_modified = user.profile_version()
+  not_modified = http_cache.check(token, last_modified)
+  if not_modified is not None:
+    return not_modified
+  return feed(user.posts_rows(columns, per_page(), before=request.args.get('before'),
+                              after=request.args.get('after')), names)
+
+
+@api.route('/events')
+def events():
+  """
+  Server-sent events for the new posts of the users the signed in user
+  follows; each "post" event has the id and author_id of a post, and a
+  cursor for ?after= that fetches it and any newer posts
+  """
+  user_ids = g.user.followed_ids()
+  return feed_events.stream(user_ids)
+
+
+@api.route('/following/<nickname>', methods=['PUT', 'DELETE'])
+@use_primary
+def following(nickname):
+  """
+  Follow (PUT) or unfollow (DELETE) a user; repeating either is harmless
+  """
+  user = find_user(nickname)
+  if user == g.user:
+    raise APIError(400, 'you cannot follow or unfollow yourself')
+  if request.method == 'PUT':
+    u = g.user.follow(user)
+    if u is not None:
+      follower_notification(user, g.user)
+  else:
+    u = g.user.unfollow(user)
+  if u is not None:
+    db.session.add(u)
+    db.session.commit()
+  return jsonify({'nickname': user.nickname, 'following': request.method == 'PUT',
+                  'followers_count': user.followers_count})
+
+
+@api.route('/following', methods=['POST'])
+@use_primary
+def following_many():
+  """
+  Follow and unfollow many users at once: a JSON object with "follow"
+  and/or "unfollow" lists of nicknames or ids, at most API_MAX_BULK_FOLLOW
+  in all, resolved with one query; unknown users and repeated (un)follows
+  are skipped, and everything is committed together. The users followed
+  and unfollowed are returned in the order of their ids.
+  """
+  data = request.json
+  if not isinstance(data, dict):
+    raise APIError(400, 'a JSON object is required')
+  follow, unfollow = data.get('follow', []), data.get('unfollow', [])
+  if not isinstance(follow, list) or not isinstance(unfollow, list):
+    raise APIError(400, 'follow and unfollow must be lists')
+  # JSON true and false are ints to Python
+  if not all(isinstance(key, (int, long, basestring)) and not isinstance(key, bool) for key in follow + unfollow):
+    raise APIError(400, 'users are given by nickname or id')
+  if len(follow) + len(unfollow) > app.config['API_MAX_BULK_FOLLOW']:
+    raise APIError(400, 'at most %d users at once' % app.config['API_MAX_BULK_FOLLOW'])
+  nicknames = User.find_ids(follow + unfollow)
+  ids = dict((nickname, id) for id, nickname in nicknames.iteritems())
+  resolve = lambda keys: [ids[key] if isinstance(key, basestring) else key
+                          for key in keys if key in ids or key in nicknames]
+  follow, unfollow = resolve(follow), resolve(unfollow)
+  if set(follow) & set(unfollow):
+    raise APIError(400, 'a user cannot be both followed and unfollowed')
+  followed = g.user.follow_many(follow)
+  unfollowed = g.user.unfollow_many(unfollow)
+  follower_notifications(followed, g.user)
+  db.session.commit()
+  return jsonify({'followed': [nicknames[id] for id in followed],
+                  'unfollowed': [nicknames[id] for id in unfollowed]})
+
+
+@api.route('/search')
+def search():
+  """
+  Posts matching ?q=, best match first, a ?page= of ?limit= at a time
+  """
+  if search_engine is None:
+    raise APIError(404, 'search is disabled')
+  query = request.args.get('q', '')
+  page = max(1, request.args.get('page', 1, type=int))
+  names, columns = requested_fields()
+  limit = per_page()
+  ids, total = search_engine.cached_page(query, page, limit)
+  rows = []
+  if ids:
+    rows = Post.query.filter(Post.id.in_(ids)).join(User, (User.id == Post.user_id)).with_entities(*columns).all()
+  by_id = dict((row.id, row) for row in rows)
+  return jsonify({
+    'posts': serialize([by_id[id] for id in ids if id in by_id], names),
+    'total': total,
+    'page': page,
+    'pages': (total + limit - 1) // limit,
+  })
+
+app.register_blueprint(api)
@@ -0,0 +1,204 @@
+import errno
+import gzip
+import json
+import os
+import re
+import tempfile
+from hashlib import md5
+from StringIO import StringIO
+from threading import Lock
+from flask import abort, request, send_file, safe_join, url_for
+
+try:
+  import rjsmin
+except ImportError:
+  rjsmin = None
+try:
+  import rcssmin
+except ImportError:
+  rcssmin = None
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# a year: built files never change, as their names are their content hash
+MAX_AGE = 365 * 24 * 3600
+
+COMMENT_LINE = re.compile(r'^\s*//(?!!).*$\n?', re.M)
+CSS_COMMENT = re.compile(r'/\*(?!!).*?\*/', re.S)
+MIMETYPES = {'.js': 'application/javascript', '.css': 'text/css'}
+
+
+def minify(source, extension):
+  """
+  Minify JavaScript or CSS, with rjsmin/rcssmin if installed, or else by
+  dropping comments (but /*! and //! notices) and indentation only
+
+  Returns:
+    the minified source
+  """
+  if extension == '.js':
+    if rjsmin is not None:
+      return rjsmin.jsmin(source, keep_bang_comments=True)
+    source = COMMENT_LINE.sub('', source)
+  elif extension == '.css':
+    if rcssmin is not None:
+      return rcssmin.cssmin(source, keep_bang_comments=True)
+    source = CSS_COMMENT.sub('', source)
+  return '\n'.join(line.strip() for line in source.splitlines() if line.strip())
+
+
+def write_file(path, content):
+  """
+  Write a file under a temporary name and rename it into place, so that
+  processes building at the same time never read a half-written file
+  """
+  directory = os.path.dirname(path)
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  fd, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(content)
+    os.chmod(temporary, 0644)
+    os.rename(temporary, path)
+  except:
+    os.remove(temporary)
+    raise
+
+
+def gzipped(content):
+  """
+  Returns:
+    the content compressed with gzip, the same for the same content
+  """
+  buffer = StringIO()
+  with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+    f.write(content)
+  return buffer.getvalue()
+
+
+class Assets(object):
+  """
+  Bundles of static files, minified, named by their content hash and
+  precompressed, served at /assets with a far-future Cache-Control
+
+  ASSET_BUNDLES maps each bundle name to the files of app/static it
+  concatenates. build_assets.py writes the bundles to ASSETS_DIR at deploy
+  time, along with .gz (and, if brotli is installed, .br) siblings and a
+  manifest; the files of earlier builds are kept for pages cached with
+  their names. Without a manifest the bundles are built on first use, and
+  in debug mode again whenever a source changes. Every file is renamed
+  into place once written, so workers building at once are harmless.
+
+  Templates link bundles with asset_url(name), which falls back to the
+  static file of that name for anything that is not a bundle.
+  """
+  def __init__(self, app):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration and its static folder
+    """
+    app.config.setdefault('ASSET_BUNDLES', {})
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+    self.app = app
+    self.files = None
+    self.lock = Lock()
+    app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+    app.jinja_env.globals['asset_url'] = self.asset_url
+
+  def sources(self, name):
+    return [os.path.join(self.app.static_folder, source) for source in self.app.config['ASSET_BUNDLES'][name]]
+
+  def build(self):
+    """
+    Write every bundle and the manifest to ASSETS_DIR
+
+    Returns:
+      The manifest: the file name of each bundle
+    """
+    directory = self.app.config['ASSETS_DIR']
+    manifest = {}
+    for name in sorted(self.app.config['ASSET_BUNDLES']):
+      base, extension = os.path.splitext(name)
+      separator = ';\n' if extension == '.js' else '\n'
+      content = separator.join(minify(open(source).read(), extension) for source in self.sources(name)) + '\n'
+      filename = '%s.%s%s' % (base, md5(content).hexdigest()[:12], extension)
+      path = os.path.join(directory, filename)
+      write_file(path, content)
+      write_file(path + '.gz', gzipped(content))
+      if brotli is not None:
+        write_file(path + '.br', brotli.compress(content, quality=11))
+      manifest[name] = filename
+    # last, once the files it names are in place
+    write_file(os.path.join(directory, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+  def stale(self):
+    """
+    Returns:
+      True if the manifest is missing or, in debug mode, older than a source
+    """
+    path = os.path.join(self.app.config['ASSETS_DIR'], 'manifest.json')
+    if not os.path.exists(path):
+      return True
+    if not self.app.debug:
+      return False
+    built = os.path.getmtime(path)
+    return any(os.path.getmtime(source) > built
+               for name in self.app.config['ASSET_BUNDLES'] for source in self.sources(name))
+
+  def manifest(self):
+    """
+    Returns:
+      the file name of each bundle, building them if needed
+    """
+    if self.files is None or self.app.debug:
+      with self.lock:
+        if self.stale():
+          self.files = self.build()
+        elif self.files is None or self.app.debug:
+          self.files = json.load(open(os.path.join(self.app.config['ASSETS_DIR'], 'manifest.json')))
+    return self.files
+
+  def asset_url(self, filename, **values):
+    """
+    url_for('static', filename=...) for bundles: the URL of their current
+    build
+
+    Returns:
+      The URL of the bundle, or of the static file if it is not one
+    """
+    built = self.manifest().get(filename)
+    if built is None:
+      return url_for('static', filename=filename, **values)
+    return url_for('assets', filename=built, **values)
+
+  def send(self, filename):
+    """
+    Serve a built file (of this build or an earlier one), precompressed
+    if the client accepts it
+    """
+    path = safe_join(self.app.config['ASSETS_DIR'], filename)
+    if not os.path.isfile(path):
+      abort(404)
+    encoding = None
+    accepted = request.accept_encodings
+    for candidate, extension in [('br', '.br'), ('gzip', '.gz')]:
+      if accepted[candidate] and os.path.exists(path + extension):
+        encoding = candidate
+        path += extension
+        break
+    mimetype = MIMETYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+    response = send_file(path, mimetype=mimetype, add_etags=False, cache_timeout=MAX_AGE, conditional=True)
+    if encoding is not None:
+      response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    return response
@@ -0,0 +1,154 @@
+import json
+from datetime import datetime
+from app import app, db
+from models import User, Post, Timeline, followers, search_engine, suggestions
+from search import WhooshBackend
+from indexer import index_writer, document
+
+# record types of the NDJSON format, in the order they are exported and
+# inserted (posts and follows reference users)
+TABLES = [('user', User.__table__), ('post', Post.__table__), ('follow', followers)]
+
+# columns that are not exported, as they are derived from the others
+DERIVED = set(['email_hash', 'version', 'followers_count', 'following_count', 'posts_count', 'pull_timeline',
+               'graph_version'])
+
+
+def keyset_chunks(connection, table, batch_size):
+  """
+  Read a table in primary key order, a chunk of rows at a time, without
+  OFFSET scans
+
+  Yields:
+    lists of rows
+  """
+  keys = list(table.primary_key.columns)
+  columns = [column for column in table.columns if column.name not in DERIVED]
+  last = None
+  while True:
+    query = db.select(columns).order_by(*keys).limit(batch_size)
+    if last is not None:
+      # (k1, k2) > (last1, last2), spelled out for SQLAlchemy 0.7
+      after = keys[-1] > last[keys[-1].name]
+      for key in reversed(keys[:-1]):
+        after = db.or_(key > last[key.name], db.and_(key == last[key.name], after))
+      query = query.where(after)
+    rows = connection.execute(query).fetchall()
+    if not rows:
+      return
+    yield rows
+    last = rows[-1]
+
+
+def export_ndjson(out, batch_size=10000):
+  """
+  Write every user, post and follow as one JSON object per line, with a
+  "type" of 'user', 'post' or 'follow'
+
+  Returns:
+    The number of records written
+  """
+  count = 0
+  connection = db.engine.connect()
+  try:
+    for kind, table in TABLES:
+      for rows in keyset_chunks(connection, table, batch_size):
+        for row in rows:
+          record = dict((name, value.isoformat() if isinstance(value, datetime) else value)
+                        for name, value in row.items())
+          record['type'] = kind
+          out.write(json.dumps(record, sort_keys=True) + '\n')
+        count += len(rows)
+  finally:
+    connection.close()
+  return count
+
+
+def parse_time(value):
+  """
+  Returns:
+    the datetime of an isoformat() string, or None
+  """
+  if value is None:
+    return None
+  return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def import_ndjson(lines, batch_size=10000, index=True):
+  """
+  Insert the records of an export in batches with executemany, then
+  recompute counters, timelines and suggestions once
+
+  Records are inserted as they are (with their ids) and must not exist
+  yet. Only one batch per type is held in memory, but every batch is
+  inserted in one transaction: an import that fails (a bad line, a
+  duplicate key) leaves nothing behind and can be run again. With Whoosh,
+  posts are
+  indexed as they are read when the post table starts out empty, else
+  the index is rebuilt at the end; the database search backends index
+  rows as they are inserted.
+
+  Args:
+    lines: an iterable of NDJSON lines, e.g. an open file
+    batch_size: rows per INSERT executemany
+    index: whether to rebuild the Whoosh index
+
+  Returns:
+    A dict with the number of records imported of each type
+  """
+  connection = db.engine.connect()
+  whoosh = index and isinstance(search_engine, WhooshBackend)
+  writer = None
+  if whoosh and connection.execute(db.select([Post.id]).limit(1)).first() is None:
+    writer = index_writer(app, Post)
+  buffers = dict((kind, []) for kind, table in TABLES)
+  counts = dict((kind, 0) for kind, table in TABLES)
+
+  def flush():
+    for kind, table in TABLES:
+      if buffers[kind]:
+        connection.execute(table.insert(), buffers[kind])
+        counts[kind] += len(buffers[kind])
+        del buffers[kind][:]
+
+  transaction = connection.begin()
+  try:
+    for line in lines:
+      if not line.strip():
+        continue
+      record = json.loads(line)
+      kind = record.pop('type')
+      if kind == 'user':
+        record['last_seen'] = parse_time(record.get('last_seen'))
+        record['email_hash'] = User.hash_email(record['email']) if record.get('email') else None
+        record.update(version=0, followers_count=0, following_count=0, posts_count=0, pull_timeline=False,
+                      graph_version=0)
+      elif kind == 'post':
+        record['timestamp'] = parse_time(record.get('timestamp'))
+        if writer is not None:
+          writer.add_document(**document(Post, record))
+      buffers[kind].append(record)
+      if len(buffers[kind]) >= batch_size:
+        flush()
+    flush()
+    if connection.dialect.name == 'postgresql':
+      # ids were inserted explicitly, so move the sequences past them
+      for table in (User.__table__, Post.__table__):
+        connection.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), coalesce(max(id), 1)) FROM %s"
+                           % (table.name, connection.dialect.identifier_preparer.quote(table.name)))
+    transaction.commit()
+  except:
+    transaction.rollback()
+    if writer is not None:
+      writer.cancel()
+    raise
+  finally:
+    connection.close()
+  User.recount()
+  Timeline.rebuild()
+  suggestions.refresh()
+  if writer is not None:
+    writer.commit(optimize=True)
+  elif whoosh:
+    search_engine.rebuild(db.engine)
+  return counts
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+  """
+  A bounded, thread-safe, in-process least recently used cache, whose
+  entries optionally expire
+  """
+  def __init__(self, maxsize, ttl=None):
+    """
+    Constructor
+
+    Args:
+      maxsize: the most entries kept; the least recently used one is dropped
+      ttl: seconds an entry stays valid after it is set, or None to keep
+        entries until they are dropped
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.lock = Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    """
+    Look up a key, marking it as recently used
+
+    Returns:
+      The cached value, or default if the key is not cached or expired
+    """
+    with self.lock:
+      try:
+        value, expires = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      if expires is not None and expires <= time.time():
+        self.misses += 1
+        return default
+      self.entries[key] = value, expires
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    """
+    Cache a value, dropping the least recently used entry if full
+    """
+    expires = None if self.ttl is None else time.time() + self.ttl
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value, expires
+      if len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def delete(self, key):
+    """
+    Drop a key, if cached
+    """
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    """
+    Drop every entry
+    """
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
@@ -0,0 +1,34 @@
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+
+class InsertFromSelect(Executable, ClauseElement):
+  """
+  INSERT INTO table (columns) SELECT ... construct
+
+  SQLAlchemy 0.7 has no Insert.from_select(), so this is the documented
+  compiler extension recipe. It lets set-based copies run in the database
+  instead of round-tripping rows through Python.
+  """
+  _execution_options = Executable._execution_options.union({'autocommit': True})
+
+  def __init__(self, table, columns, select):
+    """
+    Constructor
+
+    Args:
+      table: the table to insert into
+      columns: names of the target columns, in the order of the select
+      select: the select statement providing the rows
+    """
+    self.table = table
+    self.columns = columns
+    self.select = select
+
+
+@compiles(InsertFromSelect)
+def visit_insert_from_select(element, compiler, **kw):
+  return 'INSERT INTO %s (%s) %s' % (
+    compiler.process(element.table, asfrom=True),
+    ', '.join(element.columns),
+    compiler.process(element.select))
@@ -0,0 +1,74 @@
+# Mail sent by the job worker, never inside a request
+import math
+import time
+from datetime import datetime
+from flask import render_template
+from flask.ext.mail import Message
+from app import app, db, mail, jobs
+from models import User, followers
+
+
+def follower_notification(followed, follower):
+  """
+  Queue a mail telling a user about a new follower, in the current
+  transaction; the followers gained within FOLLOWER_EMAIL_DELAY seconds
+  are sent in one digest
+
+  Args:
+    followed: the user being followed
+    follower: the new follower
+  """
+  follower_notifications([followed.id], follower)
+
+
+def follower_notifications(followed_ids, follower, now=None):
+  """
+  follower_notification for many followed users, by id
+
+  Time is cut into windows of FOLLOWER_EMAIL_DELAY seconds, and the mails
+  of a follow are due when its window ends: the followers gained within
+  a window come due together, and the worker takes them in one batch.
+
+  Args:
+    followed_ids: ids of the users being followed
+    follower: the new follower
+    now: the time of the follow, as a time.time() value (the current time
+      by default)
+  """
+  delay = app.config['FOLLOWER_EMAIL_DELAY']
+  if now is None:
+    now = time.time()
+  run_at = datetime.utcfromtimestamp(math.ceil(now / float(delay)) * delay)
+  for followed_id in followed_ids:
+    jobs.enqueue('follower_email', {'followed': followed_id, 'follower': follower.id}, run_at=run_at)
+
+
+@jobs.handler('follower_email', batch=True)
+def send_follower_emails(payloads):
+  """
+  Send one mail per followed user over a single SMTP connection, leaving
+  out followers who unfollowed since
+  """
+  followed_ids = set(payload['followed'] for payload in payloads)
+  follower_ids = set(payload['follower'] for payload in payloads)
+  current = set(db.session.query(followers.c.followed_id, followers.c.follower_id).filter(
+    followers.c.followed_id.in_(followed_ids)).filter(followers.c.follower_id.in_(follower_ids)))
+  users = dict((user.id, user) for user in User.query.filter(User.id.in_(followed_ids | follower_ids)))
+  digests = {}
+  for payload in payloads:
+    key = (payload['followed'], payload['follower'])
+    if key in current and payload['follower'] not in digests.get(payload['followed'], []):
+      digests.setdefault(payload['followed'], []).append(payload['follower'])
+  if not digests:
+    return
+  with mail.connect() as connection:
+    for user_id, new_followers in digests.iteritems():
+      user = users[user_id]
+      new_followers = [users[id] for id in new_followers]
+      if len(new_followers) == 1:
+        subject = '[microblog] %s is now following you!' % new_followers[0].nickname
+      else:
+        subject = '[microblog] %d new followers' % len(new_followers)
+      connection.send(Message(subject, sender=app.config['ADMINS'][0], recipients=[user.email],
+                              body=render_template('follower_email.txt', user=user, followers=new_followers),
+                              html=render_template('follower_email.html', user=user, followers=new_followers)))
@@ -0,0 +1,192 @@
+import json
+import time
+from Queue import Queue, Empty, Full
+from threading import Lock
+from flask import Response
+from flask.ext.sqlalchemy import models_committed
+from pagination import encode_cursor
+
+# how long browsers wait before reconnecting a closed stream, milliseconds
+RETRY = 3000
+
+
+class MemoryBroker(object):
+  """
+  Publish/subscribe within this process (the default)
+
+  Only the clients connected to the process that committed a post hear of
+  it, so run a single (async) worker, or a shared broker on several.
+  """
+  def __init__(self, app):
+    self.channels = {}
+    self.lock = Lock()
+
+  def publish(self, channel, message):
+    with self.lock:
+      subscriptions = list(self.channels.get(channel, ()))
+    for subscription in subscriptions:
+      subscription.put(message)
+
+  def subscribe(self, channels):
+    subscription = MemorySubscription(self, channels)
+    with self.lock:
+      for channel in channels:
+        self.channels.setdefault(channel, set()).add(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      for channel in subscription.channels:
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+          subscribers.discard(subscription)
+          if not subscribers:
+            del self.channels[channel]
+
+
+class MemorySubscription(object):
+  """
+  The messages of a MemoryBroker for one client; a client that falls too
+  far behind misses messages rather than growing the queue without bound
+  """
+  def __init__(self, broker, channels):
+    self.broker = broker
+    self.channels = channels
+    self.queue = Queue(maxsize=100)
+
+  def put(self, message):
+    try:
+      self.queue.put_nowait(message)
+    except Full:
+      pass
+
+  def get(self, timeout):
+    """
+    Returns:
+      the next message, or None if there was none for timeout seconds
+    """
+    try:
+      return self.queue.get(timeout=timeout)
+    except Empty:
+      return None
+
+  def close(self):
+    self.broker.unsubscribe(self)
+
+
+class RedisBroker(object):
+  """
+  Publish/subscribe through redis at EVENTS_BROKER_URL, shared by every
+  worker and node (needs the redis package)
+  """
+  def __init__(self, app):
+    import redis
+    self.client = redis.StrictRedis.from_url(app.config['EVENTS_BROKER_URL'])
+
+  def publish(self, channel, message):
+    self.client.publish(channel, message)
+
+  def subscribe(self, channels):
+    return RedisSubscription(self.client, channels)
+
+
+class RedisSubscription(object):
+  """
+  The messages of a RedisBroker for one client, on its own connection
+  """
+  def __init__(self, client, channels):
+    self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+    self.pubsub.subscribe(*channels)
+
+  def get(self, timeout):
+    message = self.pubsub.get_message(timeout=timeout)
+    if message is None:
+      return None
+    return message['data']
+
+  def close(self):
+    self.pubsub.close()
+
+
+BROKERS = {
+  'memory': MemoryBroker,
+  'redis': RedisBroker,
+}
+
+
+class FeedEvents(object):
+  """
+  Server-sent events announcing new posts to the followers of their
+  authors
+
+  Every committed post is published once, on its author's channel; a
+  client subscribes to the channels of the users it follows when it
+  connects. Events carry the post's id, author and a cursor just below
+  it: the API's ?after=<cursor> fetches the post and any newer ones.
+
+  A stream holds its connection open for EVENTS_TIMEOUT seconds (browsers
+  reconnect by themselves), with a comment every EVENTS_HEARTBEAT seconds
+  so dead connections are noticed. Idle streams need an async worker
+  class (see the Procfile); a sync worker is tied up by each one.
+  """
+  def __init__(self, app, model):
+    """
+    Constructor
+
+    Args:
+      app: the flask app; EVENTS_BROKER names the broker
+      model: the post model, with id, user_id and timestamp columns
+    """
+    app.config.setdefault('EVENTS_BROKER', 'memory')
+    app.config.setdefault('EVENTS_BROKER_URL', 'redis://localhost:6379/0')
+    app.config.setdefault('EVENTS_HEARTBEAT', 15)
+    app.config.setdefault('EVENTS_TIMEOUT', 300)
+    self.app = app
+    self.model = model
+    self.broker = BROKERS[app.config['EVENTS_BROKER']](app)
+    models_committed.connect(self.on_commit)
+
+  @staticmethod
+  def channel(user_id):
+    return 'posts:%d' % user_id
+
+  def on_commit(self, sender, changes):
+    """
+    models_committed signal handler: publish the new posts
+    """
+    for instance, operation in changes:
+      if operation == 'insert' and isinstance(instance, self.model):
+        # ids are integers, so no post sorts between (timestamp, id - 1)
+        # and this one
+        message = json.dumps({'id': instance.id, 'author_id': instance.user_id,
+                              'cursor': encode_cursor(instance.timestamp, instance.id - 1)})
+        self.broker.publish(self.channel(instance.user_id), message)
+
+  def stream(self, user_ids):
+    """
+    Subscribe to the posts of some users, before the response is returned
+    so that nothing committed meanwhile is missed
+
+    Returns:
+      A text/event-stream response
+    """
+    subscription = self.broker.subscribe([self.channel(user_id) for user_id in user_ids])
+    heartbeat = self.app.config['EVENTS_HEARTBEAT']
+    deadline = time.time() + self.app.config['EVENTS_TIMEOUT']
+
+    def events():
+      try:
+        yield 'retry: %d\n\n' % RETRY
+        while time.time() < deadline:
+          message = subscription.get(min(heartbeat, max(deadline - time.time(), 0)))
+          if message is None:
+            yield ': ping\n\n'
+          else:
+            yield 'id: %s\nevent: post\ndata: %s\n\n' % (json.loads(message)['id'], message)
+      finally:
+        subscription.close()
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also when the client goes away before the stream starts
+    response.call_on_close(subscription.close)
+    return response
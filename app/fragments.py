@@ -0,0 +1,119 @@
+from flask import render_template
+from jinja2 import Markup
+from cache import LRUCache
+import momentjs
+
+
+class MemoryBackend(object):
+  """
+  Fragment storage in an in-process LRU (the default)
+  """
+  def __init__(self, app):
+    self.lru = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+  def get_many(self, keys):
+    found = {}
+    for key in keys:
+      value = self.lru.get(key)
+      if value is not None:
+        found[key] = value
+    return found
+
+  def set_many(self, mapping):
+    for key, value in mapping.iteritems():
+      self.lru.set(key, value)
+
+
+class MemcachedBackend(object):
+  """
+  Fragment storage in memcached, shared by every worker (needs the
+  python-memcached package)
+  """
+  def __init__(self, app):
+    import memcache
+    self.client = memcache.Client(app.config['FRAGMENT_CACHE_SERVERS'])
+
+  def get_many(self, keys):
+    return self.client.get_multi(keys)
+
+  def set_many(self, mapping):
+    self.client.set_multi(mapping)
+
+
+class RedisBackend(object):
+  """
+  Fragment storage in redis, shared by every worker (needs the redis
+  package); entries expire as redis evicts them under its maxmemory policy
+  """
+  def __init__(self, app):
+    import redis
+    self.client = redis.StrictRedis.from_url(app.config['FRAGMENT_CACHE_SERVERS'][0])
+
+  def get_many(self, keys):
+    return dict((key, value.decode('utf-8')) for key, value in zip(keys, self.client.mget(keys)) if value is not None)
+
+  def set_many(self, mapping):
+    self.client.mset(dict((key, value.encode('utf-8')) for key, value in mapping.iteritems()))
+
+
+BACKENDS = {
+  'memory': MemoryBackend,
+  'memcached': MemcachedBackend,
+  'redis': RedisBackend,
+}
+
+
+class FragmentCache(object):
+  """
+  Cache of rendered post.html fragments
+
+  A fragment only depends on the post, which never changes, and on its
+  author's nickname and avatar, so entries are keyed by post id and
+  User.version (plus the current minute when times are rendered on the
+  server). Bumping the author's version retires all of their fragments at
+  once; the stale entries age out of the backend.
+  """
+  def __init__(self, app):
+    """
+    Constructor
+
+    Args:
+      app: the flask app; FRAGMENT_CACHE names the backend, or None to
+        render every fragment
+    """
+    app.config.setdefault('FRAGMENT_CACHE', 'memory')
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+    app.config.setdefault('FRAGMENT_CACHE_SERVERS', ['127.0.0.1:11211'])
+    self.app = app
+    self.backend = None
+    if app.config['FRAGMENT_CACHE'] is not None:
+      self.backend = BACKENDS[app.config['FRAGMENT_CACHE']](app)
+
+  def key(self, post):
+    """
+    Returns:
+      the cache key of a post's fragment
+    """
+    return 'post:%d:%d:%s' % (post.id, post.author.version or 0, momentjs.cache_token(self.app.config))
+
+  def render_posts(self, posts):
+    """
+    Render a list of posts through post.html, reusing cached fragments
+
+    Args:
+      posts: the posts, with their authors loaded
+
+    Returns:
+      The concatenated HTML
+    """
+    if self.backend is None:
+      return Markup(''.join(render_template('post.html', post=post) for post in posts))
+    keys = [self.key(post) for post in posts]
+    found = self.backend.get_many(keys)
+    missing = {}
+    for key, post in zip(keys, posts):
+      if key not in found:
+        missing[key] = found[key] = render_template('post.html', post=post)
+    if missing:
+      self.backend.set_many(missing)
+    return Markup(''.join(found[key] for key in keys))
@@ -0,0 +1,103 @@
+import os
+import time
+from hashlib import md5
+from flask import g, request, session, Response
+
+# only these methods are answered from the browser's copy
+CONDITIONAL_METHODS = ('GET', 'HEAD')
+
+
+class HTTPCache(object):
+  """
+  Conditional GETs for pages whose content follows from a few cheaply read
+  values (a version token)
+
+  A view calls check() with its token before loading or rendering anything
+  else, and returns the 304 response it gets back when the browser's copy
+  is current. Otherwise the page is rendered and sent with an ETag, a
+  Last-Modified and Cache-Control: private, no-cache, so browsers keep it
+  but revalidate it on every visit. Only the ETag decides on a 304, as
+  not every change to a page has a time.
+
+  ETags also cover the viewer, the templates, the session's CSRF secret
+  and a window of ETAG_LIFETIME seconds, since pages embed CSRF tokens that
+  expire. Pages are not validated while flashed messages are pending, as
+  those are shown only once.
+
+  Successful GETs of the endpoints in CACHE_CONTROL get its policy instead,
+  e.g. to let browsers keep the login page for a while.
+  """
+  def __init__(self, app):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration and hooks
+    """
+    app.config.setdefault('ETAG_LIFETIME', 600)
+    app.config.setdefault('CACHE_CONTROL', {})
+    self.app = app
+    self.templates = self.templates_mtime(app)
+    app.after_request(self.after_request)
+
+  @staticmethod
+  def templates_mtime(app):
+    """
+    Returns:
+      the time the newest template was modified, the same in every worker
+      of a deployment
+    """
+    newest = 0
+    for directory, dirs, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+      for name in files:
+        newest = max(newest, os.path.getmtime(os.path.join(directory, name)))
+    return newest
+
+  def etag(self, token):
+    """
+    Returns:
+      the ETag of the current request's page for a version token
+    """
+    user = getattr(g, 'user', None)
+    viewer = user.get_id() if user is not None and user.is_authenticated() else None
+    window = int(time.time() // self.app.config['ETAG_LIFETIME'])
+    key = (token, viewer, session.get('csrf'), self.templates, window)
+    return md5(repr(key)).hexdigest()
+
+  def check(self, token, last_modified=None):
+    """
+    Validate the browser's copy of the current page
+
+    Args:
+      token: a value that changes whenever the page may have changed
+      last_modified: the time of the newest change to the page, if known
+
+    Returns:
+      A 304 Not Modified response if the browser's copy is current, else
+      None
+    """
+    if request.method not in CONDITIONAL_METHODS or session.get('_flashes'):
+      return None
+    g.etag = self.etag(token)
+    g.last_modified = last_modified
+    if g.etag in request.if_none_match:
+      return Response(status=304)
+    return None
+
+  def after_request(self, response):
+    """
+    Add the validators and Cache-Control headers
+    """
+    etag = getattr(g, 'etag', None)
+    if etag is not None and response.status_code in (200, 304):
+      response.set_etag(etag)
+      if g.last_modified is not None:
+        response.last_modified = g.last_modified
+      response.headers['Cache-Control'] = 'private, no-cache'
+      response.vary.add('Cookie')
+      return response
+    policy = self.app.config['CACHE_CONTROL'].get(request.endpoint)
+    if policy is not None and request.method in CONDITIONAL_METHODS and response.status_code == 200:
+      response.headers['Cache-Control'] = policy
+      response.vary.add('Cookie')
+    return response
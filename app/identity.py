@@ -0,0 +1,100 @@
+from flask.ext.sqlalchemy import models_committed
+from cache import LRUCache
+
+
+class Identity(object):
+  """
+  The cached columns of a row, standing in for an instance of its model
+
+  Subclasses name the model and the columns they keep, and may borrow the
+  model's methods that read no other attribute. Reading anything else
+  loads the full instance into the session, once; views that change a row
+  must change instance(), as identities are read-only.
+  """
+  model = None
+  fields = ()
+
+  def __init__(self, values):
+    self.__dict__.update(values)
+    self.__dict__['_instance'] = None
+
+  def instance(self):
+    """
+    Returns:
+      the full instance of the row, from the session
+    """
+    if self._instance is None:
+      self.__dict__['_instance'] = self.model.query.get(self.id)
+    return self._instance
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self.instance(), name)
+
+  def __setattr__(self, name, value):
+    raise AttributeError('%s is read-only, change instance() instead' % type(self).__name__)
+
+  def __eq__(self, other):
+    return isinstance(other, (Identity, self.model)) and other.id == self.id
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.id)
+
+
+class IdentityCache(object):
+  """
+  The identities of signed in users by id, for IDENTITY_CACHE_TTL seconds
+  and up to IDENTITY_CACHE_SIZE of them, so that authenticating a request
+  needs no query
+
+  Committed changes to a row drop its identity in this process; other
+  processes see them when the entry expires.
+  """
+  def __init__(self, app, db, identity):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration
+      db: the Flask-SQLAlchemy object
+      identity: the Identity subclass to build
+    """
+    app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+    app.config.setdefault('IDENTITY_CACHE_TTL', 30)
+    self.db = db
+    self.identity = identity
+    self.columns = [getattr(identity.model, field) for field in identity.fields]
+    self.cache = LRUCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    models_committed.connect(self.on_commit)
+
+  def get(self, id):
+    """
+    Returns:
+      the identity of a row, or None if there is no such row
+    """
+    values = self.cache.get(id)
+    if values is None:
+      row = self.db.session.query(*self.columns).filter(self.identity.model.id == id).first()
+      if row is None:
+        return None
+      values = dict(zip(self.identity.fields, row))
+      self.cache.set(id, values)
+    return self.identity(values)
+
+  def invalidate(self, id):
+    """
+    Drop the identity of a row, e.g. after changing it without the ORM
+    """
+    self.cache.delete(id)
+
+  def on_commit(self, sender, changes):
+    """
+    models_committed signal handler: drop the identities of changed rows
+    """
+    for instance, operation in changes:
+      if isinstance(instance, self.identity.model):
+        self.invalidate(instance.id)
@@ -0,0 +1,282 @@
+import atexit
+import os
+import time
+import Queue
+from collections import OrderedDict
+from threading import Lock, Thread
+import whoosh.index
+from sqlalchemy import select
+from flask.ext.sqlalchemy import models_committed
+import flask.ext.whooshalchemy as whooshalchemy
+
+# whooshalchemy listens to every commit as soon as it is imported, indexing
+# inside the request; SearchIndexer indexes in the background instead
+models_committed.disconnect(whooshalchemy._after_flush)
+
+
+class SearchIndexer(object):
+  """
+  Indexes committed changes of a searchable model in a background thread
+
+  Instead of opening a Whoosh writer inside every request that commits a
+  post, changes are queued and written in batches: one writer commit per
+  WHOOSH_BATCH_SIZE changes or WHOOSH_BATCH_DELAY milliseconds, whichever
+  comes first. Batches are committed without merging segments; segments
+  are merged every WHOOSH_MERGE_INTERVAL seconds instead.
+  """
+  def __init__(self, app, model, index):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration and logging
+      model: the model class with __searchable__ fields
+      index: the Whoosh index of the model
+    """
+    app.config.setdefault('WHOOSH_BATCH_SIZE', 100)
+    app.config.setdefault('WHOOSH_BATCH_DELAY', 500)
+    app.config.setdefault('WHOOSH_MERGE_INTERVAL', 3600)
+    self.app = app
+    self.model = model
+    self.index = index
+    self.primary_key = whooshalchemy._get_whoosh_schema_and_primary_key(model)[1]
+    self.queue = Queue.Queue()
+    self.lock = Lock()
+    self.thread = None
+    self.pid = None
+    self.last_merge = time.time()
+    self.indexed = 0
+    self.batches = 0
+    atexit.register(self.stop)
+
+  def on_commit(self, sender, changes):
+    """
+    models_committed signal handler: queue the committed changes
+
+    The searchable fields are read here, while the instances are still
+    usable, so the background thread never touches the session.
+    """
+    now = time.time()
+    for key, document in self.documents(changes):
+      self.queue.put((key, document, now))
+    self.start()
+
+  def documents(self, changes):
+    """
+    Returns:
+      (primary key, document or None to delete) for each committed change
+      of the model
+    """
+    documents = []
+    for instance, operation in changes:
+      if not isinstance(instance, self.model):
+        continue
+      document = None
+      if operation != 'delete':
+        document = dict((field, unicode(getattr(instance, field))) for field in self.model.__searchable__)
+      documents.append((unicode(getattr(instance, self.primary_key)), document))
+    return documents
+
+  def start(self):
+    """
+    Start the background thread, if it is not running in this process
+    (threads do not survive a fork, e.g. with gunicorn --preload)
+    """
+    with self.lock:
+      if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      self.thread = Thread(target=self.run, name='search-indexer')
+      self.thread.daemon = True
+      self.thread.start()
+
+  def run(self):
+    """
+    Background loop: collect a batch, write it, merge when it is time to
+    """
+    stopping = False
+    while not stopping:
+      try:
+        batch = [self.queue.get(timeout=self.app.config['WHOOSH_MERGE_INTERVAL'])]
+      except Queue.Empty:
+        batch = []
+      deadline = time.time() + self.app.config['WHOOSH_BATCH_DELAY'] / 1000.0
+      while batch and len(batch) < self.app.config['WHOOSH_BATCH_SIZE']:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self.queue.get(timeout=remaining))
+        except Queue.Empty:
+          break
+      taken = len(batch)
+      if None in batch:
+        stopping = True
+        batch.remove(None)
+      try:
+        self.write(batch)
+      except Exception:
+        # e.g. the index lock is held by another process: retry later
+        self.app.logger.exception('search indexer: failed to write %d changes', len(batch))
+        for item in batch:
+          self.queue.put(item)
+        time.sleep(1)
+      for i in range(taken):
+        self.queue.task_done()
+
+  def write(self, batch):
+    """
+    Write a batch of queued changes in one writer commit
+
+    Args:
+      batch: (primary key, document or None to delete, queued at) tuples
+    """
+    merge = time.time() - self.last_merge >= self.app.config['WHOOSH_MERGE_INTERVAL']
+    if not batch and not merge:
+      return
+    # only the last change of each row counts: update_document does not see
+    # documents added earlier in the same writer
+    latest = OrderedDict((key, document) for key, document, queued in batch)
+    writer = self.index.writer(timeout=10)
+    try:
+      for key, document in latest.iteritems():
+        if document is None:
+          writer.delete_by_term(self.primary_key, key)
+        else:
+          document[self.primary_key] = key
+          writer.update_document(**document)
+    except:
+      writer.cancel()
+      raise
+    writer.commit(merge=merge)
+    if merge:
+      self.last_merge = time.time()
+    self.indexed += len(batch)
+    self.batches += 1
+
+  def stop(self):
+    """
+    Stop the background thread and write what is left (at exit)
+    """
+    if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+      self.queue.put(None)
+      self.thread.join(10)
+    self.flush()
+
+  def flush(self, timeout=10):
+    """
+    Write everything queued so far: wait up to timeout seconds for the
+    background thread to write it, or write it from the calling thread if
+    the background thread is not running (changes stay in order either way)
+    """
+    if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+      deadline = time.time() + timeout
+      while self.queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.01)
+      return
+    batch = []
+    while True:
+      try:
+        batch.append(self.queue.get_nowait())
+      except Queue.Empty:
+        break
+    try:
+      self.write([item for item in batch if item is not None])
+    finally:
+      for item in batch:
+        self.queue.task_done()
+
+  def lag(self):
+    """
+    Returns:
+      the age in seconds of the oldest queued change (0 if none)
+    """
+    with self.queue.mutex:
+      if not self.queue.queue or self.queue.queue[0] is None:
+        return 0.0
+      return time.time() - self.queue.queue[0][2]
+
+  def stats(self):
+    """
+    Returns:
+      a dict with the queue length and lag, and the changes and batches
+      written so far by this process
+    """
+    return {'queued': self.queue.qsize(), 'lag': self.lag(),
+            'indexed': self.indexed, 'batches': self.batches}
+
+
+def open_index(app, model):
+  """
+  Open the Whoosh index of a model at WHOOSH_BASE/<model name>, creating it
+  if it does not exist (like whooshalchemy.whoosh_index, without replacing
+  model.query)
+  """
+  path = os.path.join(app.config['WHOOSH_BASE'], model.__name__)
+  if whoosh.index.exists_in(path):
+    return whoosh.index.open_dir(path)
+  if not os.path.exists(path):
+    os.makedirs(path)
+  return whoosh.index.create_in(path, whooshalchemy._get_whoosh_schema_and_primary_key(model)[0])
+
+
+def index_writer(app, model):
+  """
+  Recreate the Whoosh index of a model, empty
+
+  Returns:
+    a writer on the new index, to be committed with optimize=True once
+    every document is added
+  """
+  schema = whooshalchemy._get_whoosh_schema_and_primary_key(model)[0]
+  path = os.path.join(app.config['WHOOSH_BASE'], model.__name__)
+  if not os.path.exists(path):
+    os.makedirs(path)
+  return whoosh.index.create_in(path, schema).writer()
+
+
+def document(model, row):
+  """
+  Returns:
+    the Whoosh document of a row with the model's primary key and
+    __searchable__ columns
+  """
+  primary_key = whooshalchemy._get_whoosh_schema_and_primary_key(model)[1]
+  fields = dict((field, unicode(row[field])) for field in model.__searchable__)
+  fields[primary_key] = unicode(row[primary_key])
+  return fields
+
+
+def rebuild_index(app, model, connection, batch_size=1000):
+  """
+  Recreate the Whoosh index of a model from the database, in one writer
+
+  Args:
+    app: the flask app (WHOOSH_BASE is the index location)
+    model: the model class with __searchable__ fields
+    connection: a database connection or engine to read rows with
+    batch_size: number of rows fetched at a time
+
+  Returns:
+    The number of documents indexed
+  """
+  primary_key = whooshalchemy._get_whoosh_schema_and_primary_key(model)[1]
+  table = model.__table__
+  key = table.c[primary_key]
+  columns = [key] + [table.c[field] for field in model.__searchable__]
+  writer = index_writer(app, model)
+  count = 0
+  last = None
+  while True:
+    query = select(columns).order_by(key).limit(batch_size)
+    if last is not None:
+      query = query.where(key > last)
+    rows = connection.execute(query).fetchall()
+    if not rows:
+      break
+    for row in rows:
+      writer.add_document(**document(model, row))
+    count += len(rows)
+    last = rows[-1][primary_key]
+  writer.commit(optimize=True)
+  return count
@@ -0,0 +1,328 @@
+import cProfile
+import hmac
+import os
+import random
+import time
+from collections import defaultdict
+from threading import Lock
+from flask import abort, g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import mapper
+
+PHASES = ['db', 'template', 'search', 'other']
+
+# upper bounds of the request duration histogram, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# the installed Instrumentation objects: SQLAlchemy 0.7 cannot remove
+# engine and mapper listeners, so one set of them, added on the first
+# install, calls these
+installed = []
+
+
+def before_cursor_execute(*args):
+  for instrumentation in installed:
+    instrumentation.before_cursor_execute(*args)
+
+
+def after_cursor_execute(*args):
+  for instrumentation in installed:
+    instrumentation.after_cursor_execute(*args)
+
+
+def on_load(*args):
+  for instrumentation in installed:
+    instrumentation.on_load(*args)
+
+
+def listen():
+  """
+  Add the engine and mapper listeners, once
+  """
+  if not getattr(listen, 'done', False):
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(mapper, 'load', on_load)
+    listen.done = True
+
+
+class Instrumentation(object):
+  """
+  Opt-in per request timings, split into db, template, search and other
+  phases, with counts of SQL statements and loaded rows
+
+  Timings are exclusive: a query issued while a template renders counts
+  as db time, not template time. Every instrumented request gets a
+  Server-Timing header, and totals are served at /metrics in the
+  Prometheus text format (per process). A sample of requests can be
+  profiled with cProfile, keeping the profiles of slow ones. /metrics only
+  answers clients in METRICS_ALLOWED_IPS, or with METRICS_TOKEN as a bearer
+  token.
+
+  Nothing is hooked unless INSTRUMENTATION is set when the app starts;
+  uninstall() removes the hooks.
+  """
+  def __init__(self, app, db):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration and hooks
+      db: the Flask-SQLAlchemy object
+    """
+    app.config.setdefault('INSTRUMENTATION', False)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_SLOW_MS', 500)
+    app.config.setdefault('PROFILE_DIR', 'profiles')
+    app.config.setdefault('METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    app.config.setdefault('METRICS_TOKEN', None)
+    self.app = app
+    self.db = db
+    self.enabled = app.config['INSTRUMENTATION']
+    self.lock = Lock()
+    self.requests = defaultdict(int)
+    self.seconds = defaultdict(float)
+    self.queries = defaultdict(int)
+    self.rows = defaultdict(int)
+    self.histogram = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+    self.gauges = []
+    self.template_class = None
+    if not self.enabled:
+      return
+    app.before_request(self.before_request)
+    app.after_request(self.after_request)
+    app.teardown_request(self.teardown_request)
+    app.add_url_rule('/metrics', 'metrics', self.metrics)
+    listen()
+    installed.append(self)
+    instrumentation = self
+    self.template_class = app.jinja_env.template_class
+
+    class TimedTemplate(self.template_class):
+      def render(self, *args, **kwargs):
+        with instrumentation.phase('template'):
+          return super(TimedTemplate, self).render(*args, **kwargs)
+    app.jinja_env.template_class = TimedTemplate
+    if app.jinja_env.cache is not None:
+      app.jinja_env.cache.clear()
+
+  def uninstall(self):
+    """
+    Remove the hooks: requests, queries and templates are no longer
+    timed, and /metrics answers 404 (Flask cannot remove its URL rule)
+    """
+    if not self.enabled:
+      return
+    self.enabled = False
+    installed.remove(self)
+    self.app.before_request_funcs[None].remove(self.before_request)
+    self.app.after_request_funcs[None].remove(self.after_request)
+    self.app.teardown_request_funcs[None].remove(self.teardown_request)
+    self.app.jinja_env.template_class = self.template_class
+    if self.app.jinja_env.cache is not None:
+      self.app.jinja_env.cache.clear()
+
+  def timings(self):
+    """
+    Returns:
+      the timings of the current request, or None outside of an
+      instrumented request
+    """
+    if not self.enabled or not has_request_context():
+      return None
+    return getattr(g, 'timings', None)
+
+  def enter(self, name):
+    """
+    Start a phase of the current request, pausing the enclosing one
+    """
+    timings = self.timings()
+    if timings is None:
+      return
+    now = time.time()
+    stack = timings['stack']
+    timings[stack[-1][0]] += now - stack[-1][1]
+    stack.append([name, now])
+
+  def leave(self):
+    """
+    End the innermost phase of the current request
+    """
+    timings = self.timings()
+    if timings is None:
+      return
+    now = time.time()
+    stack = timings['stack']
+    name, start = stack.pop()
+    timings[name] += now - start
+    stack[-1][1] = now
+
+  def phase(self, name):
+    """
+    Returns:
+      a context manager timing its block as a phase
+    """
+    return Phase(self, name)
+
+  def instrument(self, obj, method, name):
+    """
+    Time every call of a method of an object as a phase
+    """
+    if not self.enabled:
+      return
+    function = getattr(obj, method)
+
+    def timed(*args, **kwargs):
+      with self.phase(name):
+        return function(*args, **kwargs)
+    setattr(obj, method, timed)
+
+  def add_metric(self, name, help, function, type='gauge'):
+    """
+    Serve the current value of function() at /metrics, e.g. a queue length
+    or the hits of a cache (type 'counter')
+    """
+    self.gauges.append((name, help, function, type))
+
+  def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    self.enter('db')
+
+  def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    timings = self.timings()
+    if timings is None:
+      return
+    self.leave()
+    timings['queries'] += 1
+    if not statement.lstrip().upper().startswith('SELECT') and cursor.rowcount > 0:
+      timings['rows'] += cursor.rowcount
+
+  def on_load(self, instance, context):
+    timings = self.timings()
+    if timings is not None:
+      timings['rows'] += 1
+
+  def before_request(self):
+    g.timings = dict((name, 0.0) for name in PHASES)
+    g.timings.update(queries=0, rows=0, start=time.time(), stack=[['other', time.time()]])
+    g.profile = None
+    if random.random() < self.app.config['PROFILE_SAMPLE_RATE']:
+      g.profile = cProfile.Profile()
+      g.profile.enable()
+
+  def after_request(self, response):
+    timings = self.timings()
+    if timings is None:
+      return response
+    self.leave_all(timings)
+    total = time.time() - timings['start']
+    if g.profile is not None:
+      g.profile.disable()
+      if total * 1000 >= self.app.config['PROFILE_SLOW_MS']:
+        self.dump(g.profile, total)
+      g.profile = None
+    endpoint = request.endpoint or 'unknown'
+    response.headers['Server-Timing'] = ', '.join(
+      ['%s;dur=%.2f' % (name, timings[name] * 1000) for name in PHASES] +
+      ['total;dur=%.2f;desc="%d queries/%d rows"' % (total * 1000, timings['queries'], timings['rows'])])
+    with self.lock:
+      self.requests[endpoint, response.status_code] += 1
+      for name in PHASES:
+        self.seconds[endpoint, name] += timings[name]
+      self.queries[endpoint] += timings['queries']
+      self.rows[endpoint] += timings['rows']
+      buckets = self.histogram[endpoint]
+      for i, bound in enumerate(BUCKETS):
+        if total <= bound:
+          buckets[i] += 1
+      buckets[-1] += 1
+    return response
+
+  def leave_all(self, timings):
+    """
+    Stop timing the request: only the innermost open phase is running,
+    the enclosing ones were accounted for when it started
+    """
+    name, start = timings['stack'][-1]
+    timings[name] += time.time() - start
+    g.timings = None
+
+  def teardown_request(self, exception):
+    # after_request is skipped when the view raises
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+      profile.disable()
+      g.profile = None
+
+  def dump(self, profile, total):
+    """
+    Write the profile of a slow request to PROFILE_DIR
+    """
+    directory = self.app.config['PROFILE_DIR']
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    name = '%s-%d-%dms.prof' % (request.endpoint or 'unknown', time.time() * 1000, total * 1000)
+    profile.dump_stats(os.path.join(directory, name))
+
+  def metrics(self):
+    """
+    The /metrics view: request counts, phase times, query and row counts,
+    a request duration histogram and the registered metrics
+    """
+    if not self.enabled:
+      abort(404)
+    if not self.authorized():
+      abort(403)
+    lines = []
+    with self.lock:
+      lines += ['# HELP microblog_requests_total Requests handled', '# TYPE microblog_requests_total counter']
+      for (endpoint, status), count in sorted(self.requests.items()):
+        lines.append('microblog_requests_total{endpoint="%s",status="%d"} %d' % (endpoint, status, count))
+      lines += ['# HELP microblog_request_phase_seconds_total Time spent in each phase of requests',
+                '# TYPE microblog_request_phase_seconds_total counter']
+      for (endpoint, name), seconds in sorted(self.seconds.items()):
+        lines.append('microblog_request_phase_seconds_total{endpoint="%s",phase="%s"} %f' % (endpoint, name, seconds))
+      lines += ['# HELP microblog_db_queries_total SQL statements issued', '# TYPE microblog_db_queries_total counter']
+      for endpoint, count in sorted(self.queries.items()):
+        lines.append('microblog_db_queries_total{endpoint="%s"} %d' % (endpoint, count))
+      lines += ['# HELP microblog_db_rows_total Rows loaded or written', '# TYPE microblog_db_rows_total counter']
+      for endpoint, count in sorted(self.rows.items()):
+        lines.append('microblog_db_rows_total{endpoint="%s"} %d' % (endpoint, count))
+      lines += ['# HELP microblog_request_duration_seconds Request durations',
+                '# TYPE microblog_request_duration_seconds histogram']
+      for endpoint, buckets in sorted(self.histogram.items()):
+        for bound, count in zip(BUCKETS + ['+Inf'], buckets):
+          lines.append('microblog_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, bound, count))
+        lines.append('microblog_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, buckets[-1]))
+        total = sum(self.seconds[endpoint, name] for name in PHASES)
+        lines.append('microblog_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, total))
+    for name, help, function, type in self.gauges:
+      lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, type), '%s %s' % (name, function())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+  def authorized(self):
+    """
+    Returns:
+      True if the current request may read /metrics
+    """
+    if request.remote_addr in self.app.config['METRICS_ALLOWED_IPS']:
+      return True
+    token = self.app.config['METRICS_TOKEN']
+    header = request.headers.get('Authorization', '')
+    return bool(token) and header.startswith('Bearer ') and hmac.compare_digest(str(header[7:]), str(token))
+
+
+class Phase(object):
+  """
+  Context manager for Instrumentation.phase
+  """
+  def __init__(self, instrumentation, name):
+    self.instrumentation = instrumentation
+    self.name = name
+
+  def __enter__(self):
+    self.instrumentation.enter(self.name)
+
+  def __exit__(self, *exc_info):
+    self.instrumentation.leave()
@@ -0,0 +1,214 @@
+import json
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import and_, or_, event
+from sqlalchemy.orm import Session
+
+
+class JobQueue(object):
+  """
+  Jobs for slow side effects (mail, search indexing), stored in the job
+  table and run by worker.py instead of inside requests
+
+  Jobs are enqueued in the current transaction, so a job exists if and
+  only if the change that asked for it was committed. A worker takes up
+  to JOBS_BATCH_SIZE due jobs at a time and holds them for JOBS_LEASE
+  seconds; jobs of a kind whose handler takes batches are handed over
+  together (e.g. one digest mail per user). A job that fails is retried
+  JOBS_MAX_ATTEMPTS times in all, JOBS_RETRY_DELAY seconds later, doubling
+  each time; then it is kept, with its error, but never run again.
+  """
+  def __init__(self, app, db):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration, logging and contexts
+      db: the Flask-SQLAlchemy object
+    """
+    app.config.setdefault('JOBS_BATCH_SIZE', 100)
+    app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+    app.config.setdefault('JOBS_LEASE', 300)
+    app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+    app.config.setdefault('JOBS_RETRY_DELAY', 30)
+    app.config.setdefault('SERVER_URL', 'http://localhost:3000')
+    self.app = app
+    self.db = db
+    self.handlers = {}
+    self.stopping = False
+    self.table = db.Table('job',
+      db.Column('id', db.Integer, primary_key=True),
+      db.Column('kind', db.String(64)),
+      db.Column('payload', db.Text),
+      # when the job is due, None once it has failed for good
+      db.Column('run_at', db.DateTime, index=True),
+      db.Column('attempts', db.Integer, default=0),
+      db.Column('locked_by', db.String(32)),
+      db.Column('locked_until', db.DateTime),
+      db.Column('error', db.Text),
+      db.Column('created', db.DateTime))
+    event.listen(Session, 'before_commit', self.before_commit)
+    event.listen(Session, 'after_rollback', self.after_rollback)
+    app.extensions = getattr(app, 'extensions', {})
+    app.extensions['jobs'] = self
+
+  def handler(self, kind, batch=False):
+    """
+    Decorator registering the function running the jobs of a kind
+
+    Args:
+      kind: the kind of job
+      batch: if True, the function gets a list of payloads instead of one
+    """
+    def register(f):
+      self.handlers[kind] = (f, batch)
+      return f
+    return register
+
+  def enqueue(self, kind, payload, delay=0, run_at=None):
+    """
+    Add a job to the current transaction of the session; the jobs of a
+    transaction are inserted together when it commits
+
+    Args:
+      kind: the kind of job, see handler
+      payload: its arguments, anything JSON can encode
+      delay: seconds to wait before running it
+      run_at: when to run it (UTC), instead of after delay
+    """
+    session = self.db.session()
+    if not hasattr(session, '_queued_jobs'):
+      session._queued_jobs = []
+    session._queued_jobs.extend(self.rows(kind, [payload], delay, run_at))
+
+  def enqueue_many(self, kind, payloads, delay=0, connection=None):
+    """
+    Add jobs of a kind with one INSERT, on a connection (outside of the
+    session by default, e.g. from a models_committed handler)
+    """
+    if not payloads:
+      return
+    if connection is None:
+      connection = self.db.engine
+    connection.execute(self.table.insert(), self.rows(kind, payloads, delay))
+
+  def rows(self, kind, payloads, delay, run_at=None):
+    now = datetime.utcnow()
+    if run_at is None:
+      run_at = now + timedelta(seconds=delay)
+    return [{'kind': kind, 'payload': json.dumps(payload), 'run_at': run_at, 'attempts': 0, 'created': now}
+            for payload in payloads]
+
+  def before_commit(self, session):
+    """
+    Session event handler: insert the jobs enqueued in the transaction
+    """
+    rows = session.__dict__.pop('_queued_jobs', None)
+    if rows:
+      session.execute(self.table.insert(), rows)
+
+  def after_rollback(self, session):
+    """
+    Session event handler: drop the jobs enqueued in the transaction
+    """
+    session.__dict__.pop('_queued_jobs', None)
+
+  def claim(self, limit):
+    """
+    Take up to limit due jobs, oldest first, for JOBS_LEASE seconds
+
+    Returns:
+      The rows of the jobs
+    """
+    table = self.table
+    now = datetime.utcnow()
+    token = uuid4().hex
+    free = or_(table.c.locked_until == None, table.c.locked_until < now)
+    connection = self.db.engine.connect()
+    try:
+      with connection.begin():
+        ids = [row[0] for row in connection.execute(
+          self.db.select([table.c.id], and_(table.c.run_at <= now, free)).order_by(table.c.run_at, table.c.id).limit(limit))]
+        if not ids:
+          return []
+        # another worker may have taken some of them meanwhile
+        connection.execute(table.update().where(and_(table.c.id.in_(ids), free)).values(
+          locked_by=token, locked_until=now + timedelta(seconds=self.app.config['JOBS_LEASE'])))
+      return connection.execute(table.select().where(table.c.locked_by == token).order_by(table.c.run_at, table.c.id)).fetchall()
+    finally:
+      connection.close()
+
+  def work(self):
+    """
+    Run one batch of due jobs
+
+    Returns:
+      The number of jobs run, successfully or not
+    """
+    jobs = self.claim(self.app.config['JOBS_BATCH_SIZE'])
+    kinds = OrderedDict()
+    for job in jobs:
+      kinds.setdefault(job.kind, []).append(job)
+    for kind, batch in kinds.iteritems():
+      f, batched = self.handlers.get(kind, (None, False))
+      if f is None:
+        self.failed(batch, 'no handler for %s jobs' % kind)
+      elif batched:
+        self.run(f, batch, [json.loads(job.payload) for job in batch])
+      else:
+        for job in batch:
+          self.run(f, [job], json.loads(job.payload))
+    return len(jobs)
+
+  def run(self, f, jobs, argument):
+    """
+    Call a handler in a request context for SERVER_URL (so that it can
+    render templates and build external URLs), and record the outcome of
+    its jobs
+    """
+    try:
+      with self.app.test_request_context(base_url=self.app.config['SERVER_URL']):
+        f(argument)
+    except Exception:
+      self.app.logger.exception('jobs: %d %s jobs failed', len(jobs), jobs[0].kind)
+      self.failed(jobs, traceback.format_exc())
+    else:
+      self.db.engine.execute(self.table.delete().where(self.table.c.id.in_([job.id for job in jobs])))
+
+  def failed(self, jobs, error):
+    """
+    Schedule failed jobs for a retry, or give up on them
+    """
+    table = self.table
+    now = datetime.utcnow()
+    for job in jobs:
+      attempts = (job.attempts or 0) + 1
+      run_at = None
+      if attempts < self.app.config['JOBS_MAX_ATTEMPTS']:
+        run_at = now + timedelta(seconds=self.app.config['JOBS_RETRY_DELAY'] * 2 ** (attempts - 1))
+      self.db.engine.execute(table.update().where(table.c.id == job.id).values(
+        attempts=attempts, run_at=run_at, locked_by=None, locked_until=None, error=error))
+
+  def run_forever(self):
+    """
+    The worker loop: run batches of jobs, polling every JOBS_POLL_INTERVAL
+    seconds while there are none, until stop() is called
+    """
+    self.stopping = False
+    while not self.stopping:
+      try:
+        if self.work():
+          continue
+      except Exception:
+        # e.g. the database is unreachable
+        self.app.logger.exception('jobs: cannot claim jobs')
+      time.sleep(self.app.config['JOBS_POLL_INTERVAL'])
+
+  def stop(self, *args):
+    """
+    Make run_forever return after the current batch (a signal handler)
+    """
+    self.stopping = True
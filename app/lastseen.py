@@ -0,0 +1,81 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock
+from sqlalchemy import bindparam
+
+
+class LastSeenTracker(object):
+  """
+  Records when users were last seen in memory and writes them to the
+  database in bulk, instead of committing to the user row on every request
+
+  A visit is only recorded when the known last seen time is older than
+  LAST_SEEN_THRESHOLD seconds, and pending visits are flushed at most every
+  LAST_SEEN_FLUSH_INTERVAL seconds, so the database lags by at most the sum
+  of both. Pending visits are kept per process.
+  """
+  def __init__(self, app, db, table='user'):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration
+      db: the Flask-SQLAlchemy object, for its engine
+      table: name of the table with the id and last_seen columns
+    """
+    app.config.setdefault('LAST_SEEN_THRESHOLD', 60)
+    app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 60)
+    self.app = app
+    self.db = db
+    self.table = table
+    self.pending = {}
+    self.last_flush = datetime.utcnow()
+    self.lock = Lock()
+    atexit.register(self.flush)
+
+  def touch(self, user, now=None):
+    """
+    Record a visit by a user, flushing pending visits if it is time to
+
+    Args:
+      user: the visiting user
+      now: time of the visit (defaults to the current time)
+    """
+    if now is None:
+      now = datetime.utcnow()
+    seen = self.last_seen(user)
+    if seen is not None and now - seen < timedelta(seconds=self.app.config['LAST_SEEN_THRESHOLD']):
+      return
+    with self.lock:
+      self.pending[user.id] = now
+      due = now - self.last_flush >= timedelta(seconds=self.app.config['LAST_SEEN_FLUSH_INTERVAL'])
+    if due:
+      self.flush()
+
+  def last_seen(self, user):
+    """
+    Get the last seen time of a user, including visits not yet flushed
+
+    Args:
+      user: the user to check
+
+    Returns:
+      The last seen time, or None if never seen
+    """
+    pending = self.pending.get(user.id)
+    if pending is None or (user.last_seen is not None and user.last_seen > pending):
+      return user.last_seen
+    return pending
+
+  def flush(self):
+    """
+    Write all pending visits to the database in one executemany UPDATE
+    """
+    with self.lock:
+      pending, self.pending = self.pending, {}
+      self.last_flush = datetime.utcnow()
+    if not pending:
+      return
+    table = self.db.metadata.tables[self.table]
+    update = table.update().where(table.c.id == bindparam('uid')).values(last_seen=bindparam('seen'))
+    self.db.engine.execute(update, [{'uid': uid, 'seen': seen} for uid, seen in pending.iteritems()])
@@ -0,0 +1,68 @@
+from functools import wraps
+from threading import Lock
+from flask import request
+
+
+class LazyOpenID(object):
+  """
+  Flask-OpenID, imported and set up on first use
+
+  python-openid takes a while to import, and only sign ins need it: the
+  login view is decorated as usual, but the OpenID object and its store
+  are only created when an OpenID request is made or completed.
+  """
+  def __init__(self, app, fs_store_path=None):
+    """
+    Constructor
+
+    Args:
+      app: the flask app
+      fs_store_path: the directory of the OpenID file store
+    """
+    app.config.setdefault('OPENID_FS_STORE_PATH', None)
+    self.app = app
+    self.fs_store_path = fs_store_path
+    self.after_login_func = None
+    self.oid = None
+    self.lock = Lock()
+
+  def load(self):
+    """
+    Returns:
+      the Flask-OpenID object, created on the first call
+    """
+    if self.oid is None:
+      with self.lock:
+        if self.oid is None:
+          from flask.ext.openid import OpenID
+          oid = OpenID(self.app, fs_store_path=self.fs_store_path)
+          oid.after_login_func = self.after_login_func
+          self.oid = oid
+    return self.oid
+
+  def after_login(self, f):
+    """
+    Decorator registering the function called after a successful sign in
+    """
+    self.after_login_func = f
+    if self.oid is not None:
+      self.oid.after_login_func = f
+    return f
+
+  def loginhandler(self, f):
+    """
+    Decorator for the login view: OpenID responses are completed by
+    Flask-OpenID, other requests go straight to the view
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+      if request.args.get('openid_complete') != u'yes':
+        return f(*args, **kwargs)
+      return self.load().loginhandler(f)(*args, **kwargs)
+    return decorated
+
+  def try_login(self, *args, **kwargs):
+    """
+    Start a sign in, see Flask-OpenID's try_login
+    """
+    return self.load().try_login(*args, **kwargs)
@@ -1,16 +1,40 @@
 from app import db, app
 from hashlib import md5
-import flask.ext.whooshalchemy as whooshalchemy
-from config import WHOOSH_ENABLED
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates
+from dbutil import InsertFromSelect
+from pagination import keyset_paginate, offset_cursor
+from cache import LRUCache
+from search import create_backend
+from events import FeedEvents
+from identity import Identity, IdentityCache
+from suggestions import Suggestions
 
 ROLE_USER = 0
 ROLE_ADMIN = 1
 
+# rendered avatar URLs, by (email hash, size)
+avatar_urls = LRUCache(app.config.get('AVATAR_CACHE_SIZE', 10000))
+
 # make a association table for many-many relation
 # between followers and followed
+# the composite primary key makes duplicate follows impossible and turns
+# is_following into a single index probe
 followers = db.Table('followers',
-            db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-            db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+            db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+            db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True))
+db.Index('ix_followers_followed_id', followers.c.followed_id)
+
+# materialized home feed: one row per (reader, post), filled in when a post
+# is written (fan-out-on-write) instead of joining followers on every read
+timeline = db.Table('timeline',
+            db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+            db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+            db.Column('author_id', db.Integer, db.ForeignKey('user.id')),
+            db.Column('timestamp', db.DateTime))
+db.Index('ix_timeline_user_timestamp', timeline.c.user_id, timeline.c.timestamp, timeline.c.post_id)
+db.Index('ix_timeline_user_author', timeline.c.user_id, timeline.c.author_id)
 
 
 class User(db.Model):
@@ -20,10 +44,26 @@ class User(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   nickname = db.Column(db.String(64), index=True, unique=True)
   email = db.Column(db.String(120), index=True, unique=True)
+  email_hash = db.Column(db.String(32))  # md5 of the email, for Gravatar
   role = db.Column(db.SmallInteger, default=ROLE_USER)
   posts = db.relationship('Post', backref='author', lazy='dynamic')
   about_me = db.Column(db.String(140))
   last_seen = db.Column(db.DateTime)
+  # bumped when anything shown next to the user's posts changes (nickname,
+  # avatar), which retires their cached post fragments
+  version = db.Column(db.Integer, default=0)
+  # denormalized counters, kept in sync by follow/unfollow and new posts
+  # (db_recount.py recomputes them); the server default fills in existing
+  # rows when a migration adds the columns
+  followers_count = db.Column(db.Integer, default=0, server_default='0')
+  following_count = db.Column(db.Integer, default=0, server_default='0')
+  posts_count = db.Column(db.Integer, default=0, server_default='0')
+  # bumped on every follow and unfollow by the user, so that pages that
+  # depend on whom they follow can be revalidated cheaply
+  graph_version = db.Column(db.Integer, default=0)
+  # set for accounts with too many followers to fan out; their posts are
+  # merged into readers' timelines at read time instead
+  pull_timeline = db.Column(db.Boolean, default=False)
   followed = db.relationship('User',
               secondary=followers,
               primaryjoin=(followers.c.follower_id==id),
@@ -40,9 +80,37 @@ class User(db.Model):
     """
     return '<User %r>' % (self.nickname)
 
+  @validates('email')
+  def update_email_hash(self, key, email):
+    """
+    Keep email_hash in step with the email, so avatars never hash on render
+    """
+    email_hash = User.hash_email(email)
+    if self.email_hash is not None and email_hash != self.email_hash:
+      # the avatar is part of every cached post fragment of this user
+      self.version = (self.version or 0) + 1
+    self.email_hash = email_hash
+    return email
+
+  @staticmethod
+  def hash_email(email):
+    """
+    Hash an email address the way Gravatar expects
+
+    Args:
+      email: the email address
+
+    Returns:
+      The hex md5 digest of the email, or None if there is no email
+    """
+    if email is None:
+      return None
+    return md5(email).hexdigest()
+
   def avatar(self, size):
     """
-    Returns a link to the Avatar of the user (uses Gravatar)
+    Returns a link to the Avatar of the user (uses Gravatar, or the mirror
+    at AVATAR_BASE_URL)
 
     Args:
       size: the size of the gravatar needed
@@ -50,7 +118,20 @@ class User(db.Model):
     Returns:
       link: a link to the user's Gravatar avatar of required size
     """
-    return 'http://www.gravatar.com/avatar/' + md5(self.email).hexdigest() + '?d=mm&s=' + str(size)
+    return User.avatar_url(self.email_hash or User.hash_email(self.email), size)
+
+  @staticmethod
+  def avatar_url(email_hash, size):
+    """
+    Returns:
+      the avatar link for an email hash, see avatar
+    """
+    key = (email_hash, size)
+    link = avatar_urls.get(key)
+    if link is None:
+      link = app.config['AVATAR_BASE_URL'] + email_hash + '?d=mm&s=' + str(size)
+      avatar_urls.set(key, link)
+    return link
 
   # methods to deal with follow/unfollow
   def follow(self, user):
@@ -65,6 +146,8 @@ class User(db.Model):
     """
     if not self.is_following(user):
       self.followed.append(user)
+      self.count_follow(user, 1)
+      Timeline.add_author(self, user)
       return self  # a good way to check if follow operation is successful
 
   def unfollow(self, user):
@@ -79,8 +162,97 @@ class User(db.Model):
     """
     if self.is_following(user):
       self.followed.remove(user)
+      self.count_follow(user, -1)
+      Timeline.remove_author(self, user)
       return self
 
+  def count_follow(self, user, delta):
+    """
+    Adjust the following/followers counters for a follow (delta 1) or an
+    unfollow (delta -1), in the current transaction
+
+    Args:
+      user: The user being followed or unfollowed
+      delta: the change to apply to both counters
+    """
+    self.count_follows([user.id], delta)
+    db.session.expire(user, ['followers_count'])
+
+  def count_follows(self, user_ids, delta):
+    """
+    Adjust the counters for follows (delta 1) or unfollows (delta -1) of
+    many users, with two UPDATEs, in the current transaction
+
+    Args:
+      user_ids: ids of the users being followed or unfollowed
+      delta: the change to the followers count of each of them
+    """
+    users = User.__table__
+    db.session.execute(users.update().where(users.c.id == self.id).values(
+      following_count=db.func.coalesce(users.c.following_count, 0) + delta * len(user_ids),
+      graph_version=db.func.coalesce(users.c.graph_version, 0) + 1))
+    # counters of users created before they existed are NULL until db_recount.py runs
+    db.session.execute(users.update().where(users.c.id.in_(user_ids)).values(
+      followers_count=db.func.coalesce(users.c.followers_count, 0) + delta))
+    if isinstance(self, User):
+      db.session.expire(self, ['following_count', 'graph_version'])
+    # changed without the ORM, so models_committed does not see it
+    identity_cache.invalidate(self.id)
+    suggestions.changed(self.id)
+
+  def follow_many(self, user_ids):
+    """
+    Follow many users at once, in the current transaction, with a fixed
+    number of statements however many there are
+
+    Args:
+      user_ids: ids of the users to follow; the user themselves and users
+        followed already are skipped
+
+    Returns:
+      The ids of the users newly followed, in order
+    """
+    users = User.__table__
+    if not user_ids:
+      return []
+    edge = db.exists().where(db.and_(followers.c.follower_id == self.id, followers.c.followed_id == users.c.id))
+    new = db.and_(users.c.id.in_(user_ids), users.c.id != self.id, ~edge)
+    followed = [row[0] for row in db.session.execute(db.select([users.c.id], new).order_by(users.c.id))]
+    if not followed:
+      return []
+    # insert-if-absent, should the same follows be made concurrently
+    db.session.execute(InsertFromSelect(followers, ['follower_id', 'followed_id'], db.select(
+      [db.literal(self.id, db.Integer), users.c.id], db.and_(users.c.id.in_(followed), ~edge))))
+    self.count_follows(followed, 1)
+    Timeline.add_authors(self, followed)
+    return followed
+
+  def unfollow_many(self, user_ids):
+    """
+    Unfollow many users at once, in the current transaction, with a fixed
+    number of statements however many there are
+
+    Args:
+      user_ids: ids of the users to unfollow; the user themselves and
+        users not followed are skipped
+
+    Returns:
+      The ids of the users unfollowed, in order
+    """
+    if not user_ids:
+      return []
+    mine = db.and_(followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids),
+                   followers.c.followed_id != self.id)
+    unfollowed = [row[0] for row in db.session.execute(
+      db.select([followers.c.followed_id], mine).order_by(followers.c.followed_id))]
+    if not unfollowed:
+      return []
+    db.session.execute(followers.delete().where(db.and_(followers.c.follower_id == self.id,
+                                                        followers.c.followed_id.in_(unfollowed))))
+    self.count_follows(unfollowed, -1)
+    Timeline.remove_authors(self, unfollowed)
+    return unfollowed
+
   def is_following(self, user):
     """
     Checks if a user is being followed or not
@@ -91,7 +263,27 @@ class User(db.Model):
     Returns:
       True, if the user is followed; False otherwise
     """
-    return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+    return db.session.query(followers.c.follower_id).filter(followers.c.follower_id == self.id).filter(followers.c.followed_id == user.id).first() is not None
+
+  def followed_ids(self):
+    """
+    Returns:
+      the ids of the users this user follows, themselves included
+    """
+    return [row[0] for row in db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)]
+
+  def suggestions(self, limit):
+    """
+    Get the users to suggest following, from the precomputed suggestions
+    (see Suggestions), leaving out those followed since
+
+    Returns:
+      A list of up to limit users, best first
+    """
+    table = suggestions.table
+    followed = db.select([followers.c.followed_id], followers.c.follower_id == self.id)
+    return User.query.join(table, (table.c.suggested_id == User.id)).filter(table.c.user_id == self.id).filter(
+      ~User.id.in_(followed)).order_by(table.c.score.desc(), table.c.suggested_id).limit(limit).all()
 
   def followed_posts(self):
     """
@@ -100,7 +292,177 @@ class User(db.Model):
     Returns:
       A list of all followed posts, sorted by time in descending order (recent 1st)
     """
-    return Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+    return Post.with_authors(Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id).order_by(Post.timestamp.desc()))
+
+  def timeline_posts(self):
+    """
+    Get the posts of the home feed from the materialized timeline
+
+    Posts of authors in pull mode (see Timeline) are merged in at read time,
+    so the result is the same as followed_posts() without the followers join
+
+    Returns:
+      A query of the feed posts, sorted by time in descending order (recent 1st)
+    """
+    query, key = self._timeline()
+    return Post.with_authors(query).order_by(key[0].desc(), key[1].desc())
+
+  def timeline_page(self, per_page, before=None, after=None):
+    """
+    Get one page of the home feed, see keyset_paginate
+
+    Returns:
+      A KeysetPage of posts
+    """
+    query, key = self._timeline()
+    return keyset_paginate(Post.with_authors(query), key, per_page, before, after)
+
+  def timeline_rows(self, columns, per_page, before=None, after=None):
+    """
+    Get one page of the home feed as plain rows of columns of the posts
+    and their authors, without building any objects
+
+    Args:
+      columns: labeled columns of Post and User, including 'id' and
+        'timestamp' for the cursors
+
+    Returns:
+      A KeysetPage of rows
+    """
+    query, key = self._timeline()
+    query = query.join(User, (User.id == Post.user_id)).with_entities(*columns)
+    return keyset_paginate(query, key, per_page, before, after)
+
+  def timeline_cursor(self, page, per_page):
+    """
+    Translate a page number of the home feed into a cursor for timeline_page
+
+    Returns:
+      The 'before' cursor of the page, or None for the first/missing pages
+    """
+    if page <= 1:
+      return None
+    query, key = self._timeline()
+    return offset_cursor(query, key, (page - 1) * per_page - 1)
+
+  def _timeline(self):
+    """
+    Build the unordered home feed query, without the authors
+
+    Returns:
+      (query, key): the query and the (timestamp, id) columns to order it on
+    """
+    pulled = [row[0] for row in db.session.query(User.id).join(followers, (followers.c.followed_id == User.id)).filter(followers.c.follower_id == self.id).filter(User.pull_timeline == True)]
+    if not pulled:
+      query = Post.query.join(timeline, (timeline.c.post_id == Post.id)).filter(timeline.c.user_id == self.id)
+      return query, (timeline.c.timestamp, timeline.c.post_id)
+    pushed = db.select([timeline.c.post_id], timeline.c.user_id == self.id)
+    query = Post.query.filter(db.or_(Post.id.in_(pushed), Post.user_id.in_(pulled)))
+    return query, (Post.timestamp, Post.id)
+
+  def own_versions(self):
+    """
+    Returns:
+      scalar subqueries of the user's version and graph_version, to read
+      along with a page's validator: the identity cache of other processes
+      may lag behind a change
+    """
+    users = User.__table__
+    return [db.select([column], users.c.id == self.id).correlate(None).as_scalar()
+            for column in (users.c.version, users.c.graph_version)]
+
+  def suggestions_versions(self):
+    """
+    Returns:
+      scalar subqueries whose values change whenever the user's stored
+      suggestions are recomputed or a suggested user's nickname or avatar
+      changes, to read along with a page's validator
+    """
+    table = suggestions.table
+    suggested = User.__table__.alias()
+    mine = table.c.user_id == self.id
+    return [db.select([db.func.sum(table.c.suggested_id)], mine).correlate(None).as_scalar(),
+            db.select([db.func.sum(db.cast(table.c.suggested_id, db.BigInteger) * table.c.score)],
+                      mine).correlate(None).as_scalar(),
+            db.select([db.func.sum(suggested.c.version)],
+                      db.and_(mine, suggested.c.id == table.c.suggested_id)).correlate(None).as_scalar()]
+
+  def page_versions(self):
+    """
+    Returns:
+      scalar subqueries of what every page shows the signed in user besides
+      its content: their own row and their suggestions
+    """
+    return self.own_versions() + self.suggestions_versions()
+
+  def timeline_version(self, versions=()):
+    """
+    Read what the home feed depends on, in one aggregate over the users
+    they follow: new posts bump the authors' posts_count and nickname
+    changes their version (posts are never edited or deleted); whom they
+    follow is the user's own graph_version
+
+    Args:
+      versions: more scalar subqueries to read in the same query, e.g.
+        suggestions_versions() for a page that shows them
+
+    Returns:
+      (token, last_modified): a value that changes whenever the feed may
+      have changed, and the time of the newest pushed post
+    """
+    users = User.__table__
+    newest = db.select([db.func.max(timeline.c.timestamp)], timeline.c.user_id == self.id).as_scalar()
+    row = db.session.execute(db.select(
+      [db.func.sum(users.c.version), db.func.sum(users.c.posts_count), newest] + self.own_versions() + list(versions),
+      db.and_(followers.c.follower_id == self.id, followers.c.followed_id == users.c.id))).first()
+    return (row[0], row[1]) + tuple(row[3:]), row[2]
+
+  def profile_version(self, versions=()):
+    """
+    Read what the profile page depends on besides the user's row
+
+    Args:
+      versions: more scalar subqueries to read in the same query, e.g. the
+        viewer's page_versions()
+
+    Returns:
+      (token, last_modified): a value that changes whenever the user's
+      profile or posts change, and the time of their newest post
+    """
+    row = db.session.execute(db.select([db.func.max(Post.timestamp)] + list(versions),
+                                       Post.user_id == self.id)).first()
+    return (self.nickname, self.version, self.about_me, self.email_hash, self.followers_count,
+            self.following_count, self.posts_count) + tuple(row[1:]), row[0]
+
+  def posts_page(self, per_page, before=None, after=None):
+    """
+    Get one page of this user's own posts, see keyset_paginate
+
+    Returns:
+      A KeysetPage of posts
+    """
+    return keyset_paginate(self.posts, (Post.timestamp, Post.id), per_page, before, after)
+
+  def posts_rows(self, columns, per_page, before=None, after=None):
+    """
+    Get one page of this user's own posts as plain rows, see timeline_rows
+
+    Returns:
+      A KeysetPage of rows
+    """
+    query = Post.query.filter(Post.user_id == self.id).join(User, (User.id == Post.user_id)).with_entities(*columns)
+    return keyset_paginate(query, (Post.timestamp, Post.id), per_page, before, after)
+
+  def posts_cursor(self, page, per_page):
+    """
+    Translate a page number of this user's posts into a cursor for posts_page
+
+    Returns:
+      The 'before' cursor of the page, or None for the first/missing pages
+    """
+    if page <= 1:
+      return None
+    return offset_cursor(self.posts, (Post.timestamp, Post.id), (page - 1) * per_page - 1)
 
   # methods needed by flask.ext.login
   def is_authenticated(self):
@@ -139,27 +501,142 @@ class User(db.Model):
     """
     return unicode(self.id)
 
+  @staticmethod
+  def find_ids(keys):
+    """
+    Resolve users by id or nickname, in one query
+
+    Args:
+      keys: ids (integers) and nicknames (strings), mixed
+
+    Returns:
+      A dict of the nicknames of the users found, by id
+    """
+    ids = [key for key in keys if isinstance(key, (int, long))]
+    nicknames = [key for key in keys if isinstance(key, basestring)]
+    conditions = []
+    if ids:
+      conditions.append(User.id.in_(ids))
+    if nicknames:
+      conditions.append(User.nickname.in_(nicknames))
+    if not conditions:
+      return {}
+    return dict(db.session.query(User.id, User.nickname).filter(db.or_(*conditions)))
+
   @staticmethod
   def make_unique_nickname(nickname):
     """
     Check for users with same nickname and append numbers to make unique
 
+    The nickname and all its numbered variants are read with one range
+    scan of the nickname index (digits sort before ':'), however many
+    suffixes are taken.
+
     Args:
       nickname: nickname to be verified
 
     Returns:
       nickname: a unique nickname
     """
-    if User.query.filter_by(nickname=nickname).first() == None:
+    users = User.__table__
+    taken = db.session.execute(db.select([users.c.nickname]).where(
+      db.and_(users.c.nickname >= nickname, users.c.nickname < nickname + u':'))).fetchall()
+    # under a case insensitive collation the scan also returns 'John' for
+    # 'john', and the unique index holds them equal: compare the same way
+    prefix = nickname.lower()
+    suffixes = set(row[0][len(nickname):] for row in taken if row[0].lower().startswith(prefix))
+    if '' not in suffixes:
       # already unique
       return nickname
     version = 2
-    while True:
-      new_nickname = nickname + str(version)
-      if User.query.filter_by(nickname=new_nickname).first() == None:
-        break
+    while str(version) in suffixes:
       version += 1
-    return new_nickname
+    return nickname + str(version)
+
+  @staticmethod
+  def create_unique(nickname, email, role=ROLE_USER, attempts=5):
+    """
+    Create and commit a user, with nickname made unique
+
+    Another signup may take the same nickname between the check and the
+    commit; the unique constraint catches that, and a new nickname is
+    picked. If the email was taken instead (the same user signing up
+    twice at once), that user is returned.
+
+    Args:
+      nickname: the wanted nickname
+      email: the user's email
+      role: ROLE_USER or ROLE_ADMIN
+      attempts: how many nicknames to try before giving up
+
+    Returns:
+      The user, and whether it was created
+    """
+    for attempt in range(attempts):
+      user = User(nickname=User.make_unique_nickname(nickname), email=email, role=role)
+      db.session.add(user)
+      try:
+        db.session.commit()
+        return user, True
+      except IntegrityError as error:
+        db.session.rollback()
+        existing = User.query.filter_by(email=email).first()
+        if existing is not None:
+          return existing, False
+        if attempt == attempts - 1:
+          raise error
+
+  @staticmethod
+  def recount(user_ids=None):
+    """
+    Recompute the denormalized counters from the followers and post tables
+
+    Args:
+      user_ids: ids of the users to recount (all if None)
+    """
+    users = User.__table__
+    posts = Post.__table__
+    update = users.update().values(
+      followers_count=db.select([db.func.count()], followers.c.followed_id == users.c.id).as_scalar(),
+      following_count=db.select([db.func.count()], followers.c.follower_id == users.c.id).as_scalar(),
+      posts_count=db.select([db.func.count()], posts.c.user_id == users.c.id).as_scalar())
+    if user_ids is not None:
+      update = update.where(users.c.id.in_(user_ids))
+    db.session.execute(update)
+    db.session.commit()
+
+
+class CachedUser(Identity):
+  """
+  The signed in user, as loaded by views.load_user from the identity cache:
+  what authentication, the layout and the home feed need, without a query
+  """
+  model = User
+  fields = ('id', 'nickname', 'email_hash', 'role', 'version', 'graph_version', 'last_seen')
+
+  # read only these fields
+  __repr__ = User.__repr__.im_func
+  avatar = User.avatar.im_func
+  is_following = User.is_following.im_func
+  followed_ids = User.followed_ids.im_func
+  suggestions = User.suggestions.im_func
+  count_follows = User.count_follows.im_func
+  follow_many = User.follow_many.im_func
+  unfollow_many = User.unfollow_many.im_func
+  followed_posts = User.followed_posts.im_func
+  timeline_posts = User.timeline_posts.im_func
+  timeline_page = User.timeline_page.im_func
+  timeline_rows = User.timeline_rows.im_func
+  timeline_cursor = User.timeline_cursor.im_func
+  _timeline = User._timeline.im_func
+  timeline_version = User.timeline_version.im_func
+  own_versions = User.own_versions.im_func
+  suggestions_versions = User.suggestions_versions.im_func
+  page_versions = User.page_versions.im_func
+  is_authenticated = User.is_authenticated.im_func
+  is_active = User.is_active.im_func
+  is_anonymous = User.is_anonymous.im_func
+  get_id = User.get_id.im_func
 
 
 class Post(db.Model):
@@ -182,6 +659,154 @@ class Post(db.Model):
     """
     return '<Post %r>' % (self.body)
 
-if WHOOSH_ENABLED:
-    import flask.ext.whooshalchemy as whooshalchemy
-    whooshalchemy.whoosh_index(app, Post)
+  @staticmethod
+  def with_authors(query):
+    """
+    Load the authors of the posts of a query in the same SELECT, so that
+    rendering post.html does not issue one user query per post
+
+    Args:
+      query: a query of posts
+
+    Returns:
+      The query, with the authors eagerly loaded
+    """
+    return query.options(db.joinedload('author'))
+
+# composite indexes for keyset pagination on (timestamp, id)
+db.Index('ix_post_timestamp_id', Post.__table__.c.timestamp, Post.__table__.c.id)
+db.Index('ix_post_user_timestamp_id', Post.__table__.c.user_id, Post.__table__.c.timestamp, Post.__table__.c.id)
+
+
+class Timeline(object):
+  """
+  Fan-out-on-write maintenance of the timeline table
+
+  Every post is copied into the timeline of each follower of its author when
+  it is written. Authors with more than TIMELINE_FANOUT_LIMIT followers are
+  switched to pull mode: their posts are not copied, and readers merge them
+  in at read time (hybrid mode).
+  """
+  columns = ['user_id', 'post_id', 'author_id', 'timestamp']
+
+  @staticmethod
+  def push_post(connection, post):
+    """
+    Copy a new post into the timelines of its author's followers
+
+    Args:
+      connection: the connection the post was inserted with
+      post: the new post
+    """
+    users = User.__table__
+    pull, count = connection.execute(db.select([users.c.pull_timeline, users.c.followers_count], users.c.id == post.user_id)).first()
+    if pull:
+      return
+    limit = app.config.get('TIMELINE_FANOUT_LIMIT')
+    if limit is not None and count > limit:
+      connection.execute(users.update().where(users.c.id == post.user_id).values(pull_timeline=True))
+      return
+    rows = db.select([followers.c.follower_id,
+                      db.literal(post.id, db.Integer),
+                      db.literal(post.user_id, db.Integer),
+                      db.literal(post.timestamp, db.DateTime)],
+                     followers.c.followed_id == post.user_id)
+    connection.execute(InsertFromSelect(timeline, Timeline.columns, rows))
+
+  @staticmethod
+  def add_author(user, author):
+    """
+    Copy the existing posts of a newly followed author into a user's timeline
+
+    Args:
+      user: the user who followed
+      author: the user being followed
+    """
+    if author.pull_timeline:
+      return
+    posts = Post.__table__
+    rows = db.select([db.literal(user.id, db.Integer), posts.c.id, posts.c.user_id, posts.c.timestamp],
+                     posts.c.user_id == author.id)
+    db.session.execute(InsertFromSelect(timeline, Timeline.columns, rows))
+
+  @staticmethod
+  def add_authors(user, author_ids):
+    """
+    Copy the existing posts of newly followed authors into a user's
+    timeline, with one INSERT (authors in pull mode are skipped)
+
+    Args:
+      user: the user who followed
+      author_ids: ids of the users being followed
+    """
+    users = User.__table__
+    posts = Post.__table__
+    rows = db.select([db.literal(user.id, db.Integer), posts.c.id, posts.c.user_id, posts.c.timestamp],
+                     db.and_(posts.c.user_id.in_(author_ids), users.c.id == posts.c.user_id,
+                             db.func.coalesce(users.c.pull_timeline, False) == False))
+    db.session.execute(InsertFromSelect(timeline, Timeline.columns, rows))
+
+  @staticmethod
+  def remove_authors(user, author_ids):
+    """
+    Drop the posts of unfollowed authors from a user's timeline
+
+    Args:
+      user: the user who unfollowed
+      author_ids: ids of the users being unfollowed
+    """
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id).where(timeline.c.author_id.in_(author_ids)))
+
+  @staticmethod
+  def remove_author(user, author):
+    """
+    Drop the posts of an unfollowed author from a user's timeline
+
+    Args:
+      user: the user who unfollowed
+      author: the user being unfollowed
+    """
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id).where(timeline.c.author_id == author.id))
+
+  @staticmethod
+  def rebuild(user_ids=None):
+    """
+    Recompute pull mode for every author and rebuild timelines from scratch
+
+    Args:
+      user_ids: ids of the users whose timeline is rebuilt (all if None)
+    """
+    users = User.__table__
+    posts = Post.__table__
+    limit = app.config.get('TIMELINE_FANOUT_LIMIT')
+    db.session.execute(users.update().values(pull_timeline=False))
+    if limit is not None:
+      crowded = db.select([followers.c.followed_id]).group_by(followers.c.followed_id).having(db.func.count() > limit)
+      db.session.execute(users.update().where(users.c.id.in_(crowded)).values(pull_timeline=True))
+    delete = timeline.delete()
+    rows = db.select([followers.c.follower_id, posts.c.id, posts.c.user_id, posts.c.timestamp],
+                     db.and_(followers.c.followed_id == posts.c.user_id,
+                             followers.c.followed_id == users.c.id,
+                             users.c.pull_timeline == False))
+    if user_ids is not None:
+      delete = delete.where(timeline.c.user_id.in_(user_ids))
+      rows = rows.where(followers.c.follower_id.in_(user_ids))
+    db.session.execute(delete)
+    db.session.execute(InsertFromSelect(timeline, Timeline.columns, rows))
+    db.session.commit()
+
+
+@event.listens_for(Post, 'after_insert')
+def fan_out_post(mapper, connection, post):
+  """
+  Fan a new post out to the timelines of its author's followers
+  """
+  users = User.__table__
+  connection.execute(users.update().where(users.c.id == post.user_id).values(
+    posts_count=db.func.coalesce(users.c.posts_count, 0) + 1))
+  Timeline.push_post(connection, post)
+
+search_engine = create_backend(app, db, Post)
+feed_events = FeedEvents(app, Post)
+identity_cache = IdentityCache(app, db, CachedUser)
+suggestions = Suggestions(app, db, followers.c.follower_id, followers.c.followed_id)
@@ -1,17 +1,230 @@
+import math
+import re
+import time
+from datetime import datetime
+from flask import current_app
 from jinja2 import Markup
+from cache import LRUCache
+
+# moment.js 2.6 tokens, longest first, and literal text in [brackets]
+TOKENS = re.compile(r'\[[^\]]*\]|YYYY|YY|MMMM|MMM|MM|M|Do|DD|D|dddd|ddd|HH|H|hh|h|mm|m|ss|s|A|a|LT|L')
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# the English locale of moment.js 2.6
+RELATIVE = {'s': 'a few seconds', 'm': 'a minute', 'mm': '%d minutes',
+            'h': 'an hour', 'hh': '%d hours', 'd': 'a day', 'dd': '%d days',
+            'M': 'a month', 'MM': '%d months', 'y': 'a year', 'yy': '%d years'}
+CALENDAR = {'sameDay': '[Today at] LT', 'nextDay': '[Tomorrow at] LT',
+            'nextWeek': 'dddd [at] LT', 'lastDay': '[Yesterday at] LT',
+            'lastWeek': '[Last] dddd [at] LT', 'sameElse': 'L'}
+LONG_FORMATS = {'LT': 'h:mm A', 'L': 'MM/DD/YYYY'}
+
+
+def ordinal(n):
+  """
+  Returns:
+    n with its English ordinal suffix, like moment's Do token
+  """
+  if 10 <= n % 100 <= 20:
+    return '%dth' % n
+  return '%d%s' % (n, {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th'))
+
+FIELDS = {
+  'YYYY': lambda t: '%04d' % t.year,
+  'YY': lambda t: '%02d' % (t.year % 100),
+  'MMMM': lambda t: MONTHS[t.month - 1],
+  'MMM': lambda t: MONTHS[t.month - 1][:3],
+  'MM': lambda t: '%02d' % t.month,
+  'M': lambda t: str(t.month),
+  'Do': lambda t: ordinal(t.day),
+  'DD': lambda t: '%02d' % t.day,
+  'D': lambda t: str(t.day),
+  'dddd': lambda t: WEEKDAYS[t.weekday()],
+  'ddd': lambda t: WEEKDAYS[t.weekday()][:3],
+  'HH': lambda t: '%02d' % t.hour,
+  'H': lambda t: str(t.hour),
+  'hh': lambda t: '%02d' % (t.hour % 12 or 12),
+  'h': lambda t: str(t.hour % 12 or 12),
+  'mm': lambda t: '%02d' % t.minute,
+  'm': lambda t: str(t.minute),
+  'ss': lambda t: '%02d' % t.second,
+  's': lambda t: str(t.second),
+  'A': lambda t: 'AM' if t.hour < 12 else 'PM',
+  'a': lambda t: 'am' if t.hour < 12 else 'pm',
+}
+
+# compiled formats, by moment.js format string
+formats = LRUCache(256)
+
+
+def compile_format(fmt):
+  """
+  Compile a moment.js format string into a list of literal strings and
+  field functions, caching the result
+
+  Args:
+    fmt: the moment.js format, e.g. "MMMM Do YYYY, h:mm a"
+
+  Returns:
+    The list of parts, to be joined by format_time
+  """
+  parts = formats.get(fmt)
+  if parts is not None:
+    return parts
+  parts = []
+  position = 0
+  for match in TOKENS.finditer(fmt):
+    if match.start() > position:
+      parts.append(fmt[position:match.start()])
+    token = match.group()
+    if token.startswith('['):
+      parts.append(token[1:-1])
+    elif token in LONG_FORMATS:
+      parts.extend(compile_format(LONG_FORMATS[token]))
+    else:
+      parts.append(FIELDS[token])
+    position = match.end()
+  if position < len(fmt):
+    parts.append(fmt[position:])
+  formats.set(fmt, parts)
+  return parts
+
+
+def format_time(timestamp, fmt):
+  """
+  Format a timestamp like moment(timestamp).format(fmt), in UTC
+  """
+  return ''.join(part if isinstance(part, basestring) else part(timestamp) for part in compile_format(fmt))
+
+
+def js_round(x):
+  """
+  Round half up like Math.round, so thresholds match moment.js
+  """
+  return int(math.floor(x + 0.5))
+
+
+def from_now(timestamp, now):
+  """
+  Describe a timestamp relative to now like moment's fromNow()
+  """
+  delta = (now - timestamp).total_seconds()
+  seconds = js_round(abs(delta))
+  minutes = js_round(seconds / 60.0)
+  hours = js_round(minutes / 60.0)
+  days = js_round(hours / 24.0)
+  years = js_round(days / 365.0)
+  if seconds < 45:
+    key, n = 's', seconds
+  elif minutes == 1:
+    key, n = 'm', 1
+  elif minutes < 45:
+    key, n = 'mm', minutes
+  elif hours == 1:
+    key, n = 'h', 1
+  elif hours < 22:
+    key, n = 'hh', hours
+  elif days == 1:
+    key, n = 'd', 1
+  elif days <= 25:
+    key, n = 'dd', days
+  elif days <= 45:
+    key, n = 'M', 1
+  elif days < 345:
+    key, n = 'MM', js_round(days / 30.0)
+  elif years == 1:
+    key, n = 'y', 1
+  else:
+    key, n = 'yy', years
+  text = RELATIVE[key] % n if '%d' in RELATIVE[key] else RELATIVE[key]
+  return text + ' ago' if delta >= 0 else 'in ' + text
+
+
+def calendar(timestamp, now):
+  """
+  Describe a timestamp relative to today like moment's calendar()
+  """
+  today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+  diff = (timestamp - today).total_seconds() / 86400.0
+  if diff < -6:
+    key = 'sameElse'
+  elif diff < -1:
+    key = 'lastWeek'
+  elif diff < 0:
+    key = 'lastDay'
+  elif diff < 1:
+    key = 'sameDay'
+  elif diff < 2:
+    key = 'nextDay'
+  elif diff < 7:
+    key = 'nextWeek'
+  else:
+    key = 'sameElse'
+  return format_time(timestamp, CALENDAR[key])
+
+
+def cache_token(config):
+  """
+  Args:
+    config: the app configuration
+
+  Returns:
+    a string that changes whenever rendered times may change, for caches
+    of HTML containing them: the mode, plus the current minute in server
+    mode since the text then depends on the current time
+  """
+  mode = config.get('MOMENTJS_MODE', 'script')
+  if mode == 'server':
+    return '%s%d' % (mode, time.time() // 60)
+  return mode
+
 
 class momentjs(object):
+  """
+  Renders timestamps in templates with the moment.js API
+
+  MOMENTJS_MODE picks how:
+    'script': one inline <script> with document.write per timestamp
+    'client': a <time> element, filled in by a single pass of
+      static/js/moment-bulk.js once the page is loaded
+    'server': a <time> element with the text rendered here, in UTC
+  """
   def __init__(self, timestamp):
     self.timestamp = timestamp
 
   def render(self, format):
     return Markup("<script>\ndocument.write(moment(\"%s\").%s);\n</script>" % (self.timestamp.strftime("%Y-%m-%dT%H:%M:%S Z"), format))
 
+  def element(self, method, text, fmt=None):
+    attributes = ' data-moment="%s"' % method if method else ''
+    if fmt is not None:
+      attributes += ' data-format="%s"' % Markup.escape(fmt)
+    return Markup('<time datetime="%sZ"%s>%s</time>' % (self.timestamp.strftime("%Y-%m-%dT%H:%M:%S"), attributes, Markup.escape(text)))
+
+  def dispatch(self, method, fmt=None):
+    mode = current_app.config.get('MOMENTJS_MODE', 'script')
+    if mode == 'client':
+      return self.element(method, format_time(self.timestamp, 'YYYY-MM-DD HH:mm [UTC]'), fmt)
+    if mode == 'server':
+      if method == 'format':
+        text = format_time(self.timestamp, fmt)
+      elif method == 'calendar':
+        text = calendar(self.timestamp, datetime.utcnow())
+      else:
+        text = from_now(self.timestamp, datetime.utcnow())
+      return self.element(None, text)
+    if method == 'format':
+      return self.render("format(\"%s\")" % fmt)
+    return self.render("%s()" % method)
+
   def format(self, fmt):
-    return self.render("format(\"%s\")" % fmt)
+    return self.dispatch('format', fmt)
 
   def calendar(self):
-    return self.render("calendar()")
+    return self.dispatch('calendar')
 
   def fromNow(self):
-    return self.render("fromNow()")
+    return self.dispatch('fromNow')
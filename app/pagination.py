@@ -0,0 +1,113 @@
+from datetime import datetime
+from flask import abort
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class KeysetPage(object):
+  """
+  A page of results from keyset_paginate
+
+  Mirrors the parts of Flask-SQLAlchemy's Pagination used by the templates,
+  with cursors instead of page numbers
+  """
+  def __init__(self, items, has_prev, has_next, prev_cursor, next_cursor):
+    """
+    Constructor
+
+    Args:
+      items: the rows on this page, newest first
+      has_prev: True if there are newer rows
+      has_next: True if there are older rows
+      prev_cursor: cursor to pass as 'after' to get the newer page
+      next_cursor: cursor to pass as 'before' to get the older page
+    """
+    self.items = items
+    self.has_prev = has_prev
+    self.has_next = has_next
+    self.prev_cursor = prev_cursor
+    self.next_cursor = next_cursor
+
+
+def encode_cursor(timestamp, id):
+  """
+  Encode a (timestamp, id) key as an URL-safe cursor
+
+  Returns:
+    The cursor string
+  """
+  return '%s_%d' % (timestamp.strftime(CURSOR_FORMAT), id)
+
+
+def decode_cursor(cursor):
+  """
+  Decode a cursor made by encode_cursor, aborting with 404 if it is invalid
+
+  Returns:
+    The (timestamp, id) key
+  """
+  try:
+    timestamp, id = cursor.split('_')
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+  except ValueError:
+    abort(404)
+
+
+def keyset_paginate(query, key, per_page, before=None, after=None):
+  """
+  Paginate a query on a (timestamp, id) key instead of OFFSET, so that every
+  page costs the same as the first one
+
+  Args:
+    query: the query to paginate; its ordering is replaced
+    key: the (timestamp, id) columns to order and seek on
+    per_page: number of rows per page
+    before: cursor of the row just above the requested (older) page
+    after: cursor of the row just below the requested (newer) page
+
+  Returns:
+    A KeysetPage
+  """
+  timestamp, id = key
+  if after is not None:
+    # walk upwards from the cursor, then flip back to newest first
+    ts, pk = decode_cursor(after)
+    query = query.filter(or_(timestamp > ts, and_(timestamp == ts, id > pk)))
+    items = query.order_by(None).order_by(timestamp.asc(), id.asc()).limit(per_page + 1).all()
+    has_prev = len(items) > per_page
+    items = items[:per_page][::-1]
+    has_next = True
+  else:
+    if before is not None:
+      ts, pk = decode_cursor(before)
+      query = query.filter(or_(timestamp < ts, and_(timestamp == ts, id < pk)))
+    items = query.order_by(None).order_by(timestamp.desc(), id.desc()).limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    has_prev = before is not None
+  prev_cursor = next_cursor = None
+  if items:
+    prev_cursor = encode_cursor(items[0].timestamp, items[0].id)
+    next_cursor = encode_cursor(items[-1].timestamp, items[-1].id)
+  return KeysetPage(items, has_prev, has_next, prev_cursor, next_cursor)
+
+
+def offset_cursor(query, key, offset):
+  """
+  Find the cursor of the row at a given offset, to translate old page
+  numbers into cursors
+
+  Args:
+    query: the query being paginated
+    key: the (timestamp, id) columns it is ordered on
+    offset: the number of rows before the requested one
+
+  Returns:
+    The cursor, or None if the query has fewer rows
+  """
+  timestamp, id = key
+  row = query.order_by(None).order_by(timestamp.desc(), id.desc()).offset(offset).first()
+  if row is None:
+    return None
+  return encode_cursor(row.timestamp, row.id)
@@ -0,0 +1,123 @@
+import random
+import time
+from threading import Lock
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.engine.default import AUTOCOMMIT_REGEXP
+from sqlalchemy.sql.expression import PARSE_AUTOCOMMIT
+from flask import request, session as client_session, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession, _record_queries, _ConnectionDebugProxy
+
+# requests with these methods may read from a replica
+READ_METHODS = ('GET', 'HEAD')
+
+
+def is_write(clause):
+  """
+  Returns:
+    whether executing a statement writes (INSERT, UPDATE, DELETE, DDL)
+  """
+  autocommit = getattr(clause, '_execution_options', {}).get('autocommit')
+  if autocommit is PARSE_AUTOCOMMIT:
+    return AUTOCOMMIT_REGEXP.match(unicode(clause)) is not None
+  return autocommit is True
+
+
+def use_primary(f):
+  """
+  Decorator for views that write on GET (e.g. follow), so that the reads
+  they base their writes on come from the primary
+  """
+  f.use_primary = True
+  return f
+
+
+class RoutingSession(_SignallingSession):
+  """
+  A session that reads from a replica in GET requests
+
+  Writes always go to the primary, and so does everything after the
+  session's first write, and every request of a client for
+  READ_YOUR_WRITES seconds after it committed one (replicas lag behind).
+  """
+  def __init__(self, db, **options):
+    self.db = db
+    self.replica = None
+    self.wrote = False
+    _SignallingSession.__init__(self, db, **options)
+
+  def get_bind(self, mapper=None, clause=None):
+    if self._flushing or is_write(clause):
+      self.wrote = True
+    if not self.wrote:
+      if self.replica is None:
+        self.replica = self.db.choose_replica(self.app) or False
+      if self.replica:
+        return self.replica
+    return _SignallingSession.get_bind(self, mapper, clause)
+
+  def commit(self):
+    _SignallingSession.commit(self)
+    if self.wrote and has_request_context():
+      client_session['last_write'] = time.time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  """
+  Flask-SQLAlchemy with read replicas (SQLALCHEMY_REPLICA_URIS) and all of
+  SQLAlchemy's pool settings, including SQLALCHEMY_MAX_OVERFLOW
+  """
+  def __init__(self, app=None, **kwargs):
+    self.replicas = {}
+    self.replicas_lock = Lock()
+    SQLAlchemy.__init__(self, app, **kwargs)
+
+  def init_app(self, app):
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+    app.config.setdefault('READ_YOUR_WRITES', 10)
+    SQLAlchemy.init_app(self, app)
+
+  def create_scoped_session(self, options=None):
+    if options is None:
+      options = {}
+    scopefunc = options.pop('scopefunc', None)
+    return sqlalchemy.orm.scoped_session(lambda: RoutingSession(self, **options), scopefunc=scopefunc)
+
+  def apply_pool_defaults(self, app, options):
+    SQLAlchemy.apply_pool_defaults(self, app, options)
+    if app.config['SQLALCHEMY_MAX_OVERFLOW'] is not None:
+      options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+  def replica_engine(self, app, uri):
+    """
+    Returns:
+      the engine of a replica, created with the same options as the
+      primary's on first use
+    """
+    with self.replicas_lock:
+      if uri not in self.replicas:
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        if _record_queries(app):
+          options['proxy'] = _ConnectionDebugProxy(app.import_name)
+        self.replicas[uri] = sqlalchemy.create_engine(info, **options)
+      return self.replicas[uri]
+
+  def choose_replica(self, app):
+    """
+    Returns:
+      the engine of a random replica if the current request may read from
+      one, else None
+    """
+    uris = app.config['SQLALCHEMY_REPLICA_URIS']
+    if not uris or not has_request_context() or request.method not in READ_METHODS:
+      return None
+    view = app.view_functions.get(request.endpoint)
+    if getattr(view, 'use_primary', False):
+      return None
+    if time.time() - client_session.get('last_write', 0) < app.config['READ_YOUR_WRITES']:
+      return None
+    return self.replica_engine(app, random.choice(uris))
@@ -0,0 +1,356 @@
+from abc import ABCMeta, abstractmethod
+from threading import Lock
+from sqlalchemy import event, text
+from flask.ext.sqlalchemy import models_committed, Pagination
+from cache import LRUCache
+
+
+def normalize(query):
+  """
+  Returns:
+    the query in lower case with single spaces, as search cache key
+  """
+  return u' '.join(query.lower().split())
+
+
+class SearchBackend(object):
+  """
+  Full text search over the __searchable__ fields of a model
+
+  Backends only rank primary keys; page() caches them by normalized query
+  for SEARCH_CACHE_TTL seconds and loads the matching rows. Cache entries
+  are also keyed by a generation that changes whenever the index is
+  committed, so new posts show up in search as soon as they are indexed.
+
+  Subclasses implement search_page(), generation() and rebuild().
+  """
+  __metaclass__ = ABCMeta
+
+  def __init__(self, app, db, model):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration
+      db: the Flask-SQLAlchemy object
+      model: the model class with __searchable__ fields
+    """
+    app.config.setdefault('SEARCH_CACHE_SIZE', 1000)
+    app.config.setdefault('SEARCH_CACHE_TTL', 60)
+    self.app = app
+    self.db = db
+    self.model = model
+    self.results = LRUCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+
+  @abstractmethod
+  def search_page(self, query, page, per_page):
+    """
+    Returns:
+      the primary keys of the rows on a page of the rows matching every
+      word of the query, best match first, and the total number of matches
+    """
+
+  @abstractmethod
+  def generation(self):
+    """
+    Returns:
+      a value that changes whenever the index is committed
+    """
+
+  def search(self, query, limit):
+    """
+    Returns:
+      the primary keys of up to limit rows matching the query, best first
+    """
+    return self.search_page(query, 1, limit)[0]
+
+  @abstractmethod
+  def rebuild(self, connection):
+    """
+    Recreate the index from the database
+
+    Returns:
+      The number of rows indexed, or None if unknown
+    """
+
+  def cached_page(self, query, page, per_page):
+    """
+    search_page, through the cache
+
+    Returns:
+      (primary keys, total)
+    """
+    query = normalize(query)
+    key = (self.generation(), query, page, per_page)
+    found = self.results.get(key)
+    if found is None:
+      found = self.search_page(query, page, per_page)
+      self.results.set(key, found)
+    return found
+
+  def page(self, query, page, per_page):
+    """
+    Search for a page of rows, through the cache, and load them with their
+    authors in one query
+
+    Returns:
+      A Pagination of the rows, best match first
+    """
+    ids, total = self.cached_page(query, page, per_page)
+    rows = []
+    if ids:
+      rows = self.model.with_authors(self.model.query.filter(self.model.id.in_(ids))).all()
+    by_id = dict((row.id, row) for row in rows)
+    return Pagination(None, page, per_page, total, [by_id[id] for id in ids if id in by_id])
+
+  def posts(self, query, limit):
+    """
+    Returns:
+      up to limit rows matching the query, best match first
+    """
+    return self.page(query, 1, limit).items
+
+
+class DatabaseBackend(SearchBackend):
+  """
+  A search backend whose index is committed along with the rows
+  """
+  def __init__(self, app, db, model):
+    super(DatabaseBackend, self).__init__(app, db, model)
+    self.commits = 0
+    models_committed.connect(self.on_commit)
+
+  def on_commit(self, sender, changes):
+    """
+    models_committed signal handler: a new generation when rows of the
+    model changed (in this process; other workers' changes show up as
+    cache entries expire)
+    """
+    if any(isinstance(instance, self.model) for instance, operation in changes):
+      self.commits += 1
+
+  def generation(self):
+    return self.commits
+
+  def count_and_page(self, sql, params, page, per_page):
+    """
+    Run a ranked query with LIMIT :limit OFFSET :offset, and count all of
+    its rows unless a first page holds them all
+
+    Returns:
+      (primary keys, total)
+    """
+    params = dict(params, limit=per_page, offset=(page - 1) * per_page)
+    ids = [row[0] for row in self.db.session.execute(text(sql + ' LIMIT :limit OFFSET :offset'), params)]
+    if page == 1 and len(ids) < per_page:
+      return ids, len(ids)
+    return ids, self.db.session.execute(text('SELECT count(*) FROM (%s) AS matches' % sql), params).scalar()
+
+
+class WhooshBackend(SearchBackend):
+  """
+  Search in a Whoosh index under WHOOSH_BASE, written by a SearchIndexer
+
+  The index lives on the local disk, so it is only complete when every
+  worker runs on the same host. With SEARCH_INDEX_JOBS, changes are
+  written by the job worker (on that host) instead of a thread of each
+  web process, and survive restarts.
+
+  Whoosh is imported and the index opened on first use (a search or a
+  committed change), not when the app starts.
+  """
+  def __init__(self, app, db, model):
+    super(WhooshBackend, self).__init__(app, db, model)
+    self._indexer = None
+    self.lock = Lock()
+    self.jobs = app.extensions.get('jobs') if app.config.get('SEARCH_INDEX_JOBS') else None
+    if self.jobs is None:
+      models_committed.connect(self.on_commit)
+    else:
+      self.jobs.handler('search_index', batch=True)(self.write_jobs)
+      models_committed.connect(self.enqueue)
+
+  @property
+  def indexer(self):
+    """
+    The SearchIndexer of the index, created on first use
+    """
+    if self._indexer is None:
+      with self.lock:
+        if self._indexer is None:
+          from indexer import SearchIndexer, open_index
+          self._indexer = SearchIndexer(self.app, self.model, open_index(self.app, self.model))
+    return self._indexer
+
+  def changed(self, changes):
+    """
+    Returns:
+      True if rows of the model are among the committed changes
+    """
+    return any(isinstance(instance, self.model) for instance, operation in changes)
+
+  def on_commit(self, sender, changes):
+    """
+    models_committed signal handler: queue the committed changes for the
+    indexer thread
+    """
+    if self.changed(changes):
+      self.indexer.on_commit(sender, changes)
+
+  def enqueue(self, sender, changes):
+    """
+    models_committed signal handler: queue the committed changes as jobs
+    """
+    if self.changed(changes):
+      self.jobs.enqueue_many('search_index', [{'key': key, 'document': document}
+                                              for key, document in self.indexer.documents(changes)])
+
+  def write_jobs(self, payloads):
+    """
+    Job handler: write a batch of changes in one writer commit
+    """
+    self.indexer.write([(payload['key'], payload['document'], None) for payload in payloads])
+
+  def generation(self):
+    # the index's generation is on disk, so commits by other processes on
+    # this host count too; rebuilding the index (db_reindex.py) numbers
+    # generations from the start again, so the time the generation's table
+    # of contents was written tells a rebuilt index apart
+    from whoosh.index import TOC
+    index = self.indexer.index
+    generation = index.latest_generation()
+    try:
+      written = index.storage.file_modified(TOC._filename(index.indexname, generation))
+    except OSError:
+      # superseded by a newer generation meanwhile
+      written = None
+    return generation, written
+
+  def search_page(self, query, page, per_page):
+    from whoosh.qparser import MultifieldParser, AndGroup
+    index = self.indexer.index
+    parser = MultifieldParser(self.model.__searchable__, index.schema, group=AndGroup)
+    with index.searcher() as searcher:
+      # only the stored fields of the hits on the page are read
+      results = searcher.search_page(parser.parse(unicode(query)), page, pagelen=per_page)
+      if results.pagenum != page:
+        return [], results.total
+      return [int(hit[self.indexer.primary_key]) for hit in results], results.total
+
+  def rebuild(self, connection):
+    from indexer import rebuild_index
+    return rebuild_index(self.app, self.model, connection)
+
+
+class SQLiteBackend(DatabaseBackend):
+  """
+  Search in an SQLite FTS5 table over the model's table, kept up to date
+  by triggers
+
+  The table and triggers are created along with the model's table; run
+  db_reindex.py once to add them to an existing database.
+  """
+  def __init__(self, app, db, model):
+    super(SQLiteBackend, self).__init__(app, db, model)
+    table = model.__table__.name
+    self.fts = table + '_fts'
+    fields = model.__searchable__
+    new = ', '.join('new.' + field for field in fields)
+    old = ', '.join('old.' + field for field in fields)
+    values = {'fts': self.fts, 'table': table, 'fields': ', '.join(fields), 'new': new, 'old': old}
+    self.ddl = [s % values for s in [
+      "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5(%(fields)s, content='%(table)s', content_rowid='id', tokenize='porter unicode61')",
+      "CREATE TRIGGER IF NOT EXISTS %(fts)s_insert AFTER INSERT ON %(table)s BEGIN "
+      "INSERT INTO %(fts)s(rowid, %(fields)s) VALUES (new.id, %(new)s); END",
+      "CREATE TRIGGER IF NOT EXISTS %(fts)s_delete AFTER DELETE ON %(table)s BEGIN "
+      "INSERT INTO %(fts)s(%(fts)s, rowid, %(fields)s) VALUES ('delete', old.id, %(old)s); END",
+      "CREATE TRIGGER IF NOT EXISTS %(fts)s_update AFTER UPDATE ON %(table)s BEGIN "
+      "INSERT INTO %(fts)s(%(fts)s, rowid, %(fields)s) VALUES ('delete', old.id, %(old)s); "
+      "INSERT INTO %(fts)s(rowid, %(fields)s) VALUES (new.id, %(new)s); END",
+    ]]
+    event.listen(model.__table__, 'after_create', lambda target, connection, **kw: self.setup(connection))
+    event.listen(model.__table__, 'before_drop', lambda target, connection, **kw: self.drop(connection))
+
+  def setup(self, connection):
+    """
+    Create the FTS5 table and its triggers, if they do not exist
+    """
+    for statement in self.ddl:
+      connection.execute(text(statement))
+
+  def drop(self, connection):
+    """
+    Drop the FTS5 table (the triggers go with the model's table)
+    """
+    connection.execute(text('DROP TABLE IF EXISTS %s' % self.fts))
+
+  def search_page(self, query, page, per_page):
+    # every word as a quoted string, so user input is never FTS5 syntax
+    words = ['"%s"' % word.replace('"', '""') for word in query.split()]
+    if not words:
+      return [], 0
+    return self.count_and_page('SELECT rowid FROM %s WHERE %s MATCH :query ORDER BY rank' % (self.fts, self.fts),
+                               {'query': ' '.join(words)}, page, per_page)
+
+  def rebuild(self, connection):
+    self.setup(connection)
+    connection.execute(text("INSERT INTO %s(%s) VALUES ('rebuild')" % (self.fts, self.fts)))
+
+
+class PostgresBackend(DatabaseBackend):
+  """
+  Search with PostgreSQL's tsvector, through a GIN expression index that
+  the database keeps up to date
+
+  The index is created along with the model's table; run db_reindex.py
+  once to add it to an existing database.
+  """
+  def __init__(self, app, db, model):
+    super(PostgresBackend, self).__init__(app, db, model)
+    table = model.__table__.name
+    config = app.config.get('SEARCH_LANGUAGE', 'english')
+    document = " || ' ' || ".join("coalesce(%s, '')" % field for field in model.__searchable__)
+    self.vector = "to_tsvector('%s', %s)" % (config, document)
+    self.tsquery = "plainto_tsquery('%s', :query)" % config
+    self.table = table
+    self.ddl = 'CREATE INDEX IF NOT EXISTS ix_%s_fts ON %s USING gin (%s)' % (table, table, self.vector)
+    event.listen(model.__table__, 'after_create', lambda target, connection, **kw: self.setup(connection))
+
+  def setup(self, connection):
+    """
+    Create the GIN index, if it does not exist
+    """
+    connection.execute(text(self.ddl))
+
+  def search_page(self, query, page, per_page):
+    return self.count_and_page('SELECT id FROM %s WHERE %s @@ %s ORDER BY ts_rank(%s, %s) DESC'
+                               % (self.table, self.vector, self.tsquery, self.vector, self.tsquery),
+                               {'query': query}, page, per_page)
+
+  def rebuild(self, connection):
+    self.setup(connection)
+
+
+BACKENDS = {
+  'whoosh': WhooshBackend,
+  'sqlite': SQLiteBackend,
+  'postgres': PostgresBackend,
+  'postgresql': PostgresBackend,
+}
+
+
+def create_backend(app, db, model):
+  """
+  Create the search backend named by SEARCH_BACKEND: 'whoosh', 'sqlite',
+  'postgresql', 'database' for the one matching SQLALCHEMY_DATABASE_URI,
+  or None to disable search
+
+  Returns:
+    The backend, or None
+  """
+  name = app.config.get('SEARCH_BACKEND', 'whoosh')
+  if name is None:
+    return None
+  if name == 'database':
+    name = app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0].split('+')[0]
+  return BACKENDS[name](app, db, model)
@@ -0,0 +1,16 @@
+// Announces new posts on the home page: listens to the server-sent events
+// of /api/v1/events and shows how many posts a reload would add, instead
+// of reloading the whole feed periodically
+(function () {
+  var notice = document.getElementById('new-posts');
+  if (!notice || !window.EventSource) {
+    return;
+  }
+  var count = 0;
+  var source = new EventSource('/api/v1/events');
+  source.addEventListener('post', function () {
+    count += 1;
+    notice.innerHTML = '<a href="' + notice.getAttribute('data-href') + '">' + count +
+      (count === 1 ? ' new post' : ' new posts') + '</a>';
+  });
+})();
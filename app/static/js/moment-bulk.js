@@ -0,0 +1,16 @@
+// Fills in every <time data-moment> element emitted by momentjs.py in
+// 'client' mode with one pass over the page, instead of an inline
+// document.write script per timestamp; bundled with moment.js in the head
+document.addEventListener('DOMContentLoaded', function () {
+  var elements = document.querySelectorAll('time[data-moment]');
+  for (var i = 0; i < elements.length; i++) {
+    var element = elements[i];
+    var time = moment(element.getAttribute('datetime'));
+    var method = element.getAttribute('data-moment');
+    if (method === 'format') {
+      element.textContent = time.format(element.getAttribute('data-format'));
+    } else {
+      element.textContent = time[method]();
+    }
+  }
+});
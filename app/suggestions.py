@@ -0,0 +1,196 @@
+from collections import Counter, defaultdict
+
+# NumPy and SciPy, imported by the first computation (web processes never
+# need them); False if they are not installed
+numpy = sparse = None
+
+
+def load_numpy():
+  """
+  Returns:
+    True if NumPy and SciPy can be used
+  """
+  global numpy, sparse
+  if numpy is None:
+    try:
+      import numpy as np
+      from scipy import sparse as sp
+      numpy, sparse = np, sp
+    except ImportError:
+      numpy = False
+  return numpy is not False
+
+
+def two_hop(follower_ids, followed_ids, user_ids, k):
+  """
+  Count, for each user, the users they follow who follow each user they do
+  not follow yet, and keep the top k, with NumPy/SciPy if installed
+
+  Args:
+    follower_ids, followed_ids: the follow edges, as two sequences of ids;
+      they must include every edge of the users and of whom they follow
+    user_ids: the users to suggest to
+    k: the most suggestions kept per user
+
+  Returns:
+    (user id, suggested id, score) tuples, best first for each user, ties
+    broken by the lowest id
+  """
+  if load_numpy():
+    return two_hop_sparse(follower_ids, followed_ids, user_ids, k)
+  following = defaultdict(set)
+  for follower, followed in zip(follower_ids, followed_ids):
+    if follower != followed:
+      following[follower].add(followed)
+  rows = []
+  for user_id in user_ids:
+    followed = following.get(user_id, set())
+    counts = Counter()
+    for id in followed:
+      counts.update(following.get(id, ()))
+    best = sorted((-score, id) for id, score in counts.iteritems() if id != user_id and id not in followed)
+    rows.extend((user_id, id, -score) for score, id in best[:k])
+  return rows
+
+
+def two_hop_sparse(follower_ids, followed_ids, user_ids, k):
+  """
+  two_hop over a CSR adjacency matrix A of the follow graph: the rows of
+  A[users] * A are the two-hop counts, and the top k of every row are
+  picked with one sort of all their nonzero entries (once load_numpy()
+  succeeded)
+  """
+  follower_ids = numpy.asarray(follower_ids, dtype=numpy.int64)
+  followed_ids = numpy.asarray(followed_ids, dtype=numpy.int64)
+  ids = numpy.unique(numpy.concatenate([follower_ids, followed_ids]))
+  users = numpy.intersect1d(numpy.asarray(user_ids, dtype=numpy.int64), ids)
+  if not len(users):
+    return []
+  src = numpy.searchsorted(ids, follower_ids)
+  dst = numpy.searchsorted(ids, followed_ids)
+  edges = src != dst
+  n = len(ids)
+  graph = sparse.csr_matrix((numpy.ones(edges.sum(), dtype=numpy.int32), (src[edges], dst[edges])), shape=(n, n))
+  rows = numpy.searchsorted(ids, users)
+  followed = graph[rows]
+  counts = (followed * graph).tocsr()
+  # not the users they follow already, nor themselves
+  themselves = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32), (numpy.arange(len(rows)), rows)),
+                                 shape=counts.shape)
+  counts = counts - counts.multiply(followed) - counts.multiply(themselves)
+  counts.eliminate_zeros()
+  counts = counts.tocoo()
+  order = numpy.lexsort((counts.col, -counts.data, counts.row))
+  row, col, score = counts.row[order], counts.col[order], counts.data[order]
+  rank = numpy.arange(len(row)) - numpy.searchsorted(row, row)
+  top = rank < k
+  return zip(users[row[top]].tolist(), ids[col[top]].tolist(), score[top].tolist())
+
+
+class Suggestions(object):
+  """
+  "Who to follow": the users followed by the most of the users someone
+  follows, computed offline and stored in the suggestion table
+
+  The SUGGESTIONS_COUNT best are stored per user, so pages only read a few
+  rows. Follows and unfollows queue a job (run by worker.py after
+  SUGGESTIONS_DELAY seconds, so a burst of follows is handled once) that
+  recomputes the suggestions of the users whose follows changed and of
+  their followers, SUGGESTIONS_CHUNK users at a time; refresh() recomputes
+  everyone's (db_suggest.py).
+  """
+  def __init__(self, app, db, follower, followed):
+    """
+    Constructor
+
+    Args:
+      app: the flask app, for configuration and its job queue
+      db: the Flask-SQLAlchemy object
+      follower, followed: the columns of the follow association table
+    """
+    app.config.setdefault('SUGGESTIONS_COUNT', 20)
+    app.config.setdefault('SUGGESTIONS_DELAY', 60)
+    app.config.setdefault('SUGGESTIONS_CHUNK', 500)
+    self.app = app
+    self.db = db
+    self.follower = follower
+    self.followed = followed
+    self.table = db.Table('suggestion',
+      db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+      db.Column('suggested_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+      # how many of the users they follow follow the suggested user
+      db.Column('score', db.Integer))
+    db.Index('ix_suggestion_user_score', self.table.c.user_id, self.table.c.score)
+    self.jobs = app.extensions['jobs']
+    self.jobs.handler('suggestions', batch=True)(self.refresh_jobs)
+
+  def changed(self, user_id):
+    """
+    Queue a refresh for a user whose follows changed, in the current
+    transaction
+    """
+    self.jobs.enqueue('suggestions', {'user': user_id}, delay=self.app.config['SUGGESTIONS_DELAY'])
+
+  def refresh_jobs(self, payloads):
+    """
+    Job handler: refresh the users whose follows changed, and their
+    followers, whose two-hop neighbourhood goes through them
+    """
+    changed = sorted(set(payload['user'] for payload in payloads))
+    users = set(changed)
+    chunk = self.app.config['SUGGESTIONS_CHUNK']
+    for i in range(0, len(changed), chunk):
+      users.update(row[0] for row in self.db.engine.execute(
+        self.db.select([self.follower], self.followed.in_(changed[i:i + chunk]))))
+    self.refresh(sorted(users))
+
+  def refresh(self, user_ids=None):
+    """
+    Recompute and store the suggestions of some users
+
+    Args:
+      user_ids: the users to refresh, or None for everyone (the whole
+        graph is then read once)
+
+    Returns:
+      The number of suggestions stored
+    """
+    chunk = self.app.config['SUGGESTIONS_CHUNK']
+    if user_ids is None:
+      edges = self.edges()
+      user_ids = sorted(set(edges[0]))
+      with self.db.engine.begin() as connection:
+        connection.execute(self.table.delete())
+      return sum(self.store(user_ids[i:i + chunk], edges) for i in range(0, len(user_ids), chunk))
+    return sum(self.store(user_ids[i:i + chunk], self.edges(user_ids[i:i + chunk]))
+               for i in range(0, len(user_ids), chunk))
+
+  def edges(self, user_ids=None):
+    """
+    Read the follow edges of some users and of whom they follow, in one
+    query
+
+    Returns:
+      (follower ids, followed ids)
+    """
+    query = self.db.select([self.follower, self.followed])
+    if user_ids is not None:
+      followed = self.db.select([self.followed], self.follower.in_(user_ids))
+      query = query.where(self.db.or_(self.follower.in_(user_ids), self.follower.in_(followed)))
+    rows = self.db.engine.execute(query).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+  def store(self, user_ids, edges):
+    """
+    Replace the suggestions of some users, in one transaction
+
+    Returns:
+      The number of suggestions stored
+    """
+    rows = two_hop(edges[0], edges[1], user_ids, self.app.config['SUGGESTIONS_COUNT'])
+    with self.db.engine.begin() as connection:
+      connection.execute(self.table.delete().where(self.table.c.user_id.in_(user_ids)))
+      if rows:
+        connection.execute(self.table.insert(), [{'user_id': user_id, 'suggested_id': suggested_id, 'score': score}
+                                                 for user_id, suggested_id, score in rows])
+    return len(rows)
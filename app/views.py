@@ -1,31 +1,45 @@
 # Handlers that respond to requests from browsers
-from flask import render_template, flash, redirect, session, url_for, g, request
+from flask import render_template, flash, redirect, session, url_for, g, request, abort
 from flask.ext.login import login_user, logout_user, current_user, login_required
-from app import app, db, lm, oid
+from flask.ext.sqlalchemy import get_debug_queries
+from app import app, db, lm, oid, last_seen, http_cache
+from routing import use_primary
 from forms import LoginForm, EditForm, PostForm, SearchForm
-from models import User, ROLE_USER, ROLE_ADMIN, Post
+from models import User, ROLE_USER, ROLE_ADMIN, Post, search_engine, identity_cache
+from emails import follower_notification
 from datetime import datetime
-from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, WHOOSH_ENABLED
+from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, SUGGESTIONS_SHOWN
 
 @app.route('/', methods=['GET', 'POST'])
 @app.route('/index', methods=['GET', 'POST'])
 @app.route('/index/<int:page>', methods=['GET', 'POST'])
 @login_required  # cannot view this page without signing in
-def index(page=1):
+def index(page=None):
   """
   Index page/Landing page for app
+
+  Pages are addressed by ?before=<cursor> (older) and ?after=<cursor> (newer);
+  old /index/<page> URLs redirect to the equivalent cursor
   """
   user = g.user
+  if page is not None and request.method == 'GET':
+    return redirect(url_for('index', before=user.timeline_cursor(page, POSTS_PER_PAGE)))
+  if request.method == 'GET':
+    token, last_modified = user.timeline_version(user.suggestions_versions())
+    not_modified = http_cache.check(token, last_modified)
+    if not_modified is not None:
+      return not_modified
   form = PostForm()
-  posts = user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
   if form.validate_on_submit():
-    post = Post(body=form.post.data, timestamp=datetime.utcnow(), author=user)
+    post = Post(body=form.post.data, timestamp=datetime.utcnow(), author=user.instance())
     db.session.add(post)
     db.session.commit()
     flash('SUCCESS: Your post is now live!')
     return redirect(url_for('index'))
+  posts = user.timeline_page(POSTS_PER_PAGE, before=request.args.get('before'),
+                    after=request.args.get('after'))
   return render_template('index.html', title='Home', user=user, posts=posts,
-                    form=form)
+                    form=form, suggestions=user.suggestions(SUGGESTIONS_SHOWN))
 
 
 @app.before_request
@@ -38,13 +52,41 @@ def before_request():
   g.user = current_user
   if g.user.is_authenticated():
     # Add the current time to this user's last seen
-    g.user.last_seen = datetime.utcnow()
-    db.session.add(g.user)
-    db.session.commit()
+    # (kept in memory and written to the database in batches)
+    last_seen.touch(g.user)
     g.search_form = SearchForm()
-  g.search_enabled = WHOOSH_ENABLED
+  g.search_enabled = search_engine is not None
+
+
+class QueryBudgetExceeded(Exception):
+  """
+  Raised in testing mode when a request issues more SQL statements than
+  SQLALCHEMY_QUERY_BUDGET
+  """
+  pass
+
+
+@app.after_request
+def after_request(response):
+  """
+  Runs after the view function
+  Counts the SQL statements of the request while queries are recorded
+  (debug and testing modes), and enforces the query budget
+  """
+  queries = get_debug_queries()
+  if not queries:
+    return response
+  response.headers['X-Query-Count'] = str(len(queries))
+  budget = app.config.get('SQLALCHEMY_QUERY_BUDGET')
+  if budget is not None and len(queries) > budget:
+    message = '%s issued %d SQL statements (budget %d)' % (request.path, len(queries), budget)
+    if app.testing:
+      raise QueryBudgetExceeded(message)
+    app.logger.warning(message)
+  return response
 
 @app.route('/login', methods=['GET', 'POST'])
+@use_primary  # writes on GET, when OpenID redirects back
 @oid.loginhandler  # tell Flask-OpenID that this is our login view function
 def login():
   """
@@ -85,17 +127,14 @@ def after_login(resp):
       # could not get nickname from OpenID provider
       # get a nickname from the email address
       nickname = resp.email.split('@')[0]
-    # make the nickname unique
-    nickname = User.make_unique_nickname(nickname)
-    # create a new user and add to database
-    user = User(nickname=nickname, email=resp.email, role=ROLE_USER)
-    db.session.add(user)
-    db.session.commit()
-    # make every new user follow himself
-    # so that a user's posts appear on his feed
-    user = user.follow(user)
-    db.session.add(user)
-    db.session.commit()
+    # create a new user with a unique nickname and add to database
+    user, created = User.create_unique(nickname, resp.email, ROLE_USER)
+    if created:
+      # make every new user follow himself
+      # so that a user's posts appear on his feed
+      user = user.follow(user)
+      db.session.add(user)
+      db.session.commit()
   remember_me = False
   if 'remember_me' in session:
     remember_me = session['remember_me']
@@ -107,15 +146,15 @@ def after_login(resp):
 @lm.user_loader
 def load_user(id):
   """
-  Loads the user from the database
+  Loads the user from the identity cache, or from the database
 
   Args:
     id: ID of required user (could be in unicode format)
 
   Returns:
-    user: the user object
+    user: a CachedUser, whose instance() is the full user
   """
-  return User.query.get(int(id))
+  return identity_cache.get(int(id))
 
 
 @app.route('/logout')
@@ -130,20 +169,31 @@ def logout():
 @app.route('/user/<nickname>')
 @app.route('/user/<nickname>/<int:page>')
 @login_required
-def user(nickname, page=1):
+def user(nickname, page=None):
   """
   Profile page for a user
 
   Args:
     nickname: nickname of the user whose profile page is needed
+    page: old-style page number, redirected to the equivalent cursor
   """
   # verify if user exists
   user = User.query.filter_by(nickname=nickname).first()
   if user is None:
     flash('ERROR: User ' + nickname + ' not found!')
     return redirect(url_for('index'))
-  posts = user.posts.paginate(page, POSTS_PER_PAGE, False)
-  return render_template('user.html', user=user, posts=posts)
+  if page is not None:
+    return redirect(url_for('user', nickname=nickname,
+                    before=user.posts_cursor(page, POSTS_PER_PAGE)))
+  seen = last_seen.last_seen(user)
+  token, last_modified = user.profile_version(g.user.page_versions())
+  not_modified = http_cache.check((token, seen), last_modified)
+  if not_modified is not None:
+    return not_modified
+  posts = user.posts_page(POSTS_PER_PAGE, before=request.args.get('before'),
+                    after=request.args.get('after'))
+  return render_template('user.html', user=user, posts=posts,
+                    last_seen=seen, suggestions=g.user.suggestions(SUGGESTIONS_SHOWN))
 
 
 @app.route('/edit', methods=['GET', 'POST'])
@@ -152,22 +202,29 @@ def edit():
   """
   Page to edit profile
   """
-  form = EditForm(g.user.nickname)
+  user = g.user.instance()
+  form = EditForm(user.nickname)
   if form.validate_on_submit():
-    g.user.nickname = form.nickname.data
-    g.user.about_me = form.about_me.data
-    db.session.add(g.user)
+    if form.nickname.data != user.nickname:
+      # the nickname is part of every cached post fragment of this user
+      user.version = (user.version or 0) + 1
+    user.nickname = form.nickname.data
+    user.about_me = form.about_me.data
+    db.session.add(user)
     db.session.commit()
+    # (committed changes to users drop them too, roles included)
+    identity_cache.invalidate(user.id)
     flash('SUCCESS: Your changes have been saved.')
     return redirect(url_for('edit'))
   else:
     # provide default values, else form will be very irritating
-    form.nickname.data = g.user.nickname
-    form.about_me.data = g.user.about_me
+    form.nickname.data = user.nickname
+    form.about_me.data = user.about_me
   return render_template('edit.html', title='Edit Profile', form=form)
 
 
 @app.route('/follow/<nickname>')
+@use_primary  # writes on GET
 @login_required
 def follow(nickname):
   """
@@ -185,12 +242,14 @@ def follow(nickname):
     flash('ERROR: You cannot follow: ' + nickname)
     return redirect(url_for('user', nickname=nickname))
   db.session.add(u)
+  follower_notification(user, g.user)
   db.session.commit()
   flash('SUCCESS: You are now following: ' + nickname)
   return redirect(url_for('user', nickname = nickname))
 
 
 @app.route('/unfollow/<nickname>')
+@use_primary  # writes on GET
 @login_required
 def unfollow(nickname):
   """
@@ -241,10 +300,16 @@ def search():
 
 
 @app.route('/search_results/<query>')
+@app.route('/search_results/<query>/<int:page>')
 @login_required
-def search_results(query):
+def search_results(query, page=1):
   """
-  Uses Whooshalchemy to perform full-text search
+  Full-text search with the configured search backend, a page of
+  MAX_SEARCH_RESULTS posts at a time
   """
-  results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
+  if search_engine is None:
+    return redirect(url_for('index'))
+  results = search_engine.page(query, page, MAX_SEARCH_RESULTS)
+  if page > 1 and not results.items:
+    abort(404)
   return render_template('search_results.html', query=query, results=results)
@@ -0,0 +1,66 @@
+#!flask/bin/python
+
+# Benchmarks the JSON API against the HTML pages it replaces for the mobile
+# client: requests per second and bytes per response, plain and gzipped
+# Usage: bench_api.py [iterations]
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+handle, dbfile = tempfile.mkstemp(suffix='.db')
+os.close(handle)
+os.environ['DATABASE_URL'] = 'sqlite:///' + dbfile
+
+from app import app, db, last_seen
+from app.models import User, Post
+from config import POSTS_PER_PAGE
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+db.create_all()
+reader = User(nickname='reader', email='reader@example.com')
+db.session.add(reader)
+db.session.commit()
+reader.follow(reader)
+db.session.add(reader)
+now = datetime.utcnow()
+for i in range(20):
+  author = User(nickname='author%d' % i, email='author%d@example.com' % i)
+  db.session.add(author)
+  db.session.commit()
+  reader.follow(author)
+  db.session.add(reader)
+  for j in range(10):
+    db.session.add(Post(body='post %d by author %d' % (j, i), author=author,
+                        timestamp=now - timedelta(minutes=7 * j + i)))
+  db.session.commit()
+
+client = app.test_client()
+with client.session_transaction() as session:
+  session['user_id'] = unicode(reader.id)
+  session['_fresh'] = True
+
+ROUTES = [
+  ('html', '/index'),
+  ('json', '/api/v1/timeline?limit=%d' % POSTS_PER_PAGE),
+  ('json', '/api/v1/timeline?limit=%d&fields=id,body,author' % POSTS_PER_PAGE),
+  ('html', '/user/author0'),
+  ('json', '/api/v1/users/author0/posts?limit=%d' % POSTS_PER_PAGE),
+]
+
+try:
+  for kind, url in ROUTES:
+    size = len(client.get(url).data)
+    gzipped = len(client.get(url, headers={'Accept-Encoding': 'gzip'}).data)
+    start = time.time()
+    for i in range(iterations):
+      rv = client.get(url)
+      assert rv.status_code == 200
+    elapsed = time.time() - start
+    print '%-4s %-50s %7.1f req/s  %6d bytes  %6d gzipped' % (kind, url, iterations / elapsed, size, gzipped)
+finally:
+  last_seen.flush()
+  db.session.remove()
+  os.remove(dbfile)
@@ -0,0 +1,363 @@
+#!flask/bin/python
+
+# Load tests the app by replaying request traces, reporting latency
+# percentiles, throughput and SQL statements per endpoint
+#
+# Usage:
+#   bench_load.py seed [--users N] [--posts N] [--degree N] [--reset]
+#     fills the database (DATABASE_URL) with a synthetic social graph
+#   bench_load.py trace [--requests N] [-o trace.jsonl]
+#     writes a trace of requests by the seeded users
+#   bench_load.py run trace.jsonl [--url URL] [--concurrency N] [-o results.json] [--compare old.json]
+#     replays a trace through app.test_client(), or against a running
+#     server at URL (e.g. gunicorn on the same database; start it with
+#     RECORD_QUERIES=1 to get SQL statement counts)
+#
+# A trace has one JSON object per line: {"user": nickname or null,
+# "method": "GET" or "POST", "path": "/index", "data": {form fields}}
+
+import argparse
+import bisect
+import cookielib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import Queue
+from datetime import datetime, timedelta
+
+# count the SQL statements of requests replayed in this process
+os.environ['RECORD_QUERIES'] = '1'
+
+from app import app, db
+from app.models import User, Post, Timeline, followers, search_engine
+
+WORDS = ['flask', 'python', 'coffee', 'music', 'travel', 'running', 'cats', 'dogs', 'books',
+         'weather', 'football', 'cooking', 'movies', 'garden', 'photos', 'database', 'search']
+
+
+def zipf_sampler(n, exponent=1.0):
+  """
+  Returns:
+    a function drawing ids from 1 to n, id k with probability
+    proportional to 1 / k ** exponent (a few users get most follows)
+  """
+  total = 0.0
+  cumulative = []
+  for k in range(1, n + 1):
+    total += 1.0 / k ** exponent
+    cumulative.append(total)
+  return lambda: bisect.bisect_left(cumulative, random.random() * total) + 1
+
+
+def seed(args):
+  """
+  Insert users, posts and follows in bulk, then compute counters,
+  timelines and the search index like the app would have
+  """
+  db.create_all()
+  if User.query.first() is not None:
+    if not args.reset:
+      sys.exit('The database is not empty; use --reset to drop it')
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+  random.seed(args.random_seed)
+  users = User.__table__
+  posts = Post.__table__
+  db.engine.execute(users.insert(), [
+    {'id': i, 'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i,
+     'email_hash': User.hash_email('user%d@example.com' % i), 'version': 0,
+     'followers_count': 0, 'following_count': 0, 'posts_count': 0, 'pull_timeline': False}
+    for i in range(1, args.users + 1)])
+  # follow degrees are heavy tailed: most users follow a few, some many
+  popular = zipf_sampler(args.users)
+  follows = set()
+  for follower in range(1, args.users + 1):
+    follows.add((follower, follower))
+    degree = min(args.users - 1, int(random.paretovariate(2.0) * args.degree / 2))
+    while degree > 0:
+      followed = popular()
+      if followed != follower and (follower, followed) not in follows:
+        follows.add((follower, followed))
+        degree -= 1
+  db.engine.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in follows])
+  now = datetime.utcnow()
+  batch = []
+  for i in range(args.users * args.posts):
+    batch.append({'body': ' '.join(random.sample(WORDS, 4)), 'user_id': random.randint(1, args.users),
+                  'timestamp': now - timedelta(seconds=random.randint(0, 30 * 86400))})
+    if len(batch) == 10000:
+      db.engine.execute(posts.insert(), batch)
+      batch = []
+  if batch:
+    db.engine.execute(posts.insert(), batch)
+  User.recount()
+  Timeline.rebuild()
+  if search_engine is not None:
+    search_engine.rebuild(db.engine)
+  print 'Seeded %d users, %d follows, %d posts' % (args.users, len(follows), args.users * args.posts)
+
+
+def trace(args):
+  """
+  Write a synthetic trace: mostly home pages, then profiles, searches,
+  new posts and follows
+  """
+  count = User.query.count()
+  if not count:
+    sys.exit('Seed the database first')
+  random.seed(args.random_seed)
+  popular = zipf_sampler(count)
+  out = open(args.output, 'w') if args.output else sys.stdout
+  for i in range(args.requests):
+    user = 'user%d' % random.randint(1, count)
+    kind = random.random()
+    entry = {'user': user, 'method': 'GET'}
+    if kind < 0.5:
+      entry['path'] = '/index'
+    elif kind < 0.7:
+      entry['path'] = '/user/user%d' % popular()
+    elif kind < 0.8:
+      entry['path'] = '/search_results/' + random.choice(WORDS)
+    elif kind < 0.9:
+      entry.update(method='POST', path='/index', data={'post': ' '.join(random.sample(WORDS, 4))})
+    else:
+      entry['path'] = random.choice(['/follow/', '/unfollow/']) + 'user%d' % popular()
+    out.write(json.dumps(entry) + '\n')
+  if out is not sys.stdout:
+    out.close()
+
+
+def login_client(nickname):
+  """
+  Returns:
+    a test client with a user logged in (bypassing OpenID)
+  """
+  user = User.query.filter_by(nickname=nickname).first()
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session['user_id'] = unicode(user.id)
+    session['_fresh'] = True
+  return client
+
+
+def session_cookie(nickname):
+  """
+  Returns:
+    the value of a session cookie logging a user in, signed with the
+    app's SECRET_KEY
+  """
+  for cookie in login_client(nickname).cookie_jar:
+    if cookie.name == app.session_cookie_name:
+      return cookie.value
+
+
+class TestClientReplayer(object):
+  """
+  Replays requests in this process, one test client per user
+  """
+  def __init__(self):
+    app.config['CSRF_ENABLED'] = False
+    self.clients = {}
+
+  def request(self, entry):
+    user = entry.get('user')
+    if user not in self.clients:
+      self.clients[user] = app.test_client() if user is None else login_client(user)
+    client = self.clients[user]
+    if entry.get('method', 'GET') == 'POST':
+      response = client.post(entry['path'], data=entry.get('data', {}))
+    else:
+      response = client.get(entry['path'])
+    queries = response.headers.get('X-Query-Count')
+    return response.status_code, int(queries) if queries else None
+
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+  def redirect_request(self, *args, **kwargs):
+    return None
+
+
+class HTTPReplayer(object):
+  """
+  Replays requests against a running server, one cookie jar per user;
+  posts carry a CSRF token read from the user's home page first
+  """
+  def __init__(self, url):
+    self.url = url.rstrip('/')
+    self.openers = {}
+    self.tokens = {}
+    self.lock = threading.Lock()
+
+  def opener(self, user):
+    with self.lock:
+      if user not in self.openers:
+        jar = cookielib.CookieJar()
+        if user is not None:
+          jar.set_cookie(cookielib.Cookie(0, app.session_cookie_name, session_cookie(user), None, False,
+                                          urllib2.urlparse.urlparse(self.url).hostname, False, False,
+                                          '/', True, False, None, False, None, None, {}))
+        self.openers[user] = urllib2.build_opener(urllib2.HTTPCookieProcessor(jar), NoRedirect)
+      return self.openers[user]
+
+  def open(self, opener, path, data=None):
+    try:
+      response = opener.open(self.url + path, data)
+    except urllib2.HTTPError as error:
+      response = error
+    body = response.read()
+    return response, body
+
+  def request(self, entry):
+    user = entry.get('user')
+    opener = self.opener(user)
+    data = None
+    if entry.get('method', 'GET') == 'POST':
+      if user not in self.tokens:
+        response, body = self.open(opener, '/index')
+        match = re.search(r'name="csrf_token" type="hidden" value="([^"]*)"', body)
+        self.tokens[user] = match.group(1) if match else ''
+      data = urllib.urlencode(dict(entry.get('data', {}), csrf_token=self.tokens[user]))
+    response, body = self.open(opener, entry['path'], data)
+    queries = response.info().getheader('X-Query-Count')
+    return response.code, int(queries) if queries else None
+
+
+def percentile(values, p):
+  """
+  Returns:
+    the p-th percentile of sorted values (nearest rank)
+  """
+  if not values:
+    return None
+  return values[max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)]
+
+
+def endpoint(entry):
+  """
+  Returns:
+    the name of the view handling a trace entry
+  """
+  try:
+    return app.url_map.bind('localhost').match(entry['path'], entry.get('method', 'GET'))[0]
+  except Exception:
+    return 'unknown'
+
+
+def summarize(samples, elapsed):
+  """
+  Args:
+    samples: (endpoint, seconds, status, SQL statements or None) tuples
+    elapsed: wall clock duration of the run
+
+  Returns:
+    the statistics of every endpoint, and of all requests under 'all'
+  """
+  groups = {'all': samples}
+  for sample in samples:
+    groups.setdefault(sample[0], []).append(sample)
+  stats = {}
+  for name, group in groups.iteritems():
+    latencies = sorted(sample[1] * 1000 for sample in group)
+    queries = [sample[3] for sample in group if sample[3] is not None]
+    stats[name] = {
+      'requests': len(group),
+      'errors': sum(1 for sample in group if sample[2] >= 400),
+      'throughput': len(group) / elapsed if elapsed else None,
+      'mean_ms': sum(latencies) / len(latencies),
+      'p50_ms': percentile(latencies, 50),
+      'p95_ms': percentile(latencies, 95),
+      'p99_ms': percentile(latencies, 99),
+      'max_ms': latencies[-1],
+      'queries_mean': float(sum(queries)) / len(queries) if queries else None,
+      'queries_max': max(queries) if queries else None,
+    }
+  return stats
+
+
+def run(args):
+  """
+  Replay a trace and write the statistics
+  """
+  entries = [json.loads(line) for line in open(args.trace) if line.strip()]
+  if args.url:
+    replayer = HTTPReplayer(args.url)
+  else:
+    app.config['SQLALCHEMY_QUERY_BUDGET'] = None
+    replayer = TestClientReplayer()
+    args.concurrency = 1
+  work = Queue.Queue()
+  for entry in entries:
+    work.put(entry)
+  samples = []
+
+  def worker():
+    while True:
+      try:
+        entry = work.get_nowait()
+      except Queue.Empty:
+        return
+      start = time.time()
+      status, queries = replayer.request(entry)
+      samples.append((endpoint(entry), time.time() - start, status, queries))
+
+  start = time.time()
+  threads = [threading.Thread(target=worker) for i in range(args.concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+  except Exception:
+    commit = None
+  results = {'commit': commit, 'trace': args.trace, 'target': args.url or 'test_client',
+             'concurrency': args.concurrency, 'started': datetime.utcnow().isoformat(),
+             'elapsed': elapsed, 'endpoints': summarize(samples, elapsed)}
+  with open(args.output, 'w') as out:
+    json.dump(results, out, indent=2, sort_keys=True)
+  previous = json.load(open(args.compare))['endpoints'] if args.compare else {}
+  print '%-16s %8s %8s %8s %8s %8s %8s %8s' % ('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'errors')
+  for name, stats in sorted(results['endpoints'].iteritems()):
+    line = '%-16s %8d %8.1f %8.2f %8.2f %8.2f %8s %8d' % (
+      name, stats['requests'], stats['throughput'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+      '-' if stats['queries_mean'] is None else '%.1f' % stats['queries_mean'], stats['errors'])
+    if name in previous:
+      line += '  p95 %+.1f%%' % ((stats['p95_ms'] / previous[name]['p95_ms'] - 1) * 100)
+    print line
+  print 'Results written to ' + args.output
+
+
+parser = argparse.ArgumentParser(description='Load test the microblog app')
+commands = parser.add_subparsers()
+command = commands.add_parser('seed', help='fill the database with a synthetic social graph')
+command.add_argument('--users', type=int, default=1000)
+command.add_argument('--posts', type=int, default=20, help='posts per user, on average')
+command.add_argument('--degree', type=int, default=20, help='mean number of users followed')
+command.add_argument('--reset', action='store_true', help='drop the existing tables first')
+command.add_argument('--random-seed', type=int, default=1)
+command.set_defaults(func=seed)
+command = commands.add_parser('trace', help='write a synthetic request trace')
+command.add_argument('--requests', type=int, default=1000)
+command.add_argument('-o', '--output', help='trace file (default: standard output)')
+command.add_argument('--random-seed', type=int, default=1)
+command.set_defaults(func=trace)
+command = commands.add_parser('run', help='replay a request trace')
+command.add_argument('trace')
+command.add_argument('--url', help='base URL of a running server (default: in-process test client)')
+command.add_argument('--concurrency', type=int, default=1, help='parallel requests, with --url')
+command.add_argument('-o', '--output', default='bench_results.json')
+command.add_argument('--compare', help='results of an earlier run to compare p95 latencies with')
+command.set_defaults(func=run)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  args.func(args)
@@ -0,0 +1,54 @@
+#!flask/bin/python
+
+# Benchmarks rendering a home page of POSTS_PER_PAGE posts in each
+# MOMENTJS_MODE, with the fragment cache off (every post is rendered) and on
+# Usage: bench_momentjs.py [iterations]
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+handle, dbfile = tempfile.mkstemp(suffix='.db')
+os.close(handle)
+os.environ['DATABASE_URL'] = 'sqlite:///' + dbfile
+
+from flask import g, render_template
+from app import app, db, fragment_cache
+from app.models import User, Post
+from app.forms import PostForm
+from config import POSTS_PER_PAGE
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+app.config['CSRF_ENABLED'] = False
+db.create_all()
+user = User(nickname='john', email='john@example.com')
+db.session.add(user)
+db.session.commit()
+user.follow(user)
+db.session.add(user)
+now = datetime.utcnow()
+for i in range(POSTS_PER_PAGE):
+  db.session.add(Post(body='post %d' % i, author=user, timestamp=now - timedelta(minutes=37 * i)))
+db.session.commit()
+
+backend = fragment_cache.backend
+try:
+  for mode, cache in [(mode, cache) for cache in (None, backend) for mode in ('script', 'client', 'server')]:
+    app.config['MOMENTJS_MODE'] = mode
+    fragment_cache.backend = cache
+    with app.test_request_context('/index'):
+      g.user = user
+      posts = user.timeline_page(POSTS_PER_PAGE)
+      form = PostForm()
+      page = render_template('index.html', title='Home', user=user, posts=posts, form=form)
+      start = time.time()
+      for i in range(iterations):
+        render_template('index.html', title='Home', user=user, posts=posts, form=form)
+      elapsed = time.time() - start
+    print '%-7s %-9s %7.3f ms/page  %6d bytes  %3d inline scripts' % (
+      mode, 'cached' if cache else 'uncached', elapsed * 1000 / iterations, len(page), page.count('<script>'))
+finally:
+  db.session.remove()
+  os.remove(dbfile)
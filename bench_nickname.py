@@ -0,0 +1,47 @@
+#!flask/bin/python
+
+# Benchmarks picking a unique nickname for a name with many numbered
+# variants taken, against probing one candidate per query
+# Usage: bench_nickname.py [suffixes] [iterations]
+
+import os
+import sys
+import tempfile
+import time
+
+handle, dbfile = tempfile.mkstemp(suffix='.db')
+os.close(handle)
+os.environ['DATABASE_URL'] = 'sqlite:///' + dbfile
+
+from app import app, db
+from app.models import User
+
+suffixes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+
+def probe_nickname(nickname):
+  # the previous allocator: one query per candidate
+  if User.query.filter_by(nickname=nickname).first() is None:
+    return nickname
+  version = 2
+  while User.query.filter_by(nickname=nickname + str(version)).first() is not None:
+    version += 1
+  return nickname + str(version)
+
+db.create_all()
+users = User.__table__
+names = ['john'] + ['john%d' % i for i in range(2, suffixes + 1)] + ['johnny%d' % i for i in range(suffixes)]
+db.session.execute(users.insert(), [{'nickname': name, 'email': name + '@example.com'} for name in names])
+db.session.commit()
+
+try:
+  for name, allocate in [('range', User.make_unique_nickname), ('probe', probe_nickname)]:
+    start = time.time()
+    for i in range(iterations):
+      nickname = allocate('john')
+    elapsed = time.time() - start
+    print '%-6s %9.3f ms/signup  -> %s' % (name, elapsed * 1000 / iterations, nickname)
+finally:
+  db.session.remove()
+  os.remove(dbfile)
@@ -0,0 +1,54 @@
+#!flask/bin/python
+
+# Measures cold start in fresh processes: the time to import the app, and
+# to serve the first requests (the sign in page, then a home page twice)
+# Usage: bench_startup.py [runs]
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+if len(sys.argv) > 1 and sys.argv[1] == '--child':
+  start = time.time()
+  from app import app, db
+  from app.models import User
+  imported = time.time()
+  db.create_all()
+  user = User(nickname='reader', email='reader@example.com')
+  db.session.add(user)
+  db.session.commit()
+  db.session.add(user.follow(user))
+  db.session.commit()
+  user_id = user.id
+  client = app.test_client()
+  times = {'import': imported - start}
+  now = time.time()
+  assert client.get('/login').status_code == 200
+  times['first /login'] = time.time() - now
+  with client.session_transaction() as session:
+    session['user_id'] = unicode(user_id)
+    session['_fresh'] = True
+  for name in ['first /index', 'second /index']:
+    now = time.time()
+    assert client.get('/index').status_code == 200
+    times[name] = time.time() - now
+  print json.dumps(times)
+  sys.exit(0)
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+results = []
+for i in range(runs):
+  handle, dbfile = tempfile.mkstemp(suffix='.db')
+  os.close(handle)
+  try:
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + dbfile)
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'], env=env)
+    results.append(json.loads(output.strip().splitlines()[-1]))
+  finally:
+    os.remove(dbfile)
+for name in ['import', 'first /login', 'first /index', 'second /index']:
+  values = sorted(result[name] for result in results)
+  print '%-15s median %7.1f ms  min %7.1f ms' % (name, values[len(values) // 2] * 1000, values[0] * 1000)
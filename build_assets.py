@@ -0,0 +1,9 @@
+#!flask/bin/python
+
+# Builds the static asset bundles (minified, named by content hash, with
+# precompressed siblings) and their manifest; run at deploy time
+
+from app import assets
+
+for name, filename in sorted(assets.build().items()):
+  print '%-20s -> %s' % (name, filename)
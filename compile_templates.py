@@ -0,0 +1,15 @@
+#!flask/bin/python
+
+# Compiles every template into TEMPLATE_CACHE_DIR, so that workers load
+# them as bytecode instead of compiling them on their first requests; run
+# at deploy time
+
+from app import app
+
+if not app.config.get('TEMPLATE_CACHE_DIR'):
+  print 'The template cache is disabled'
+else:
+  names = app.jinja_env.list_templates()
+  for name in names:
+    app.jinja_env.get_template(name)
+  print 'Compiled %d templates into %s' % (len(names), app.config['TEMPLATE_CACHE_DIR'])
@@ -19,11 +19,156 @@ if os.environ.get('DATABASE_URL') is None:
 else:
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
+# read replicas (space separated in DATABASE_REPLICA_URLS): GET requests read
+# from one of them, except in views that write and for READ_YOUR_WRITES
+# seconds after the client last committed, which covers replication lag
+SQLALCHEMY_REPLICA_URIS = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+READ_YOUR_WRITES = 10
+# connection pools of the primary and the replicas (None keeps the defaults)
+SQLALCHEMY_POOL_SIZE = int(os.environ['DB_POOL_SIZE']) if 'DB_POOL_SIZE' in os.environ else None
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ['DB_MAX_OVERFLOW']) if 'DB_MAX_OVERFLOW' in os.environ else None
+SQLALCHEMY_POOL_TIMEOUT = int(os.environ['DB_POOL_TIMEOUT']) if 'DB_POOL_TIMEOUT' in os.environ else None
+SQLALCHEMY_POOL_RECYCLE = int(os.environ['DB_POOL_RECYCLE']) if 'DB_POOL_RECYCLE' in os.environ else None
+# most SQL statements a page may issue while queries are recorded (debug and
+# testing); going over it fails the request in tests and logs a warning in debug
+SQLALCHEMY_QUERY_BUDGET = 10
+# queries are also recorded (and counted in an X-Query-Count header) when
+# RECORD_QUERIES is set, e.g. for load tests against a production server
+SQLALCHEMY_RECORD_QUERIES = True if os.environ.get('RECORD_QUERIES') else None
+
+# per request timings by phase in a Server-Timing header and at /metrics
+# (Prometheus format, keep it internal), off unless INSTRUMENTATION is set;
+# PROFILE_SAMPLE_RATE of the requests are profiled, and the profiles of the
+# ones slower than PROFILE_SLOW_MS milliseconds are saved in PROFILE_DIR
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION') is not None
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SLOW_MS = 500
+PROFILE_DIR = os.path.join(basedir, 'tmp', 'profiles')
+# /metrics answers requests from these addresses, or with an
+# "Authorization: Bearer <METRICS_TOKEN>" header (behind a proxy or a
+# load balancer, every request comes from its address: use the token)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# last seen times are written in batches: a visit is recorded when the known
+# time is older than the threshold, and flushed every interval (seconds)
+LAST_SEEN_THRESHOLD = 60
+LAST_SEEN_FLUSH_INTERVAL = 60
+
+# signed in users are loaded from an in-process cache of up to SIZE users,
+# each kept for TTL seconds (changes made by other processes show up then)
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 30
+
+# avatars: Gravatar, or a CDN mirroring it, and how many URLs to memoize
+AVATAR_BASE_URL = 'http://www.gravatar.com/avatar/'
+AVATAR_CACHE_SIZE = 10000
+
+# how momentjs(ts) renders times: 'script' (inline document.write per
+# timestamp), 'client' (<time> elements filled in by one script once the
+# page is loaded) or 'server' (text rendered in UTC on the server)
+MOMENTJS_MODE = 'client'
+
+# compiled templates are cached in TEMPLATE_CACHE_DIR (None to compile them
+# in every process); compile_templates.py fills it at deploy time
+TEMPLATE_CACHE_DIR = os.path.join(basedir, 'tmp', 'templates')
+
+# static files bundled, minified, hashed and precompressed into ASSETS_DIR
+# by build_assets.py, by bundle name (see app/assets.py)
+ASSET_BUNDLES = {
+  'js/base.js': ['js/moment.min.js', 'js/moment-bulk.js'],
+  'js/feed-events.js': ['js/feed-events.js'],
+}
+ASSETS_DIR = os.path.join(basedir, 'app', 'static', 'dist')
+
+# rendered post fragments: 'memory' (per process), 'memcached' or 'redis'
+# (shared, at FRAGMENT_CACHE_SERVERS), or None to render every post
+FRAGMENT_CACHE = 'memory'
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_SERVERS = ['127.0.0.1:11211']
+
+# HTTP caching: the home and profile pages are revalidated with ETags, which
+# expire after ETAG_LIFETIME seconds (pages embed CSRF tokens valid for 30
+# minutes); CACHE_CONTROL sets the Cache-Control of other pages by endpoint
+ETAG_LIFETIME = 600
+CACHE_CONTROL = {'login': 'private, max-age=300'}
 
 # pagination
 POSTS_PER_PAGE = 50
 
+# "who to follow": the SUGGESTIONS_COUNT best friends of friends are stored
+# per user (NumPy and SciPy speed this up if installed), recomputed by the
+# job worker SUGGESTIONS_DELAY seconds after a follow, SUGGESTIONS_CHUNK
+# users at a time; pages show SUGGESTIONS_SHOWN of them
+SUGGESTIONS_COUNT = 20
+SUGGESTIONS_DELAY = 60
+SUGGESTIONS_CHUNK = 500
+SUGGESTIONS_SHOWN = 5
+
+# JSON API (/api/v1): most posts per page, avatar size, and responses of at
+# least API_COMPRESS_MIN_SIZE bytes are compressed (brotli if installed, or
+# gzip) at API_COMPRESS_LEVEL; POST /api/v1/following takes at most
+# API_MAX_BULK_FOLLOW users
+API_MAX_PER_PAGE = 100
+API_AVATAR_SIZE = 50
+API_COMPRESS_MIN_SIZE = 500
+API_COMPRESS_LEVEL = 6
+API_MAX_BULK_FOLLOW = 500
+
+# new posts are pushed to followers as server-sent events (/api/v1/events)
+# through EVENTS_BROKER: 'memory' (within one process, run a single async
+# worker) or 'redis' (shared, at EVENTS_BROKER_URL); streams last
+# EVENTS_TIMEOUT seconds with a heartbeat every EVENTS_HEARTBEAT seconds
+EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'memory')
+EVENTS_BROKER_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+EVENTS_HEARTBEAT = 15
+EVENTS_TIMEOUT = 300
+
+# background jobs, run by worker.py: batches of JOBS_BATCH_SIZE due jobs,
+# polled every JOBS_POLL_INTERVAL seconds and held for JOBS_LEASE seconds;
+# failed jobs are run JOBS_MAX_ATTEMPTS times in all, after JOBS_RETRY_DELAY
+# seconds, doubling each time
+JOBS_BATCH_SIZE = 100
+JOBS_POLL_INTERVAL = 1
+JOBS_LEASE = 300
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_DELAY = 30
+
+# mail server settings, and the sender of notifications
+MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
+MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
+MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
+MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+ADMINS = ['you@example.com']
+# base of the links in mails
+SERVER_URL = os.environ.get('SERVER_URL', 'http://localhost:3000')
+# new followers are mailed in one digest per this many seconds
+FOLLOWER_EMAIL_DELAY = 300
+
+# home timeline: authors with more followers than this are not fanned out on
+# write, their posts are merged into the timeline at read time instead
+TIMELINE_FANOUT_LIMIT = 10000
+
 # full text search
 WHOOSH_ENABLED = os.environ.get('HEROKU') is None
+# 'whoosh', 'sqlite' (FTS5), 'postgresql' (tsvector), 'database' for the
+# engine of SQLALCHEMY_DATABASE_URI, or None to disable search; Whoosh keeps
+# its index on the local disk, so it is only used on a single host
+SEARCH_BACKEND = 'whoosh' if WHOOSH_ENABLED else 'database'
+SEARCH_LANGUAGE = 'english'
 WHOOSH_BASE = os.path.join(basedir, 'search.db')
+# search results per page
 MAX_SEARCH_RESULTS = 50
+# search results are cached by query for SEARCH_CACHE_TTL seconds, or until
+# the index is committed
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 60
+# posts are indexed by a background thread: one writer commit per batch of
+# WHOOSH_BATCH_SIZE changes or WHOOSH_BATCH_DELAY milliseconds, and segments
+# are merged every WHOOSH_MERGE_INTERVAL seconds
+WHOOSH_BATCH_SIZE = 100
+WHOOSH_BATCH_DELAY = 500
+WHOOSH_MERGE_INTERVAL = 3600
+# write the index from the job worker instead (run worker.py on the same host)
+SEARCH_INDEX_JOBS = os.environ.get('SEARCH_INDEX_JOBS') is not None
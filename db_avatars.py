@@ -0,0 +1,20 @@
+#!flask/bin/python
+
+# Fills in User.email_hash for users created before it existed
+# Run once after the migration that adds the column
+
+from sqlalchemy import bindparam
+from app import db
+from app.models import User
+
+users = User.__table__
+update = users.update().where(users.c.id == bindparam('uid')).values(email_hash=bindparam('hash'))
+missing = db.select([users.c.id, users.c.email], db.and_(users.c.email_hash == None, users.c.email != None)).order_by(users.c.id).limit(1000)
+count = 0
+while True:
+  rows = db.engine.execute(missing).fetchall()
+  if not rows:
+    break
+  db.engine.execute(update, [{'uid': id, 'hash': User.hash_email(email)} for id, email in rows])
+  count += len(rows)
+print 'Email hashes filled in for ' + str(count) + ' users'
@@ -0,0 +1,13 @@
+#!flask/bin/python
+
+# Exports users, posts and follows as newline-delimited JSON
+# Usage: db_export.py [file]  (default: standard output)
+
+import sys
+from app.bulk import export_ndjson
+
+out = open(sys.argv[1], 'w') if len(sys.argv) > 1 else sys.stdout
+count = export_ndjson(out)
+if out is not sys.stdout:
+  out.close()
+sys.stderr.write('Records exported: %d\n' % count)
@@ -0,0 +1,23 @@
+#!flask/bin/python
+
+# Imports users, posts and follows exported by db_export.py, in batches,
+# then recomputes counters, timelines, suggestions and the search index
+# The records are inserted in one transaction, so a failed import inserts
+# nothing and can be run again once the export is fixed
+# Usage: db_import.py [--batch-size N] [--no-index] [file]  (default: standard input)
+
+import argparse
+import sys
+from app import db
+from app.bulk import import_ndjson
+
+parser = argparse.ArgumentParser(description='Import users, posts and follows from NDJSON')
+parser.add_argument('file', nargs='?', help='the export (default: standard input)')
+parser.add_argument('--batch-size', type=int, default=10000, help='rows per INSERT')
+parser.add_argument('--no-index', action='store_true', help='do not rebuild the Whoosh index')
+args = parser.parse_args()
+
+db.create_all()
+lines = open(args.file) if args.file else sys.stdin
+counts = import_ndjson(lines, args.batch_size, not args.no_index)
+print 'Imported %(user)d users, %(post)d posts, %(follow)d follows' % counts
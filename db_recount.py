@@ -0,0 +1,22 @@
+#!flask/bin/python
+
+# Removes duplicate follow rows and recomputes the follower, following and
+# post counters of every user from scratch
+# Run once after the migration that adds the counters, and before adding
+# the primary key of the followers table, which fails while duplicate
+# follows remain
+
+from app import db
+from app.models import User, followers
+
+duplicates = db.session.execute(db.select([followers.c.follower_id, followers.c.followed_id])
+                                .group_by(followers.c.follower_id, followers.c.followed_id)
+                                .having(db.func.count() > 1)).fetchall()
+for follower_id, followed_id in duplicates:
+  db.session.execute(followers.delete().where(followers.c.follower_id == follower_id)
+                     .where(followers.c.followed_id == followed_id))
+  db.session.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+db.session.commit()
+print 'Duplicate follows removed: ' + str(len(duplicates))
+User.recount()
+print 'Counters recomputed'
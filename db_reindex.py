@@ -0,0 +1,14 @@
+#!flask/bin/python
+
+# Rebuilds the full text search index of posts from the database with the
+# configured search backend (for the database backends, this also creates
+# the full text table, triggers or index in an existing database)
+
+from app import db
+from app.models import search_engine
+
+if search_engine is None:
+  print 'Search is disabled'
+else:
+  count = search_engine.rebuild(db.engine)
+  print 'Search index rebuilt' + ('' if count is None else ': ' + str(count) + ' posts')
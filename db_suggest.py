@@ -0,0 +1,11 @@
+#!flask/bin/python
+
+# Recomputes the "who to follow" suggestions of every user from the follow
+# graph (the job worker keeps them up to date after that)
+
+import time
+from app.models import suggestions
+
+start = time.time()
+count = suggestions.refresh()
+print 'Stored %d suggestions in %.1fs' % (count, time.time() - start)
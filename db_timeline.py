@@ -0,0 +1,11 @@
+#!flask/bin/python
+
+# Rebuilds the materialized home timelines from the followers graph
+# Run once after upgrading, and whenever TIMELINE_FANOUT_LIMIT changes
+
+import sys
+from app.models import Timeline
+
+user_ids = [int(arg) for arg in sys.argv[1:]] or None
+Timeline.rebuild(user_ids)
+print 'Timelines rebuilt for ' + ('all users' if user_ids is None else str(len(user_ids)) + ' users')
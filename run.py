@@ -3,4 +3,4 @@
 # Starts development server with microblog app
 
 from app import app  # import app from app package (init script useful)
-app.run(port=3000, debug=True)
+app.run(port=3000, debug=True, threaded=True)  # threaded, for event streams
@@ -1,2 +1,8 @@
 #!flask/bin/python
+# gunicorn runs this with gevent workers (see the Procfile), so that idle
+# event streams do not hold a worker each; psycopg2 has to yield to the
+# other greenlets while it waits for PostgreSQL
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
 from app import app
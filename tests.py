@@ -2,11 +2,33 @@
 
 # Unit testing for the Flask app
 import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
 from config import basedir
-from app import app, db
-from app.models import User, Post
+from app import app, db, last_seen, fragment_cache, jobs, mail, assets, oid
+from app.models import User, Post, Timeline, followers, search_engine, feed_events, identity_cache, ROLE_ADMIN, suggestions
+from app.views import QueryBudgetExceeded
+from app.momentjs import from_now, calendar, format_time
+from app.indexer import SearchIndexer, rebuild_index
+from app.search import SearchBackend, WhooshBackend
+from app import suggestions as suggestions_module
+from app.instrumentation import Instrumentation
+from app.bulk import export_ndjson, import_ndjson
+from app.emails import follower_notifications
+from StringIO import StringIO
+import gzip
+import json
+import flask.ext.whooshalchemy as whooshalchemy
+import whoosh.index
+import whoosh.query
+from sqlalchemy.exc import IntegrityError
+from flask.ext.sqlalchemy import get_debug_queries
 from datetime import datetime, timedelta
 
 class TestCase(unittest.TestCase):
@@ -18,6 +40,9 @@ class TestCase(unittest.TestCase):
     app.config['CSRF_ENABLED'] = False
     # Use a test database
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+    # pages build the static bundles on first use, not into app/static
+    app.config['ASSETS_DIR'] = self.assets_dir = tempfile.mkdtemp()
+    assets.files = None
     self.app = app.test_client()
     db.create_all()
 
@@ -25,14 +50,31 @@ class TestCase(unittest.TestCase):
     """
     Runs after each testcase
     """
+    last_seen.pending.clear()
+    fragment_cache.backend.lru.clear()
+    identity_cache.cache.clear()
     db.session.remove()
     db.drop_all()
+    shutil.rmtree(self.assets_dir)
+
+  def login(self, user):
+    """
+    Log a user in for the test client, bypassing OpenID
+    """
+    with self.app.session_transaction() as session:
+      session['user_id'] = unicode(user.id)
+      session['_fresh'] = True
 
   def test_avatar(self):
     u = User(nickname = 'john', email = 'john@example.com')
     avatar = u.avatar(128)
     expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
     assert avatar[0:len(expected)] == expected
+    # the hash follows the email and is not recomputed on render
+    assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+    u.email = 'susan@example.com'
+    assert u.email_hash != 'd4c74594d841139328695756648b6bd6'
+    assert u.avatar(128) != avatar
 
   def test_make_unique_nickname(self):
     u = User(nickname = 'john', email = 'john@example.com')
@@ -48,6 +90,30 @@ class TestCase(unittest.TestCase):
     nickname2 = User.make_unique_nickname('john')
     assert nickname2 != 'john'
     assert nickname2 != nickname
+    # other names sharing the prefix do not count, gaps are reused
+    for name in ['johnny', 'john3x', 'John3', 'john4']:
+      db.session.add(User(nickname = name, email = name + '@example.com'))
+    db.session.commit()
+    assert User.make_unique_nickname('john') == 'john3'
+    assert User.make_unique_nickname('johnn') == 'johnn'
+
+  def test_create_unique(self):
+    u, created = User.create_unique('john', 'john@example.com')
+    assert created and u.nickname == 'john'
+    u2, created = User.create_unique('john', 'susan@example.com')
+    assert created and u2.nickname == 'john2'
+    # a signup racing another one for the same account gets that account
+    u3, created = User.create_unique('john', 'john@example.com')
+    assert not created and u3.id == u.id
+    # a nickname taken between the check and the commit is retried
+    make_unique_nickname = User.make_unique_nickname
+    picks = iter(['john2', 'john3'])
+    User.make_unique_nickname = staticmethod(lambda nickname: picks.next())
+    try:
+      u4, created = User.create_unique('john', 'david@example.com')
+    finally:
+      User.make_unique_nickname = staticmethod(make_unique_nickname)
+    assert created and u4.nickname == 'john3'
 
   def test_follow(self):
     u1 = User(nickname = 'john', email = 'john@example.com')
@@ -65,6 +131,8 @@ class TestCase(unittest.TestCase):
     assert u1.followed.first().nickname == 'susan'
     assert u2.followers.count() == 1
     assert u2.followers.first().nickname == 'john'
+    assert u1.following_count == 1 and u1.followers_count == 0
+    assert u2.followers_count == 1 and u2.following_count == 0
     u = u1.unfollow(u2)
     assert u != None
     db.session.add(u)
@@ -72,6 +140,14 @@ class TestCase(unittest.TestCase):
     assert u1.is_following(u2) == False
     assert u1.followed.count() == 0
     assert u2.followers.count() == 0
+    assert u1.following_count == 0
+    assert u2.followers_count == 0
+    # counters left NULL by the migration count from zero
+    db.session.execute(User.__table__.update().values(followers_count = None, following_count = None))
+    db.session.commit()
+    db.session.add(u1.follow(u2))
+    db.session.commit()
+    assert u1.following_count == 1 and u2.followers_count == 1
 
   def test_follow_posts(self):
     # make four users
@@ -122,6 +198,789 @@ class TestCase(unittest.TestCase):
     assert f3 == [p4, p3]
     assert f4 == [p4]
 
+  def test_timeline(self):
+    u1 = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    u3 = User(nickname = 'mary', email = 'mary@example.com')
+    db.session.add(u1)
+    db.session.add(u2)
+    db.session.add(u3)
+    utcnow = datetime.utcnow()
+    p1 = Post(body = "post from susan", author = u2, timestamp = utcnow + timedelta(seconds = 1))
+    db.session.add(p1)
+    db.session.commit()
+    # following copies the existing posts into the timeline
+    u1.follow(u2)
+    u1.follow(u3)
+    db.session.add(u1)
+    db.session.commit()
+    assert [p.id for p in u1.timeline_posts()] == [p1.id]
+    # new posts are fanned out to followers
+    p2 = Post(body = "post from mary", author = u3, timestamp = utcnow + timedelta(seconds = 2))
+    db.session.add(p2)
+    db.session.commit()
+    assert [p.id for p in u1.timeline_posts()] == [p2.id, p1.id]
+    assert [p.id for p in u1.timeline_posts()] == [p.id for p in u1.followed_posts()]
+    # unfollowing removes the author's posts
+    u1.unfollow(u2)
+    db.session.add(u1)
+    db.session.commit()
+    assert [p.id for p in u1.timeline_posts()] == [p2.id]
+    # authors over the fan-out limit are merged in at read time
+    u2.follow(u3)
+    db.session.add(u2)
+    db.session.commit()
+    fanout_limit = app.config['TIMELINE_FANOUT_LIMIT']
+    app.config['TIMELINE_FANOUT_LIMIT'] = 1
+    try:
+      p3 = Post(body = "another post from mary", author = u3, timestamp = utcnow + timedelta(seconds = 3))
+      db.session.add(p3)
+      db.session.commit()
+      assert u3.pull_timeline
+      assert [p.id for p in u1.timeline_posts()] == [p3.id, p2.id]
+      assert [p.id for p in u2.timeline_posts()] == [p3.id, p2.id]
+      Timeline.rebuild()
+      assert [p.id for p in u1.timeline_posts()] == [p3.id, p2.id]
+    finally:
+      app.config['TIMELINE_FANOUT_LIMIT'] = fanout_limit
+
+  def test_keyset_pagination(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    utcnow = datetime.utcnow()
+    # two posts share a timestamp, the id breaks the tie
+    timestamps = [utcnow, utcnow] + [utcnow + timedelta(seconds = i) for i in range(1, 6)]
+    for i, timestamp in enumerate(timestamps):
+      db.session.add(Post(body = "post %d" % i, author = u, timestamp = timestamp))
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    db.session.commit()
+    expected = [p.id for p in u.followed_posts().order_by(Post.id.desc())]
+    for page, cursor in ((u.posts_page, u.posts_cursor), (u.timeline_page, u.timeline_cursor)):
+      # walk down through the older pages
+      seen = []
+      p = page(3)
+      assert not p.has_prev
+      seen += [post.id for post in p.items]
+      while p.has_next:
+        p = page(3, before = p.next_cursor)
+        seen += [post.id for post in p.items]
+      assert seen == expected
+      # and back up through the newer ones
+      p = page(3, after = p.prev_cursor)
+      assert [post.id for post in p.items] == expected[3:6]
+      p = page(3, after = p.prev_cursor)
+      assert [post.id for post in p.items] == expected[0:3]
+      assert not p.has_prev
+      # page numbers translate to the same cursors
+      assert cursor(1, 3) is None
+      assert [post.id for post in page(3, before = cursor(3, 3)).items] == expected[6:]
+
+  def test_last_seen(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    utcnow = datetime.utcnow()
+    last_seen.touch(u, utcnow)
+    # visits are kept in memory until flushed
+    assert last_seen.last_seen(u) == utcnow
+    assert User.query.get(u.id).last_seen is None
+    last_seen.flush()
+    db.session.expire_all()
+    assert User.query.get(u.id).last_seen == utcnow
+    # visits within the threshold are not recorded again
+    last_seen.touch(u, utcnow + timedelta(seconds = 1))
+    assert u.id not in last_seen.pending
+    later = utcnow + timedelta(seconds = app.config['LAST_SEEN_THRESHOLD'] + 1)
+    last_seen.touch(u, later)
+    last_seen.flush()
+    db.session.expire_all()
+    assert User.query.get(u.id).last_seen == later
+
+  def test_page_query_count(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.follow(u)
+    utcnow = datetime.utcnow()
+    for i in range(5):
+      author = User(nickname = 'author%d' % i, email = 'author%d@example.com' % i)
+      db.session.add(author)
+      db.session.commit()
+      u.follow(author)
+      db.session.add(u)
+      db.session.commit()
+      db.session.add(Post(body = "post %d" % i, author = author, timestamp = utcnow + timedelta(seconds = i)))
+      db.session.commit()
+    self.login(u)
+    # authors are loaded with the posts, not one query per post (the
+    # others read the user, the feed's version and its authors in pull
+    # mode), and the suggestions box adds one
+    with self.app:
+      rv = self.app.get('/index')
+      statements = [query.statement for query in get_debug_queries()]
+    assert rv.status_code == 200
+    suggested = [statement for statement in statements if 'JOIN suggestion' in statement]
+    assert len(suggested) == 1
+    assert len(statements) - len(suggested) < 5
+    rv = self.app.get('/user/author0')
+    assert rv.status_code == 200
+
+  def test_query_budget(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    self.login(u)
+    # in testing mode, a page issuing more statements than the budget fails
+    budget = app.config['SQLALCHEMY_QUERY_BUDGET']
+    app.config['SQLALCHEMY_QUERY_BUDGET'] = 1
+    try:
+      self.assertRaises(QueryBudgetExceeded, self.app.get, '/index')
+    finally:
+      app.config['SQLALCHEMY_QUERY_BUDGET'] = budget
+    assert self.app.get('/index').status_code == 200
+
+  def test_identity_cache(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    db.session.commit()
+    self.login(u)
+    rv = self.app.get('/index')
+    assert rv.status_code == 200 and 'john' in rv.data
+    queries = int(rv.headers['X-Query-Count'])
+    hits = identity_cache.cache.hits
+    # the signed in user is not queried again
+    rv = self.app.get('/index')
+    assert rv.status_code == 200
+    assert identity_cache.cache.hits == hits + 1
+    assert int(rv.headers['X-Query-Count']) == queries - 1
+    # editing the profile drops the cached identity
+    rv = self.app.post('/edit', data = dict(nickname = 'johnny', about_me = 'hi'), follow_redirects = True)
+    assert rv.status_code == 200
+    john = identity_cache.get(1)
+    assert john.nickname == 'johnny' and john.about_me == 'hi' and john.version == 1
+    assert john == User.query.get(1)
+    # so does any committed change, e.g. of the role
+    john = User.query.get(1)
+    john.role = ROLE_ADMIN
+    db.session.add(john)
+    db.session.commit()
+    assert identity_cache.get(1).role == ROLE_ADMIN
+    try:
+      identity_cache.get(1).role = 0
+    except AttributeError:
+      pass
+    else:
+      assert False, 'cached identities are read-only'
+    assert identity_cache.get(2) is None
+
+  def test_counters(self):
+    u1 = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    db.session.add(u1)
+    db.session.add(u2)
+    db.session.commit()
+    u1.follow(u1)
+    u1.follow(u2)
+    db.session.add(u1)
+    db.session.add(Post(body = "post from susan", author = u2, timestamp = datetime.utcnow()))
+    db.session.commit()
+    assert (u1.followers_count, u1.following_count, u1.posts_count) == (1, 2, 0)
+    assert (u2.followers_count, u2.following_count, u2.posts_count) == (1, 0, 1)
+    # recounting from scratch gives the same numbers
+    db.session.execute(User.__table__.update().values(followers_count = 0, following_count = 0, posts_count = 0))
+    User.recount()
+    assert (u1.followers_count, u1.following_count, u1.posts_count) == (1, 2, 0)
+    assert (u2.followers_count, u2.following_count, u2.posts_count) == (1, 0, 1)
+    # duplicate follow rows are rejected by the primary key
+    try:
+      db.session.execute(followers.insert().values(follower_id = u1.id, followed_id = u2.id))
+    except IntegrityError:
+      db.session.rollback()
+    else:
+      assert False, 'duplicate follow was stored'
+
+  def test_fragment_cache(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    db.session.add(Post(body = "post from john", author = u, timestamp = datetime.utcnow()))
+    db.session.commit()
+    self.login(u)
+    rv = self.app.get('/index')
+    assert '>john</a> said' in rv.data
+    post = Post.query.first()
+    assert fragment_cache.key(post) in fragment_cache.backend.get_many([fragment_cache.key(post)])
+    # changing the nickname retires the cached fragments
+    rv = self.app.post('/edit', data = dict(nickname = 'johnny', about_me = ''))
+    assert rv.status_code == 302
+    rv = self.app.get('/index')
+    assert '>johnny</a> said' in rv.data
+    assert '>john</a> said' not in rv.data
+
+  def test_momentjs_server(self):
+    now = datetime(2014, 5, 14, 15, 30)
+    assert from_now(now - timedelta(seconds = 10), now) == 'a few seconds ago'
+    assert from_now(now - timedelta(minutes = 5), now) == '5 minutes ago'
+    assert from_now(now - timedelta(hours = 1), now) == 'an hour ago'
+    assert from_now(now - timedelta(days = 3), now) == '3 days ago'
+    assert from_now(now - timedelta(days = 400), now) == 'a year ago'
+    assert from_now(now + timedelta(hours = 3), now) == 'in 3 hours'
+    assert calendar(now - timedelta(hours = 1), now) == 'Today at 2:30 PM'
+    assert calendar(now - timedelta(days = 1), now) == 'Yesterday at 3:30 PM'
+    assert calendar(now - timedelta(days = 3), now) == 'Last Sunday at 3:30 PM'
+    assert calendar(now - timedelta(days = 30), now) == '04/14/2014'
+    assert format_time(now, 'dddd, MMMM Do YYYY [at] HH:mm') == 'Wednesday, May 14th 2014 at 15:30'
+
+  def test_assets(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    self.login(u)
+    # bundles are built on first use, and linked by their content hash
+    rv = self.app.get('/index')
+    with app.test_request_context():
+      url = assets.asset_url('js/base.js')
+      assert assets.asset_url('js/moment.min.js') == '/static/js/moment.min.js'
+    assert url.startswith('/assets/js/base.') and url in rv.data
+    assert 'moment-bulk' not in rv.data
+    # every file was renamed into place
+    assert not [name for name in os.listdir(os.path.join(self.assets_dir, 'js')) if name.startswith('.')]
+    rv = self.app.get(url)
+    assert rv.status_code == 200 and 'Content-Encoding' not in rv.headers
+    assert 'moment.js' in rv.data and 'DOMContentLoaded' in rv.data and '// Fills in' not in rv.data
+    assert 'public' in rv.headers['Cache-Control'] and 'max-age=31536000' in rv.headers['Cache-Control']
+    plain = rv.data
+    rv = self.app.get(url, headers = {'Accept-Encoding': 'gzip, deflate'})
+    assert rv.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in rv.headers['Vary']
+    assert gzip.GzipFile(fileobj = StringIO(rv.data)).read() == plain
+    assert self.app.get('/assets/js/missing.js').status_code == 404
+    assert self.app.get('/assets/../manifest.json').status_code == 404
+    # files of earlier builds are still served
+    with open(os.path.join(self.assets_dir, 'js', 'base.000000000000.js'), 'w') as f:
+      f.write('old')
+    assert self.app.get('/assets/js/base.000000000000.js').data == 'old'
+
+  def test_lazy_startup(self):
+    # Whoosh, OpenID and NumPy are not imported along with the app
+    script = "import sys, app; print [m for m in ('whoosh', 'openid', 'numpy') if m in sys.modules]"
+    output = subprocess.check_output([sys.executable, '-c', script], cwd = basedir)
+    assert output.strip() == '[]'
+    # nor by the sign in page, until an OpenID sign in starts
+    oid.oid = None
+    assert self.app.get('/login').status_code == 200
+    assert oid.oid is None
+
+  def test_search_indexer(self):
+    base = tempfile.mkdtemp()
+    indexer = None
+    try:
+      schema = whooshalchemy._get_whoosh_schema_and_primary_key(Post)[0]
+      index = whoosh.index.create_in(base, schema)
+      indexer = SearchIndexer(app, Post, index)
+      u = User(nickname = 'john', email = 'john@example.com')
+      p1 = Post(body = "my first post", author = u, timestamp = datetime.utcnow())
+      p2 = Post(body = "my second post", author = u, timestamp = datetime.utcnow())
+      db.session.add(u)
+      db.session.add(p1)
+      db.session.add(p2)
+      db.session.commit()
+      # changes are queued, and written in one batch
+      indexer.on_commit(app, [(u, 'insert'), (p1, 'insert'), (p2, 'insert')])
+      indexer.flush()
+      assert indexer.stats()['queued'] == 0
+      assert indexer.stats()['batches'] == 1
+      assert indexer.stats()['indexed'] == 2
+      searcher = index.searcher()
+      assert len(searcher.search(whoosh.query.Term('body', u'post'))) == 2
+      searcher.close()
+      indexer.on_commit(app, [(p1, 'delete')])
+      indexer.flush()
+      searcher = index.searcher()
+      results = searcher.search(whoosh.query.Term('body', u'post'))
+      assert [r['id'] for r in results] == [unicode(p2.id)]
+      searcher.close()
+      # the index can be rebuilt from the database
+      app.config['WHOOSH_BASE'], old_base = base, app.config['WHOOSH_BASE']
+      try:
+        assert rebuild_index(app, Post, db.engine, batch_size = 1) == 2
+      finally:
+        app.config['WHOOSH_BASE'] = old_base
+      index = whoosh.index.open_dir(os.path.join(base, 'Post'))
+      searcher = index.searcher()
+      assert len(searcher.search(whoosh.query.Term('body', u'second'))) == 1
+      searcher.close()
+    finally:
+      # the indexer thread must not outlive its index
+      if indexer is not None:
+        indexer.stop()
+      shutil.rmtree(base)
+
+  def test_search(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.add(Post(body = "my first post", author = u, timestamp = datetime.utcnow()))
+    db.session.add(Post(body = "second post, about cats", author = u, timestamp = datetime.utcnow()))
+    db.session.commit()
+    if isinstance(search_engine, WhooshBackend):
+      # drop the documents of earlier tests' posts
+      search_engine.indexer.flush()
+      search_engine.rebuild(db.engine)
+      # a rebuilt index starts over from the same generation number, but
+      # results cached for the old one are not used
+      generation = search_engine.generation()
+      search_engine.rebuild(db.engine)
+      assert search_engine.generation()[0] == generation[0]
+      assert search_engine.generation() != generation
+    assert len(search_engine.posts('posts', 10)) == 2
+    cats = search_engine.posts('cats', 10)
+    assert [p.body for p in cats] == ["second post, about cats"]
+    assert search_engine.posts('post dogs', 10) == []
+    # malformed query syntax is not an error
+    search_engine.posts('"cats OR (', 10)
+    self.login(u)
+    rv = self.app.get('/search_results/cats')
+    assert 'about cats' in rv.data
+    assert 'my first post' not in rv.data
+    # pages, and the result cache
+    page = search_engine.page('Post', 2, 1)
+    assert page.total == 2 and len(page.items) == 1 and not page.has_next
+    hits = search_engine.results.hits
+    assert search_engine.page('  post ', 2, 1).items[0].id == page.items[0].id
+    assert search_engine.results.hits == hits + 1
+    assert search_engine.page('post', 3, 1).items == []
+    rv = self.app.get('/search_results/post/3')
+    assert rv.status_code == 404
+    # committing the index invalidates cached results
+    db.session.delete(cats[0])
+    db.session.commit()
+    if isinstance(search_engine, WhooshBackend):
+      search_engine.indexer.flush()
+    assert search_engine.posts('cats', 10) == []
+    # backends implement the whole interface
+    self.assertRaises(TypeError, SearchBackend, app, db, Post)
+
+  def test_conditional_get(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    db.session.add(u)
+    db.session.add(u2)
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    db.session.add(Post(body = "post from john", author = u, timestamp = datetime.utcnow()))
+    db.session.commit()
+    self.login(u)
+    for url in ['/index', '/user/susan']:
+      rv = self.app.get(url)
+      etag = rv.headers['ETag']
+      assert rv.headers['Cache-Control'] == 'private, no-cache'
+      # the version token is read, nothing is loaded or rendered
+      rv = self.app.get(url, headers = {'If-None-Match': etag})
+      assert rv.status_code == 304 and rv.data == ''
+      assert int(rv.headers['X-Query-Count']) <= 3
+    assert 'Last-Modified' in self.app.get('/index').headers
+    # a new post in the feed
+    rv = self.app.get('/index', headers = {'If-None-Match': etag})
+    etag = rv.headers['ETag']
+    db.session.add(Post(body = "another post from john", author = User.query.get(1), timestamp = datetime.utcnow()))
+    db.session.commit()
+    rv = self.app.get('/index', headers = {'If-None-Match': etag})
+    assert rv.status_code == 200 and 'another post from john' in rv.data
+    # following changes both pages
+    etags = dict((url, self.app.get(url).headers['ETag']) for url in ['/index', '/user/susan'])
+    rv = self.app.get('/follow/susan')
+    assert rv.status_code == 302
+    # no ETag while a flashed message is pending
+    rv = self.app.get('/user/susan', headers = {'If-None-Match': etags['/user/susan']})
+    assert rv.status_code == 200 and 'ETag' not in rv.headers and 'now following' in rv.data
+    for url, etag in etags.items():
+      rv = self.app.get(url, headers = {'If-None-Match': etag})
+      assert rv.status_code == 200 and rv.headers['ETag'] != etag
+    # a nickname change of a followed user changes the feed
+    etag = self.app.get('/index').headers['ETag']
+    susan = User.query.filter_by(nickname = 'susan').first()
+    susan.version += 1
+    db.session.add(susan)
+    db.session.commit()
+    assert self.app.get('/index', headers = {'If-None-Match': etag}).status_code == 200
+    # so do recomputed suggestions, and a change to the viewer made by
+    # another process while the identity cache here holds the old row
+    john_id = User.query.filter_by(nickname = 'john').first().id
+    susan_id = User.query.filter_by(nickname = 'susan').first().id
+    users = User.__table__
+    changes = [suggestions.table.insert().values(user_id = john_id, suggested_id = susan_id, score = 1),
+               users.update().where(users.c.id == john_id).values(version = users.c.version + 1)]
+    for change in changes:
+      etags = dict((url, self.app.get(url).headers['ETag']) for url in ['/index', '/user/susan'])
+      db.engine.execute(change)
+      for url, etag in etags.items():
+        assert self.app.get(url, headers = {'If-None-Match': etag}).status_code == 200
+    # anonymous pages get their Cache-Control policy
+    with self.app.session_transaction() as session:
+      session.clear()
+    rv = self.app.get('/login')
+    assert rv.status_code == 200 and rv.headers['Cache-Control'] == 'private, max-age=300'
+
+  def test_api(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    db.session.add(u)
+    db.session.add(u2)
+    db.session.commit()
+    u.follow(u)
+    u2.follow(u2)
+    db.session.add(u)
+    db.session.add(u2)
+    utcnow = datetime.utcnow()
+    for i in range(5):
+      db.session.add(Post(body = "post %d from susan" % i, author = u2, timestamp = utcnow + timedelta(seconds = i)))
+    db.session.commit()
+    rv = self.app.get('/api/v1/timeline')
+    assert rv.status_code == 401 and json.loads(rv.data)['error']
+    self.login(User.query.filter_by(nickname = 'john').first())
+    rv = self.app.put('/api/v1/following/susan')
+    assert json.loads(rv.data) == {'nickname': 'susan', 'following': True, 'followers_count': 2}
+    # cursor paging, newest first
+    data = json.loads(self.app.get('/api/v1/timeline?limit=2').data)
+    assert [post['body'] for post in data['posts']] == ["post 4 from susan", "post 3 from susan"]
+    assert data['posts'][0]['author'] == 'susan' and data['posts'][0]['avatar'] == User.avatar_url(User.hash_email('susan@example.com'), 50)
+    assert data['prev'] is None
+    data = json.loads(self.app.get('/api/v1/timeline?limit=2&before=' + data['next']).data)
+    assert [post['body'] for post in data['posts']] == ["post 2 from susan", "post 1 from susan"]
+    data = json.loads(self.app.get('/api/v1/users/susan/posts?limit=10&after=' + data['prev']).data)
+    assert [post['body'] for post in data['posts']] == ["post 4 from susan", "post 3 from susan"]
+    # field selection
+    data = json.loads(self.app.get('/api/v1/users/susan/posts?fields=id,body').data)
+    assert len(data['posts']) == 5 and set(data['posts'][0]) == set(['id', 'body'])
+    assert self.app.get('/api/v1/timeline?fields=email').status_code == 400
+    assert self.app.get('/api/v1/users/david/posts').status_code == 404
+    assert self.app.get('/api/v1/timeline?before=garbage').status_code == 404
+    # compression
+    rv = self.app.get('/api/v1/timeline', headers = {'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.GzipFile(fileobj = StringIO(rv.data)).read())['posts']) == 5
+    if isinstance(search_engine, WhooshBackend):
+      search_engine.indexer.flush()
+      search_engine.rebuild(db.engine)
+    data = json.loads(self.app.get('/api/v1/search?q=susan&limit=2&fields=body').data)
+    assert data['total'] == 5 and data['pages'] == 3 and len(data['posts']) == 2
+    rv = self.app.delete('/api/v1/following/susan')
+    assert json.loads(rv.data)['followers_count'] == 1
+    assert json.loads(self.app.get('/api/v1/timeline').data)['posts'] == []
+
+  def test_bulk_follow(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    db.session.add(u.follow(u))
+    utcnow = datetime.utcnow()
+    for i in range(30):
+      author = User(nickname = 'author%d' % i, email = 'author%d@example.com' % i)
+      db.session.add(author)
+      db.session.add(Post(body = "post from author%d" % i, author = author, timestamp = utcnow + timedelta(seconds = i)))
+    db.session.commit()
+    self.login(u)
+    post = lambda data: self.app.post('/api/v1/following', data = json.dumps(data), content_type = 'application/json')
+    rv = post({'follow': ['author0', 'author1']})
+    assert json.loads(rv.data) == {'followed': ['author0', 'author1'], 'unfollowed': []}
+    # by nickname or id, skipping unknown users, themselves and repeats, in
+    # as many statements for 28 users as for 2
+    queries = int(rv.headers['X-Query-Count'])
+    ids = [User.query.filter_by(nickname = 'author%d' % i).first().id for i in range(30)]
+    rv = post({'follow': ['author%d' % i for i in range(1, 15)] + ids[15:] + ['nobody', 999, 'john']})
+    assert rv.status_code == 200
+    assert int(rv.headers['X-Query-Count']) == queries
+    assert json.loads(rv.data)['followed'] == ['author%d' % i for i in range(2, 30)]
+    john = User.query.filter_by(nickname = 'john').first()
+    assert john.following_count == 31 and john.followed.count() == 31
+    assert User.query.get(ids[5]).followers_count == 1
+    assert john.timeline_posts().count() == 30
+    # a job per new follower email, inserted together
+    assert db.engine.execute(db.select([db.func.count()], jobs.table.c.kind == 'follower_email')).scalar() == 30
+    # a user both followed and unfollowed, by nickname or id, is an error
+    assert post({'unfollow': ['author0', 'author1'], 'follow': [ids[0]]}).status_code == 400
+    assert john.is_following(User.query.get(ids[0]))
+    rv = post({'unfollow': [ids[1], 'author0', 'john', 'nobody'], 'follow': ['author0x']})
+    assert json.loads(rv.data) == {'followed': [], 'unfollowed': ['author0', 'author1']}
+    john = User.query.filter_by(nickname = 'john').first()
+    assert john.following_count == 29 and john.is_following(john)
+    assert User.query.get(ids[0]).followers_count == 0
+    assert john.timeline_posts().count() == 28
+    assert post({'follow': 'author0'}).status_code == 400
+    assert post({'follow': [True]}).status_code == 400
+    assert post({'follow': ['author%d' % i for i in range(501)]}).status_code == 400
+
+  def test_feed_events(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    u3 = User(nickname = 'david', email = 'david@example.com')
+    db.session.add_all([u, u2, u3])
+    db.session.commit()
+    u.follow(u)
+    u.follow(u2)
+    db.session.add(u)
+    db.session.commit()
+    self.login(u)
+    app.config['EVENTS_HEARTBEAT'] = 0.05
+    app.config['EVENTS_TIMEOUT'] = 0.2
+    try:
+      rv = self.app.get('/api/v1/events', buffered = True)
+      assert rv.mimetype == 'text/event-stream'
+      assert rv.data.startswith('retry: 3000\n\n: ping\n\n')
+      assert feed_events.broker.channels == {}
+    finally:
+      app.config['EVENTS_HEARTBEAT'] = 15
+      app.config['EVENTS_TIMEOUT'] = 300
+    susan = User.query.filter_by(nickname = 'susan').first()
+    david = User.query.filter_by(nickname = 'david').first()
+    # only the posts of followed users are pushed, once committed
+    stream = feed_events.stream([1, susan.id])
+    chunks = iter(stream.response)
+    assert chunks.next().startswith('retry:')
+    db.session.add(Post(body = "post from david", author = david, timestamp = datetime.utcnow()))
+    db.session.add(Post(body = "post from susan", author = susan, timestamp = datetime.utcnow()))
+    db.session.commit()
+    post = Post.query.filter_by(body = "post from susan").first()
+    event = chunks.next()
+    assert event.startswith('id: %d\nevent: post\n' % post.id)
+    data = json.loads(event.split('data: ')[1])
+    assert data['author_id'] == susan.id
+    # the cursor fetches the announced post, and any newer ones, from the API
+    posts = json.loads(self.app.get('/api/v1/timeline?after=' + data['cursor']).data)['posts']
+    assert [p['id'] for p in posts] == [post.id]
+    stream.close()
+    assert feed_events.broker.channels == {}
+
+  def test_jobs(self):
+    runs = []
+    @jobs.handler('test_batch', batch = True)
+    def batch(payloads):
+      runs.append(payloads)
+    @jobs.handler('test_fail')
+    def fail(payload):
+      raise ValueError(payload)
+    jobs.enqueue_many('test_batch', [1, 2])
+    jobs.enqueue_many('test_batch', [3], delay = 60)
+    jobs.enqueue_many('test_fail', ['boom'])
+    assert jobs.work() == 3
+    # same-type jobs are run in one batch, failed ones are retried later
+    assert runs == [[1, 2]]
+    table = jobs.table
+    job = db.engine.execute(table.select().where(table.c.kind == 'test_fail')).first()
+    assert job.attempts == 1 and 'boom' in job.error
+    assert timedelta(seconds = 29) < job.run_at - datetime.utcnow() <= timedelta(seconds = 30)
+    assert jobs.work() == 0
+    # until they are given up on
+    app.config['JOBS_MAX_ATTEMPTS'] = 2
+    try:
+      db.engine.execute(table.update().values(run_at = datetime.utcnow()))
+      assert jobs.work() == 2
+      assert runs == [[1, 2], [3]]
+      job = db.engine.execute(table.select()).first()
+      assert job.attempts == 2 and job.run_at is None
+    finally:
+      app.config['JOBS_MAX_ATTEMPTS'] = 5
+
+  def test_follower_email(self):
+    u = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    u3 = User(nickname = 'david', email = 'david@example.com')
+    u4 = User(nickname = 'mary', email = 'mary@example.com')
+    db.session.add_all([u, u2, u3, u4])
+    db.session.commit()
+    mail.suppress = True
+    with mail.record_messages() as outbox:
+      for follower in ['susan', 'david']:
+        self.login(User.query.filter_by(nickname = follower).first())
+        assert self.app.get('/follow/john').status_code == 302
+      # nothing is sent in the request, nor before the digest is due
+      assert outbox == []
+      assert jobs.work() == 0
+      # follows at different times of a window are due together, when it ends
+      delay = app.config['FOLLOWER_EMAIL_DELAY']
+      start = (time.time() // delay - 10) * delay
+      john = User.query.filter_by(nickname = 'john').first()
+      db.engine.execute(jobs.table.delete())
+      follower_notifications([john.id], User.query.filter_by(nickname = 'susan').first(), now = start + 1)
+      follower_notifications([john.id], User.query.filter_by(nickname = 'david').first(), now = start + delay - 1)
+      db.session.commit()
+      due = [row[0] for row in db.engine.execute(db.select([jobs.table.c.run_at]))]
+      assert due == [datetime.utcfromtimestamp(start + delay)] * 2
+      assert jobs.work() == 2
+      assert len(outbox) == 1
+      assert outbox[0].recipients == ['john@example.com']
+      assert outbox[0].subject == '[microblog] 2 new followers'
+      assert 'http://localhost:3000/user/susan' in outbox[0].body
+      # followers who left in the meantime are not announced
+      self.login(User.query.filter_by(nickname = 'mary').first())
+      self.app.get('/follow/john')
+      self.app.get('/unfollow/john')
+      assert jobs.work() == 0
+      db.engine.execute(jobs.table.update().where(jobs.table.c.kind == 'follower_email').values(run_at = datetime.utcnow()))
+      assert jobs.work() == 1
+      assert len(outbox) == 1
+
+  def test_suggestions(self):
+    users = dict((name, User(nickname = name, email = name + '@example.com'))
+                 for name in ['john', 'susan', 'david', 'mary', 'tom'])
+    db.session.add_all(users.values())
+    db.session.commit()
+    for follower, followed in [('john', 'john'), ('john', 'susan'), ('john', 'david'), ('susan', 'mary'),
+                               ('susan', 'tom'), ('david', 'mary'), ('david', 'john')]:
+      db.session.add(users[follower].follow(users[followed]))
+      db.session.commit()
+    ids = dict((name, user.id) for name, user in users.items())
+    # friends of friends, best first, never themselves or whom they follow
+    db.engine.execute(jobs.table.delete())
+    assert suggestions.refresh() == 3
+    john = User.query.get(ids['john'])
+    assert [user.nickname for user in john.suggestions(5)] == ['mary', 'tom']
+    assert [user.nickname for user in User.query.get(ids['david']).suggestions(5)] == ['susan']
+    # the same without NumPy/SciPy
+    edges = suggestions.edges()
+    numpy = suggestions_module.numpy
+    suggestions_module.numpy = False
+    try:
+      rows = suggestions_module.two_hop(edges[0], edges[1], ids.values(), 1)
+    finally:
+      suggestions_module.numpy = numpy
+    assert (ids['john'], ids['mary'], 2) in rows
+    # new follows are left out at once, and refreshed by a job
+    self.login(john)
+    assert 'Who to follow' in self.app.get('/index').data
+    assert self.app.get('/follow/tom').status_code == 302
+    assert [user.nickname for user in User.query.get(ids['john']).suggestions(5)] == ['mary']
+    table = suggestions.table
+    db.engine.execute(jobs.table.update().where(jobs.table.c.kind == 'suggestions').values(run_at = datetime.utcnow()))
+    assert jobs.work() == 1
+    suggested = lambda name: [row[0] for row in db.engine.execute(
+      db.select([table.c.suggested_id], table.c.user_id == ids[name]).order_by(table.c.score.desc(), table.c.suggested_id))]
+    assert suggested('john') == [ids['mary']]
+    # and so are those of john's followers
+    assert suggested('david') == sorted([ids['susan'], ids['tom']])
+
+  @unittest.skipIf(not suggestions_module.load_numpy(), 'NumPy and SciPy are not installed')
+  def test_two_hop_sparse(self):
+    # the CSR computation gives the results of plain Python, ties included
+    rng = random.Random(1)
+    follower_ids, followed_ids = zip(*sorted(set((rng.randint(1, 30), rng.randint(1, 30)) for i in range(300))))
+    user_ids = range(1, 36)
+    numpy = suggestions_module.numpy
+    suggestions_module.numpy = False
+    try:
+      expected = dict((k, suggestions_module.two_hop(follower_ids, followed_ids, user_ids, k)) for k in [1, 3, 50])
+    finally:
+      suggestions_module.numpy = numpy
+    for k, rows in expected.items():
+      assert suggestions_module.two_hop_sparse(follower_ids, followed_ids, user_ids, k) == rows
+    assert suggestions_module.two_hop_sparse(follower_ids, followed_ids, [40], 3) == []
+
+  def test_instrumentation(self):
+    app.config['INSTRUMENTATION'] = True
+    instrumentation = Instrumentation(app, db)
+    try:
+      u = User(nickname = 'john', email = 'john@example.com')
+      db.session.add(u)
+      db.session.commit()
+      u.follow(u)
+      db.session.add(u)
+      db.session.add(Post(body = "post from john", author = u, timestamp = datetime.utcnow()))
+      db.session.commit()
+      self.login(u)
+      rv = self.app.get('/index')
+      phases = dict(phase.split(';')[0:2] for phase in rv.headers['Server-Timing'].split(', '))
+      assert set(phases) == set(['db', 'template', 'search', 'other', 'total'])
+      assert float(phases['template'][4:]) > 0
+      assert float(phases['db'][4:]) > 0
+      assert 'queries' in rv.headers['Server-Timing']
+      rv = self.app.get('/metrics', environ_base = {'REMOTE_ADDR': '127.0.0.1'})
+      assert 'microblog_requests_total{endpoint="index",status="200"} 1' in rv.data
+      assert 'microblog_request_duration_seconds_count{endpoint="index"} 1' in rv.data
+      assert 'microblog_db_queries_total{endpoint="index"}' in rv.data
+      # other clients need the token
+      remote = {'REMOTE_ADDR': '10.0.0.1'}
+      assert self.app.get('/metrics', environ_base = remote).status_code == 403
+      app.config['METRICS_TOKEN'] = 'secret'
+      rv = self.app.get('/metrics', environ_base = remote, headers = {'Authorization': 'Bearer wrong'})
+      assert rv.status_code == 403
+      rv = self.app.get('/metrics', environ_base = remote, headers = {'Authorization': 'Bearer secret'})
+      assert rv.status_code == 200
+    finally:
+      app.config['METRICS_TOKEN'] = None
+      instrumentation.uninstall()
+      app.config['INSTRUMENTATION'] = False
+    # later requests are not timed
+    rv = self.app.get('/index')
+    assert 'Server-Timing' not in rv.headers
+    assert self.app.get('/metrics').status_code == 404
+
+  def test_read_replica(self):
+    uri = 'sqlite:///' + os.path.join(basedir, 'test_replica.db')
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [uri]
+    replica = db.replica_engine(app, uri)
+    db.metadata.create_all(bind = replica)
+    try:
+      u = User(nickname = 'john', email = 'john@example.com', about_me = 'on the primary')
+      db.session.add(u)
+      db.session.commit()
+      replica.execute(User.__table__.insert(), id = u.id, nickname = 'john', email = 'john@example.com',
+                      about_me = 'on the replica')
+      self.login(u)
+      rv = self.app.get('/user/john')
+      assert 'on the replica' in rv.data
+      # the client reads its own writes from the primary for a while
+      rv = self.app.post('/edit', data = dict(nickname = 'john', about_me = 'edited'))
+      assert rv.status_code == 302
+      rv = self.app.get('/user/john')
+      assert 'edited' in rv.data
+      app.config['READ_YOUR_WRITES'] = 0
+      rv = self.app.get('/user/john')
+      assert 'on the replica' in rv.data
+    finally:
+      app.config['SQLALCHEMY_REPLICA_URIS'] = []
+      app.config['READ_YOUR_WRITES'] = 10
+      db.metadata.drop_all(bind = replica)
+      replica.dispose()
+      db.replicas.clear()
+      os.remove(os.path.join(basedir, 'test_replica.db'))
+
+  def test_bulk_export_import(self):
+    u1 = User(nickname = 'john', email = 'john@example.com')
+    u2 = User(nickname = 'susan', email = 'susan@example.com')
+    db.session.add(u1)
+    db.session.add(u2)
+    db.session.commit()
+    u1.follow(u2)
+    db.session.add(u1)
+    db.session.add(Post(body = "post from susan", author = u2, timestamp = datetime.utcnow()))
+    db.session.add(Post(body = "another post from susan", author = u2, timestamp = datetime.utcnow()))
+    db.session.commit()
+    out = StringIO()
+    assert export_ndjson(out, batch_size = 1) == 5
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    # a failed import inserts nothing, so it can be run again
+    lines = StringIO(out.getvalue()).readlines()
+    self.assertRaises(ValueError, import_ndjson, lines[:3] + ['{not json\n'] + lines[3:], batch_size = 1)
+    assert User.query.count() == 0 and Post.query.count() == 0
+    counts = import_ndjson(lines, batch_size = 1)
+    assert counts == {'user': 2, 'post': 2, 'follow': 1}
+    john = User.query.filter_by(nickname = 'john').first()
+    susan = User.query.filter_by(nickname = 'susan').first()
+    assert john.email_hash == User.hash_email('john@example.com')
+    assert john.is_following(susan)
+    assert john.following_count == 1 and susan.followers_count == 1 and susan.posts_count == 2
+    assert [p.body for p in john.timeline_posts()] == ["another post from susan", "post from susan"]
+    assert len(search_engine.posts('another', 10)) == 1
+
 # standard boilerplate
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,17 @@
+#!flask/bin/python
+
+# Runs background jobs (mail, search indexing with SEARCH_INDEX_JOBS) until
+# stopped with SIGTERM or Ctrl-C; run one or more next to the web server
+
+import logging
+import signal
+from app import app, jobs
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+app.logger.addHandler(handler)
+signal.signal(signal.SIGTERM, jobs.stop)
+try:
+  jobs.run_forever()
+except KeyboardInterrupt:
+  pass